@@ -25,11 +25,13 @@
 
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 import warnings
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from torchvision.transforms import Normalize, Compose
-from IBA.utils import _to_saliency_map, get_tqdm, ifnone
+from IBA.utils import _to_saliency_map, _to_saliency_maps, _bilinear_indices, _relative_change, \
+    get_tqdm, ifnone, estimator_cache_key, load_estimator_cache, save_estimator_cache
 
 # Helper Functions
 
@@ -45,6 +47,48 @@ def to_saliency_map(capacity, shape=None):
     return _to_saliency_map(capacity, shape, data_format="channels_first")
 
 
+def to_saliency_maps(capacities, shape=None):
+    """
+    Converts a batch of capacities (in nats) to saliency maps (in bits) of the given shape.
+    For tensors, the channel sum and the upsampling run on the device of ``capacities`` and
+    only the final maps are copied back. Gives the same output as :func:`to_saliency_map`
+    for every image.
+
+    Args:
+        capacities (torch.Tensor or np.ndarray): Capacities in nats, shape ``(N, C, H, W)``.
+        shape (tuple): (height, width) of the images.
+
+    Returns:
+        np.ndarray of shape ``(N, height, width)``.
+    """
+    if not torch.is_tensor(capacities):
+        return _to_saliency_maps(capacities, shape, data_format="channels_first")
+    capacities = capacities.detach()
+    saliency_maps = torch.where(torch.isnan(capacities), torch.zeros_like(capacities),
+                                capacities).sum(1) / float(np.log(2))
+    if shape is not None:
+        ho, wo = saliency_maps.shape[1:]
+        h, w = shape
+        saliency_maps = saliency_maps * ((ho*wo) / (h*w))
+        # the indices of the NumPy fallback, bilinear interpolation of the rows then the columns
+        for dim, (n_in, n_out) in ((1, (ho, h)), (2, (wo, w))):
+            lo, hi, weight = (torch.from_numpy(x).to(saliency_maps.device)
+                              for x in _bilinear_indices(n_in, n_out))
+            weight = weight.view((1, -1, 1) if dim == 1 else (1, 1, -1))
+            saliency_maps = (saliency_maps.index_select(dim, lo) * (1 - weight) +
+                             saliency_maps.index_select(dim, hi) * weight)
+    return saliency_maps.cpu().numpy()
+
+
+def model_cache_key(model, layer_name, manifest=None, folds=None):
+    """
+    Returns the estimator cache key of ``layer_name`` in ``model``, see
+    :func:`IBA.utils.estimator_cache_key`.
+    """
+    weights = [t.detach().cpu().numpy() for t in model.state_dict().values()]
+    return estimator_cache_key(weights, layer_name, manifest, folds)
+
+
 def insert_into_sequential(sequential, layer, idx):
     """
     Returns a ``nn.Sequential`` with ``layer`` inserted in ``sequential`` at position ``idx``.
@@ -91,39 +135,46 @@ def get_imagenet_folder(path, image_size=224, transform='default'):
     return ImageFolder(path, transform=transform)
 
 
+# 1-D gaussian kernels per (kernel_size, sigma, channels, device, dtype)
+_gaussian_kernels = {}
+
+
+def _gaussian_kernel_1d(kernel_size, sigma, channels, device=None, dtype=torch.float):
+    """ Returns the normalized 1-D gaussian kernel of shape ``(channels, 1, kernel_size)``. """
+    key = (kernel_size, float(sigma), channels, str(device), dtype)
+    if key not in _gaussian_kernels:
+        x_cord = torch.arange(kernel_size, dtype=torch.float) - (kernel_size - 1) / 2.
+        kernel = torch.exp(-x_cord ** 2 / (2 * sigma ** 2.))
+        kernel = (kernel / kernel.sum()).expand(channels, 1, -1)
+        _gaussian_kernels[key] = kernel.to(device=device, dtype=dtype).contiguous()
+    return _gaussian_kernels[key]
+
+
 class _SpatialGaussianKernel(nn.Module):
-    """ A simple convolutional layer with fixed gaussian kernels, used to smoothen the input """
+    """
+    A simple convolutional layer with fixed gaussian kernels, used to smoothen the input.
+    The 2-D gaussian is separable, it runs as one 1-D convolution over the height and one
+    over the width, which gives the same result as the 2-D kernel with reflection padding.
+    """
     def __init__(self, kernel_size, sigma, channels,):
         super().__init__()
         self.sigma = sigma
         self.kernel_size = kernel_size
+        self.channels = channels
         assert kernel_size % 2 == 1, \
             "kernel_size must be an odd number (for padding), {} given".format(self.kernel_size)
-        variance = sigma ** 2.
-        x_cord = torch.arange(kernel_size, dtype=torch.float)
-        x_grid = x_cord.repeat(kernel_size).view(kernel_size, kernel_size)
-        y_grid = x_grid.t()
-        xy_grid = torch.stack([x_grid, y_grid], dim=-1)
-        mean_xy = (kernel_size - 1) / 2.
-        kernel_2d = (1. / (2. * np.pi * variance)) * torch.exp(
-            -torch.sum((xy_grid - mean_xy) ** 2., dim=-1) /
-            (2 * variance)
-        )
-        kernel_2d = kernel_2d / kernel_2d.sum()
-        kernel_3d = kernel_2d.expand(channels, 1, -1, -1)  # expand in channel dimension
-        self.conv = nn.Conv2d(in_channels=channels, out_channels=channels,
-                              padding=0, kernel_size=kernel_size,
-                              groups=channels, bias=False)
-        self.conv.weight.data.copy_(kernel_3d)
-        self.conv.weight.requires_grad = False
-        self.pad = nn.ReflectionPad2d(int((kernel_size - 1) / 2))
 
     def parameters(self, **kwargs):
         """returns no parameters"""
         return []
     # x是alpha
     def forward(self, x):
-        return self.conv(self.pad(x))
+        kernel = _gaussian_kernel_1d(self.kernel_size, self.sigma, self.channels, x.device, x.dtype)
+        pad = (self.kernel_size - 1) // 2
+        x = F.conv2d(F.pad(x, (0, 0, pad, pad), mode='reflect'), kernel[:, :, :, None],
+                     groups=self.channels)
+        return F.conv2d(F.pad(x, (pad, pad, 0, 0), mode='reflect'), kernel[:, :, None, :],
+                        groups=self.channels)
 
 #Estimates the mean and standard derivation.
 class TorchWelfordEstimator(nn.Module):
@@ -174,14 +225,21 @@ class TorchWelfordEstimator(nn.Module):
             # Initialize running mean and std on first datapoint,将标准差和均值全部初始化为0
             self._init(x.shape[1:], x.device)
         # 计算每batch样本的均值和标准差，保存在self.m 和self.s
-        for xi in x:
-            self._neuron_nonzero += (xi != 0.).long()
-            old_m = self.m.clone()
-            # Update the mean: new_m = old_m + (x-m)/(n+1)
-            self.m = self.m + (xi-self.m) / (self._n_samples.float() + 1)
-            # Update the 无偏估计: s
-            self.s = self.s + (xi-self.m) * (xi-old_m)
-            self._n_samples += 1
+        if len(x) == 0:
+            return x
+        # merge the batch statistics with the running ones (Chan et al.), equivalent
+        # to the per-sample welford update
+        n_a, n_b = self.n_samples(), len(x)
+        n = n_a + n_b
+        batch_mean = x.mean(dim=0)
+        batch_s = ((x - batch_mean) ** 2).sum(dim=0)
+        delta = batch_mean - self.m
+        # Update the mean: new_m = old_m + (batch_m - old_m) * n_b / n
+        self.m += delta * (n_b / n)
+        # Update the 无偏估计: s
+        self.s += batch_s + delta ** 2 * (n_a * n_b / n)
+        self._neuron_nonzero += (x != 0.).sum(dim=0)
+        self._n_samples += n_b
         return x
 
     def n_samples(self):
@@ -203,6 +261,43 @@ class TorchWelfordEstimator(nn.Module):
         """
         return (self._neuron_nonzero.float() / self._n_samples.float()) > threshold
 
+    def numpy_state_dict(self):
+        """
+        Returns the state in the format of :meth:`IBA.utils.WelfordEstimator.state_dict`,
+        e.g. to return it from a worker of :func:`IBA.utils.estimate_sharded`.
+        """
+        return {
+            'm': self.m.detach().cpu().numpy().astype(np.float64),
+            's': self.s.detach().cpu().numpy().astype(np.float64),
+            'n_samples': self.n_samples(),
+            'neuron_nonzero': self._neuron_nonzero.cpu().numpy(),
+        }
+
+    def merge(self, other):
+        """
+        Merges the estimates of ``other`` into this estimator, as if all samples were
+        fitted by this estimator. ``other`` is a ``TorchWelfordEstimator`` or a
+        :meth:`numpy_state_dict` fitted on different samples.
+        """
+        state = other.numpy_state_dict() if hasattr(other, 'numpy_state_dict') else other
+        n_b = int(state['n_samples'])
+        if n_b == 0:
+            return self
+        m_b = torch.as_tensor(state['m'])
+        if self.shape is None:
+            self._init(m_b.shape, self.device or m_b.device)
+        m_b = m_b.to(self.m)
+        s_b = torch.as_tensor(state['s']).to(self.s)
+        # parallel variance (Chan et al.)
+        n_a = self.n_samples()
+        n = n_a + n_b
+        delta = m_b - self.m
+        self.m += delta * (n_b / n)
+        self.s += s_b + delta ** 2 * (n_a * n_b / n)
+        self._neuron_nonzero += torch.as_tensor(state['neuron_nonzero']).to(self._neuron_nonzero)
+        self._n_samples += n_b
+        return self
+
 
 class _InterruptExecution(Exception):
     pass
@@ -256,6 +351,16 @@ class IBA(nn.Module):
         batch_size: Number of samples to use per iteration
         input_or_output: Select either ``"output"`` or ``"input"``.
         initial_alpha: Initial value for the parameter.
+        tol: Stop the optimization of an image once the relative change of its loss and of
+            its capacity map between two steps are both below ``tol``. ``None`` always runs
+            all ``optimization_steps``.
+        cache_key: key of the estimator cache (see :func:`model_cache_key`). :meth:`estimate`
+            loads a cached estimate instead of running the model and saves new estimates.
+        cache_dir: directory of the estimator cache. Default: ``$IBA_CACHE_DIR`` or ``~/.cache/iba``.
+        autocast_dtype: run the model passes of the optimization under ``torch.autocast``
+            with this dtype, e.g. ``torch.bfloat16`` on CPUs with oneDNN or ``torch.float16``
+            on GPUs. The capacity and the losses stay in float32. Use
+            :func:`IBA.utils.saliency_parity` to compare the saliency maps with float32.
     """
     def __init__(self,
                  layer=None,
@@ -272,8 +377,15 @@ class IBA(nn.Module):
                  estimator=None,
                  progbar=False,
                  input_or_output="output",
-                 relu=False):
+                 relu=False,
+                 tol=None,
+                 cache_key=None,
+                 cache_dir=None,
+                 autocast_dtype=None):
         super().__init__()
+        self.cache_key = cache_key
+        self.cache_dir = cache_dir
+        self.autocast_dtype = autocast_dtype
         self.relu = relu
         self.beta = beta
         self.min_std = min_std
@@ -281,6 +393,8 @@ class IBA(nn.Module):
         self.lr = lr
         self.batch_size = batch_size
         self.initial_alpha = initial_alpha
+        self.tol = tol
+        self.steps_used = None  # optimization steps of the last analyze call
         self.alpha = None  # Initialized on first forward pass
         self.progbar = progbar
         self.sigmoid = nn.Sigmoid()
@@ -295,7 +409,10 @@ class IBA(nn.Module):
         self._active_neurons_threshold = active_neurons_threshold
         self._restrict_flow = False
         self._interrupt_execution = False
+        self._record_feature = False  # set by get_feature
+        self._recorded_feature = None
         self._hook_handle = None
+        self._alpha_batch = None  # one alpha per image, set during analyze_batch
 
         # Check if modifying forward hooks are supported by the current torch version
         if layer is not None:
@@ -369,9 +486,12 @@ class IBA(nn.Module):
 
         if self._restrict_flow:
             # self._do_restrict_information(x) :计算Z
-            return self._do_restrict_information(x)
+            alpha = self._alpha_batch if self._alpha_batch is not None else self.alpha
+            return self._do_restrict_information(x, alpha)
         if self._estimate:
             self.estimator(x)
+        if self._record_feature:
+            self._recorded_feature = x.detach()
         if self._interrupt_execution:
             raise _InterruptExecution()
         return x
@@ -458,8 +578,14 @@ class IBA(nn.Module):
 
         # Smoothen and expand alpha on batch dimension
         lamb = self.sigmoid(alpha)
-        lamb = lamb.expand(x.shape[0], x.shape[1], -1, -1)
-        lamb = self.smooth(lamb) if self.smooth is not None else lamb
+        if alpha.dim() == x.dim():
+            # one alpha per image, the rows of x hold the noise samples of every image in turn
+            lamb = self.smooth(lamb) if self.smooth is not None else lamb
+            lamb = lamb.repeat_interleave(x.shape[0] // lamb.shape[0], dim=0)
+        else:
+            # all rows share the alpha, smooth it once before expanding it over the batch
+            lamb = self.smooth(lamb[None]) if self.smooth is not None else lamb[None]
+            lamb = lamb.expand(x.shape[0], x.shape[1], -1, -1)
         # We normalize r to simplify the computation of the KL-divergence
         #
         # The equation in the paper is:
@@ -482,6 +608,9 @@ class IBA(nn.Module):
         # 用于计算信息瓶颈的loss
         # 产生的注意力图
         # 问题：为什么通过KL距离可以产生注意力图[56,56,256,15],信息量的值[-5,5]
+        # the capacity is computed in float32, also if the model runs in reduced precision
+        out_dtype = x.dtype
+        x = x.float()
         self._buffer_capacity = self._kl_div(x, lamb, self._mean, self._std) * self._active_neurons
 
         # addiing noise into Tensor R
@@ -498,7 +627,7 @@ class IBA(nn.Module):
         if self.relu:
             z = torch.clamp(z, 0.0)
 
-        return z
+        return z.to(out_dtype)
 
     @contextmanager
     def enable_estimation(self):
@@ -533,6 +662,9 @@ class IBA(nn.Module):
                 progbar (bool): show a progress bar.
                 reset (bool): reset the current estimate of the mean and std
 
+            If a ``cache_key`` is set and ``reset`` is ``True``, a cached estimate of at least
+            ``n_samples`` is loaded instead of running the model, otherwise the new estimate
+            is saved to the cache.
         """
         progbar = progbar if progbar is not None else self.progbar
         if progbar:
@@ -549,7 +681,13 @@ class IBA(nn.Module):
             device = next(iter(model.parameters())).device
         if reset:
             self.reset_estimate()
-        for batch in dataloader:
+        cached = reset and self._load_estimator_cache(device)
+        if cached and self.estimator.n_samples() < n_samples:
+            # a cached estimate of fewer samples is a miss, refit from scratch instead of
+            # fitting the cached images again on top of it
+            self.reset_estimate()
+            cached = False
+        for batch in ([] if cached else dataloader):
             imgs = batch[0]
             if self.estimator.n_samples() > n_samples:
                 break
@@ -559,6 +697,8 @@ class IBA(nn.Module):
                 bar.update(len(imgs))
         if bar:
             bar.close()
+        if self.cache_key is not None and not cached:
+            save_estimator_cache(self.cache_key, self.estimator.numpy_state_dict(), self.cache_dir)
 
         # Cache results
         self._mean = self.estimator.mean()
@@ -569,6 +709,24 @@ class IBA(nn.Module):
         if self.alpha is None:
             self._build()
 
+    def _load_estimator_cache(self, device):
+        """ Loads the cached estimate of ``cache_key`` into a new estimator on ``device``. """
+        if self.cache_key is None:
+            return False
+        state = load_estimator_cache(self.cache_key, self.cache_dir)
+        if state is None:
+            return False
+        estimator = TorchWelfordEstimator()
+        estimator._init(state['m'].shape, device)
+        self.estimator = estimator.merge(state)
+        return True
+
+    def _autocast(self, device):
+        """ ``torch.autocast`` with ``autocast_dtype`` on ``device``, a no-op if it is None. """
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=torch.device(device).type, dtype=self.autocast_dtype)
+
     @contextmanager
     def restrict_flow(self):
         """
@@ -589,7 +747,7 @@ class IBA(nn.Module):
 
     def analyze(self, input_t, model_loss_fn, mode="saliency",
                 beta=None, optimization_steps=None, min_std=None,
-                lr=None, batch_size=None, active_neurons_threshold=0.01):
+                lr=None, batch_size=None, active_neurons_threshold=0.01, tol=None):
         """
         Generates a heatmap for a given sample. Make sure you estimated mean and variance of the
         input distribution.
@@ -604,6 +762,8 @@ class IBA(nn.Module):
             lr: if not None, overrides the bottleneck lr value
             batch_size: if not None, overrides the bottleneck batch_size value
             active_neurons_threshold: used threshold to determine if a neuron is active
+            tol: if not None, overrides the bottleneck tol value. The number of steps
+                used is stored in ``self.steps_used``.
 
         Returns:
             The heatmap of the same shape as the ``input_t``.
@@ -617,9 +777,72 @@ class IBA(nn.Module):
         lr = ifnone(lr, self.lr)
         batch_size = ifnone(batch_size, self.batch_size)
         active_neurons_threshold = ifnone(active_neurons_threshold, self._active_neurons_threshold)
+        tol = ifnone(tol, self.tol)
 
         batch = input_t.expand(batch_size, -1, -1, -1)
+        self._optimize_alpha(lambda: model_loss_fn(batch), beta, optimization_steps, min_std, lr,
+                             active_neurons_threshold, tol)
+        return self._get_saliency(mode=mode, shape=input_t.shape[2:])
+
+    def get_feature(self, model, inputs):
+        """
+        Returns the features at the bottleneck for ``inputs``. The model is only executed
+        up to the bottleneck. Useful for :meth:`analyze_feature`.
+        """
+        self._record_feature = True
+        try:
+            with torch.no_grad(), self.interrupt_execution():
+                model(inputs)
+        finally:
+            self._record_feature = False
+        feature, self._recorded_feature = self._recorded_feature, None
+        return feature
+
+    def analyze_feature(self, feature, head_loss_fn, mode="saliency", shape=None,
+                        beta=None, optimization_steps=None, min_std=None,
+                        lr=None, batch_size=None, active_neurons_threshold=0.01, tol=None):
+        """
+        Like :meth:`analyze`, but starts from the precomputed bottleneck ``feature`` of an image
+        (see :meth:`get_feature`). The layers before the bottleneck are not executed during
+        the optimization, only ``head_loss_fn`` runs the part of the model after it.
+
+        Example: ::
+
+            feature = iba.get_feature(model, img)
+            head = nn.Sequential(*model.features[11:], nn.Flatten(1), model.classifier)
+            saliency_map = iba.analyze_feature(
+                feature, lambda z: F.cross_entropy(head(z), target.expand(len(z))),
+                shape=img.shape[2:])
+
+        Args:
+            feature: bottleneck feature of shape (1, C, H, W)
+            head_loss_fn: closure ``head_loss_fn(z)`` returning the model loss given the
+                ``batch_size`` restricted features ``z``
+            mode: how to post-process the resulting map: 'saliency' (default) or 'capacity'
+            shape: (height, width) of the saliency map, usually the image size
+            beta, optimization_steps, min_std, lr, batch_size, active_neurons_threshold, tol:
+                see :meth:`analyze`
+
+        Returns:
+            The heatmap of the given ``shape``.
+        """
+        assert feature.shape[0] == 1, "We can only fit one sample a time"
+        beta = ifnone(beta, self.beta)
+        optimization_steps = ifnone(optimization_steps, self.optimization_steps)
+        min_std = ifnone(min_std, self.min_std)
+        lr = ifnone(lr, self.lr)
+        batch_size = ifnone(batch_size, self.batch_size)
+        active_neurons_threshold = ifnone(active_neurons_threshold, self._active_neurons_threshold)
+        tol = ifnone(tol, self.tol)
 
+        batch = feature.expand(batch_size, *feature.shape[1:])
+        self._optimize_alpha(lambda: head_loss_fn(self._do_restrict_information(batch, self.alpha)),
+                             beta, optimization_steps, min_std, lr, active_neurons_threshold, tol)
+        return self._get_saliency(mode=mode, shape=shape)
+
+    def _optimize_alpha(self, model_loss_fn, beta, optimization_steps, min_std, lr,
+                        active_neurons_threshold, tol):
+        """ Optimizes alpha for the closure ``model_loss_fn()`` which runs one step. """
         # Reset from previous run or modifications
         self._reset_alpha()
         optimizer = torch.optim.Adam(lr=lr, params=[self.alpha])
@@ -645,14 +868,26 @@ class IBA(nn.Module):
                 warnings.warn("Cannot load tqdm! Sorry, no progress bar")
                 self.progbar = False
 
+        self.steps_used = optimization_steps
+        last = None
         with self.restrict_flow():
-            for _ in opt_range:
+            for step in opt_range:
                 optimizer.zero_grad()
-                # batch: Any = input_t.expand(batch_size, -1, -1, -1)
-                model_loss = model_loss_fn(batch)
+                with self._autocast(self.alpha.device):
+                    model_loss = model_loss_fn().float()
                 # Taking the mean is equivalent of scaling the sum with 1/K
                 information_loss = self.capacity().mean()
                 loss = model_loss + beta * information_loss
+
+                if tol is not None:
+                    current = loss.detach()[None], self.capacity().detach()[None]
+                    if last is not None and (_relative_change(current[0], last[0]) < tol and
+                                             _relative_change(current[1], last[1]) < tol):
+                        # the capacity buffer holds the converged capacity
+                        self.steps_used = step
+                        break
+                    last = current
+
                 loss.backward()
                 optimizer.step()
 
@@ -661,7 +896,124 @@ class IBA(nn.Module):
                 self._model_loss.append(model_loss.item())
                 self._information_loss.append(information_loss.item())
 
-        return self._get_saliency(mode=mode, shape=input_t.shape[2:])
+    def analyze_batch(self, inputs, targets, model_loss_fn, mode="saliency",
+                      beta=None, optimization_steps=None, min_std=None,
+                      lr=None, batch_size=None, active_neurons_threshold=0.01, tol=None):
+        """
+        Generates a heatmap for every image in ``inputs``. All images are optimized together:
+        each has its own alpha and the ``N * batch_size`` noise samples run in one forward
+        pass per step. The results are the same as calling :meth:`analyze` for every image.
+
+        Args:
+            inputs: input images of shape (N, C, H W)
+            targets: targets of shape (N, ), passed to ``model_loss_fn``
+            model_loss_fn: closure ``model_loss_fn(x, targets)`` returning the loss of every
+                sample, e.g. ``F.cross_entropy(model(x), targets, reduction='none')``.
+                ``x`` holds the ``batch_size`` noise samples of every image in turn and
+                ``targets`` is repeated accordingly.
+            mode: how to post-process the resulting maps: 'saliency' (default) or 'capacity'
+            beta: if not None, overrides the bottleneck beta value
+            optimization_steps: if not None, overrides the bottleneck optimization_steps value
+            min_std: if not None, overrides the bottleneck min_std value
+            lr: if not None, overrides the bottleneck lr value
+            batch_size: if not None, overrides the bottleneck batch_size value
+            active_neurons_threshold: used threshold to determine if a neuron is active
+            tol: if not None, overrides the bottleneck tol value. Converged images are
+                removed from the batch, the remaining steps only run the other images.
+                The steps used by every image are stored in ``self.steps_used``.
+
+        Returns:
+            A list with the heatmap of every image.
+        """
+        beta = ifnone(beta, self.beta)
+        optimization_steps = ifnone(optimization_steps, self.optimization_steps)
+        min_std = ifnone(min_std, self.min_std)
+        lr = ifnone(lr, self.lr)
+        batch_size = ifnone(batch_size, self.batch_size)
+        active_neurons_threshold = ifnone(active_neurons_threshold, self._active_neurons_threshold)
+        tol = ifnone(tol, self.tol)
+
+        n_images = inputs.shape[0]
+        # indices of the images which did not converge yet
+        active = torch.arange(n_images, device=inputs.device)
+        batch = inputs.repeat_interleave(batch_size, dim=0)
+        batch_targets = targets.repeat_interleave(batch_size, dim=0)
+
+        alpha = nn.Parameter(
+            torch.full((n_images,) + tuple(self.alpha.shape), self.initial_alpha,
+                       device=self.alpha.device),
+            requires_grad=True)
+        optimizer = torch.optim.Adam(lr=lr, params=[alpha])
+        final_capacities = torch.zeros_like(alpha)
+        self.steps_used = np.full(n_images, optimization_steps)
+
+        if self.estimator.n_samples() < 1000:
+            warnings.warn(f"Selected estimator was only fitted on {self.estimator.n_samples()} "
+                          f"samples. Might not be enough! We recommend 10.000 samples.")
+        std = self.estimator.std()
+        self._active_neurons = self.estimator.active_neurons(active_neurons_threshold).float()
+        self._std = torch.max(std, min_std*torch.ones_like(std))
+
+        self._loss = []
+        self._model_loss = []
+        self._information_loss = []
+
+        opt_range = range(optimization_steps)
+        try:
+            tqdm = get_tqdm()
+            opt_range = tqdm(opt_range, desc="Training Bottleneck", disable=not self.progbar)
+        except ImportError:
+            if self.progbar:
+                warnings.warn("Cannot load tqdm! Sorry, no progress bar")
+                self.progbar = False
+
+        last = None
+        try:
+            with self.restrict_flow():
+                for step in opt_range:
+                    optimizer.zero_grad()
+                    n_active = len(active)
+                    self._alpha_batch = alpha if n_active == n_images else alpha[active]
+                    # mean over the noise samples of every image, summed over the images,
+                    # so the gradient of every alpha only depends on its own image
+                    with self._autocast(inputs.device):
+                        model_loss = model_loss_fn(batch, batch_targets).float()
+                    model_loss = model_loss.view(n_active, -1).mean(1)
+                    capacities = self.capacities(n_active)
+                    information_loss = capacities.view(n_active, -1).mean(1)
+                    image_loss = model_loss + beta * information_loss
+
+                    if tol is not None:
+                        current = image_loss.detach(), capacities.detach()
+                        if last is not None:
+                            converged = ((_relative_change(current[0], last[0]) < tol) &
+                                         (_relative_change(current[1], last[1]) < tol))
+                            if converged.any():
+                                final_capacities[active[converged]] = current[1][converged]
+                                self.steps_used[active[converged].cpu().numpy()] = step
+                                keep = ~converged
+                                active, image_loss = active[keep], image_loss[keep]
+                                capacities = capacities[keep]
+                                current = current[0][keep], current[1][keep]
+                                if len(active) == 0:
+                                    break
+                                batch = inputs[active].repeat_interleave(batch_size, dim=0)
+                                batch_targets = targets[active].repeat_interleave(batch_size, dim=0)
+                        last = current
+
+                    loss = image_loss.sum()
+                    loss.backward()
+                    optimizer.step()
+
+                    self._loss.append(loss.item())
+                    self._model_loss.append(model_loss.detach().cpu().numpy())
+                    self._information_loss.append(information_loss.detach().cpu().numpy())
+            # the capacities of the last forward pass, before the last optimizer step
+            final_capacities[active] = capacities.detach()
+        finally:
+            self._alpha_batch = None
+
+        return list(self._postprocess_capacities(final_capacities, mode, inputs.shape[2:]))
 
     def capacity(self):
         """
@@ -671,9 +1023,22 @@ class IBA(nn.Module):
         """
         return self._buffer_capacity.mean(dim=0)
 
+    def capacities(self, n_images):
+        """
+        Returns the capacity from the last input of :meth:`analyze_batch`, averaged over
+        the noise samples of every image. Shape is ``(n_images, self.channels, self.height,
+        self.width)``
+        """
+        return self._buffer_capacity.view(
+            (n_images, -1) + self._buffer_capacity.shape[1:]).mean(dim=1)
+
     def _get_saliency(self, mode='saliency', shape=None):
 
         capacity_np = self.capacity().detach().cpu().numpy()
+        return self._postprocess_capacity(capacity_np, mode, shape)
+
+    @staticmethod
+    def _postprocess_capacity(capacity_np, mode='saliency', shape=None):
         if mode == "saliency":
             # In bits, summed over channels, scaled to input
             return to_saliency_map(capacity_np, shape)
@@ -682,3 +1047,13 @@ class IBA(nn.Module):
             return capacity_np / float(np.log(2))
         else:
             raise ValueError
+
+    @staticmethod
+    def _postprocess_capacities(capacities, mode='saliency', shape=None):
+        """ Batched :meth:`_postprocess_capacity`, runs on the device of ``capacities``. """
+        if mode == "saliency":
+            return to_saliency_maps(capacities, shape)
+        elif mode == "capacity":
+            return (capacities.detach() / float(np.log(2))).cpu().numpy()
+        else:
+            raise ValueError
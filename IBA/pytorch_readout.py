@@ -1,12 +1,13 @@
 import warnings
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from decorator import contextmanager
 from torch.nn import ModuleList
 
 from IBA.pytorch import IBA, TorchWelfordEstimator
+from IBA.utils import get_tqdm
 
 
 class IBAReadout(IBA):
@@ -27,6 +28,15 @@ class IBAReadout(IBA):
         iba = IBAReadout(model.features[10], readout_layers, model)
 
         iba.estimate(model, trainloader, device=dev, n_samples=75, progbar=True)
+
+        # Train the readout network, then save it
+        iba.train_readout(model, trainloader, epochs=10, device=dev)
+        iba.save_readout('readout.pt')
+
+        # Later: saliency maps of a batch in one forward pass, without optimization
+        iba = IBAReadout(model.features[10], readout_layers, model)
+        iba.load_readout('readout.pt', device=dev)
+        saliency_maps = iba.analyze_batch(imgs, model)
     """
 
     def __init__(self, attach_layer, readout_layers, model, estimator_type=None, **kwargs):
@@ -116,12 +126,104 @@ class IBAReadout(IBA):
         super().detach()
         if self._input_hook:
             # Remove input hook
-            self._input_hook.detach()
+            self._input_hook.remove()
             self._input_hook = None
             # Remove readout hooks
-            [h.detach() for h in self._readout_hooks]
+            [h.remove() for h in self._readout_hooks]
             self._readout_hooks = [None for _ in self._readout_hooks]
 
+    def readout_parameters(self):
+        """ Returns the parameters of the readout network. """
+        return [p for conv in (self.conv1, self.conv2, self.conv3) for p in conv.parameters()]
+
+    def train_readout(self, model, dataloader, epochs=1, lr=1e-5, beta=None, device=None,
+                      model_loss_fn=None, progbar=None):
+        """
+        Trains the readout network on the images of ``dataloader``. The model is not trained.
+        Estimate the feature distribution with :meth:`estimate` first.
+
+        Args:
+            model: the model containing the bottleneck layer
+            dataloader: yielding ``batch``'s with the images ``batch[0]`` and targets ``batch[1]``.
+            epochs: number of passes over the ``dataloader``.
+            lr: learning rate of the Adam optimizer.
+            beta: if not None, overrides the bottleneck beta value
+            device: images will be transfered to the device. If ``None``, it uses the device
+                of the first model parameter.
+            model_loss_fn: ``model_loss_fn(outputs, targets)``, defaults to the cross-entropy.
+            progbar (bool): show a progress bar.
+
+        Returns:
+            The losses of all steps.
+        """
+        if not hasattr(self, 'conv1'):
+            self._build()
+        beta = beta if beta is not None else self.beta
+        model_loss_fn = model_loss_fn or F.cross_entropy
+        progbar = progbar if progbar is not None else self.progbar
+        if device is None:
+            device = next(iter(model.parameters())).device
+
+        optimizer = torch.optim.Adam(lr=lr, params=self.readout_parameters())
+        # only the readout network gets gradients
+        model_requires_grad = [p.requires_grad for p in model.parameters()]
+        for p in model.parameters():
+            p.requires_grad_(False)
+        model_was_training = model.training
+        model.eval()
+
+        losses = []
+        try:
+            for epoch in range(epochs):
+                batches = dataloader
+                if progbar:
+                    try:
+                        batches = get_tqdm()(dataloader, desc="[Train Readout {}]".format(epoch))
+                    except ImportError:
+                        warnings.warn("Cannot load tqdm! Sorry, no progress bar")
+                for batch in batches:
+                    imgs, targets = batch[0].to(device), batch[1].to(device)
+                    optimizer.zero_grad()
+                    with self.restrict_flow():
+                        outputs = model(imgs)
+                    information_loss = self.capacity().mean()
+                    loss = model_loss_fn(outputs, targets) + beta * information_loss
+                    loss.backward()
+                    optimizer.step()
+                    losses.append(loss.item())
+        finally:
+            for p, requires_grad in zip(model.parameters(), model_requires_grad):
+                p.requires_grad_(requires_grad)
+            model.train(model_was_training)
+        return losses
+
+    def save_readout(self, path):
+        """ Saves the estimators and the readout network. Load it with :meth:`load_readout`. """
+        torch.save(self.state_dict(), path)
+
+    def load_readout(self, path, device=None):
+        """
+        Loads the estimators and the readout network saved with :meth:`save_readout`.
+        No :meth:`estimate` or :meth:`train_readout` is needed afterwards.
+        """
+        device = device or 'cpu'
+        state = torch.load(path, map_location='cpu')
+
+        def load_estimator(estimator, prefix):
+            estimator._init(state[prefix + 'm'].shape, device)
+            estimator.load_state_dict({k[len(prefix):]: v for k, v in state.items()
+                                       if k.startswith(prefix)})
+
+        load_estimator(self.estimator, 'estimator.')
+        for i, estimator in enumerate(self._readout_estimators):
+            load_estimator(estimator, '_readout_estimators.{}.'.format(i))
+        self._build()
+        self.load_state_dict(state)
+
+        self._mean = self.estimator.mean()
+        self._std = self.estimator.std()
+        self._active_neurons = self.estimator.active_neurons(self._active_neurons_threshold).float()
+
     def analyze(self, input_t, model, mode='saliency', **kwargs):
         """
         Use the trained Readout IBA to find relevant regions in the input.
@@ -142,12 +244,28 @@ class IBAReadout(IBA):
         if len(kwargs) > 0:
             warnings.warn(f"Additional arguments ({list(kwargs.keys())}) "
                           " are ignored in the Readout IBA.")
-        # Pass the input through the model
+        return self.analyze_batch(input_t, model, mode)[0]
+
+    def analyze_batch(self, inputs, model, mode='saliency'):
+        """
+        Returns the heatmaps of all images in ``inputs`` from one batched forward pass
+        (and the nested pass of the readout network). There is no optimization, the
+        readout network predicts the alphas.
+
+        Args:
+            inputs: input images of shape (N, C, H W)
+            model: the model containing the trained bottleneck
+            mode: how to post-process the resulting maps: 'saliency' (default) or 'capacity'
+
+        Returns:
+            A list with the heatmap of every image.
+        """
+        # Pass the inputs through the model
         with self.restrict_flow(), torch.no_grad():
-            model(input_t)
+            model(inputs)
 
-        # Read heatmap
-        return self._get_saliency(mode=mode, shape=input_t.shape[2:])
+        # one capacity per image, the readout bottleneck does not repeat the inputs
+        return list(self._postprocess_capacities(self._buffer_capacity, mode, inputs.shape[2:]))
 
     def reset_estimate(self):
         """
@@ -163,7 +281,6 @@ class IBAReadout(IBA):
                 # Obtain alpha using the readout and readout network
                 alpha = self._generate_alpha()
                 # Suppress information identically to the Per-Sample IBA
-                print("X.shape:", x.size())
                 return self._do_restrict_information(x, alpha)
         if self._estimate:
             self.estimator(x)
@@ -0,0 +1,338 @@
+import warnings
+
+try:
+    import tensorflow.compat.v1 as tf
+except ModuleNotFoundError:
+    import tensorflow as tf
+
+import numpy as np
+import keras
+import keras.backend as K
+from keras.layers import Input, Lambda, Conv2D, Concatenate
+
+from IBA.utils import WelfordEstimator, get_tqdm
+from IBA.tensorflow_v1 import _kl_div, _pad_rows, to_saliency_maps
+
+
+class IBAReadout:
+    """
+    The Readout Bottleneck for keras models containing an :class:`IBA.tensorflow_v1.IBALayer`,
+    see :class:`IBA.pytorch_readout.IBAReadout`. A readout network of three 1x1 conv. layers
+    predicts alpha from the feature maps of the ``readout_layers``, so no per-sample optimization
+    is needed to explain an image.
+
+    The feature maps of the nested pass are the outputs of the ``readout_layers`` when the
+    bottleneck does not restrict the flow. Therefore, the model, the readout network and the
+    capacity form a single keras model (:meth:`get_saliency_model`) and a batch is explained
+    with one ``predict`` call.
+
+    Example: ::
+
+        model = VGG16Net_IBA.build(width=224, height=224, depth=3, classes=2)
+        model.load_weights('weights.h5')
+        K.set_learning_phase(0)
+
+        readout = IBAReadout(model, 'iba', ['block4_conv3', 'block5_conv1', 'block5_conv3'])
+        # estimate the feature mean and std, builds the readout network
+        readout.fit_generator(datagen.flow(train_x, train_y, batch_size=16), n_samples=5000)
+        readout.train_readout(datagen.flow(train_x, train_y, batch_size=16), steps_per_epoch=100,
+                              epochs=10)
+        readout.save('readout.npz')
+
+        # later
+        readout = IBAReadout(model, 'iba', ['block4_conv3', 'block5_conv1', 'block5_conv3'])
+        readout.load('readout.npz')
+        capacities = readout.analyze_batch(test_x)
+        saliency_map = to_saliency_map(capacities[0], shape=(224, 224))
+
+    Args:
+        model: keras model containing the bottleneck.
+        iba (IBALayer or str): the bottleneck layer or its name. Its ``analyze_batch`` is the
+            number of images per training step.
+        readout_layers: layers or layer names whose outputs are the inputs of the readout
+            network, usually layers after the bottleneck. Outputs must be feature maps
+            (``channels_last``) or vectors.
+        output: model output used for the training loss. Default: the first model output.
+        from_logits (bool): ``output`` are logits. Default: ``output`` are probabilities.
+        beta: trade-off between model loss and information loss during the training.
+        min_std: minimum feature standard derivation.
+        session (tf.Session): session of the model. If ``None``, the keras session is used.
+    """
+    def __init__(self, model, iba, readout_layers, output=None, from_logits=False,
+                 beta=10., min_std=0.01, session=None):
+        def to_layer(layer):
+            return model.get_layer(layer) if isinstance(layer, str) else layer
+
+        self._model = model
+        self._iba = to_layer(iba)
+        self._readout_layers = [to_layer(layer) for layer in readout_layers]
+        self._output = output if output is not None else model.outputs[0]
+        self._from_logits = from_logits
+        self._beta = beta
+        self._min_std = min_std
+        self._session = session
+        self._alpha_bound = 5
+
+        self._feature = self._iba.input
+        self._readouts = [layer.output for layer in self._readout_layers]
+        self._feature_estimator = WelfordEstimator()
+        self._readout_estimators = [WelfordEstimator() for _ in self._readouts]
+
+        self._head = None
+        self._saliency_model = None
+        self._saliency_map_models = {}
+        self._train_ops = None
+
+    def _get_session(self):
+        return self._session or K.get_session()
+
+    def _feed_dict(self, x):
+        xs = x if isinstance(x, list) else [x]
+        return dict(zip(self._model.inputs, xs))
+
+    def _head_feed_dict(self, readouts, feature):
+        return dict(zip(self._head.inputs, readouts + [feature]))
+
+    def fit_generator(self, generator, n_samples=5000, progbar=True):
+        """
+        Estimates the mean and std of the bottleneck feature and of the readout feature
+        maps, then builds the readout network.
+        .. warning ::
+            Ensure that your model is in eval mode. If you use keras, call
+            ``K.set_learning_phase(0)``.
+        Args:
+            generator: yields ``(x, y)`` batches like the keras generators, ``y`` is ignored.
+            n_samples (int): Stop after ``n_samples``.
+            progbar (bool): Flag to display progressbar.
+        """
+        session = self._get_session()
+        try:
+            tqdm = get_tqdm()
+            gen = tqdm(generator, disable=not progbar, desc="[Fit Estimator]")
+        except ImportError:
+            if progbar:
+                warnings.warn("Cannot load tqdm! Sorry, no progress bar")
+            gen = generator
+
+        for x, _ in gen:
+            values = session.run([self._feature] + self._readouts, feed_dict=self._feed_dict(x))
+            self._feature_estimator.fit(values[0])
+            for estimator, value in zip(self._readout_estimators, values[1:]):
+                estimator.fit(value)
+            if self._feature_estimator.n_samples() >= n_samples:
+                break
+        self._build_head()
+
+    def _build_head(self):
+        """ Builds the readout network and the saliency model from the estimates. """
+        def normalize(estimator):
+            mean = estimator.mean().astype(np.float32)
+            std = np.maximum(estimator.std(), self._min_std).astype(np.float32)
+            return lambda r: (r - mean) / std
+
+        feature_shape = self._feature_estimator.mean().shape
+        height, width, channels = feature_shape
+
+        readout_inputs = [Input(shape=estimator.mean().shape) for estimator in self._readout_estimators]
+        feature_input = Input(shape=feature_shape)
+
+        readouts = []
+        for r, estimator in zip(readout_inputs, self._readout_estimators):
+            r = Lambda(normalize(estimator))(r)
+            if len(estimator.mean().shape) == 1:
+                # expand the readouts of dense layers to feature maps
+                r = Lambda(lambda r: tf.tile(r[:, None, None], [1, height, width, 1]))(r)
+            else:
+                r = Lambda(lambda r: tf.image.resize_bilinear(r, (height, width), align_corners=True))(r)
+            readouts.append(r)
+        readout = Concatenate()(readouts) if len(readouts) > 1 else readouts[0]
+
+        features_in = sum(int(estimator.mean().shape[-1]) for estimator in self._readout_estimators)
+        alpha = Conv2D(features_in // 2, 1, activation='relu')(readout)
+        alpha = Conv2D(channels * 2, 1, activation='relu')(alpha)
+        # start close to the constant initial alpha of the per-sample bottleneck
+        alpha = Conv2D(channels, 1,
+                       kernel_initializer=keras.initializers.VarianceScaling(scale=1e-6),
+                       bias_initializer=keras.initializers.Constant(5.))(alpha)
+        # keep alphas in a meaningful range during training
+        alpha = Lambda(lambda a: K.clip(a, -self._alpha_bound, self._alpha_bound))(alpha)
+
+        mean_r = self._feature_estimator.mean().astype(np.float32)
+        std_r = np.maximum(self._feature_estimator.std(), self._min_std).astype(np.float32)
+        active = self._feature_estimator.active_neurons().astype(np.float32)
+        capacity = Lambda(lambda t: _kl_div(t[0], tf.sigmoid(t[1]), mean_r, std_r) * active)(
+            [feature_input, alpha])
+
+        self._head = keras.models.Model(readout_inputs + [feature_input], [alpha, capacity])
+        # the readouts of the unrestricted model are the nested pass
+        self._saliency_model = keras.models.Model(
+            self._model.inputs, self._head(self._readouts + [self._feature])[1])
+        self._saliency_map_models = {}
+        self._train_ops = None
+        self._get_session().run(tf.variables_initializer(self._head.weights))
+
+    def get_saliency_model(self):
+        """ Returns the keras model which maps the model inputs to the capacities. """
+        return self._saliency_model
+
+    def analyze_batch(self, x, batch_size=32, shape=None):
+        """
+        Returns the transmitted information per feature for every image in ``x``, predicted
+        by the readout network without optimization. See :func:`IBA.tensorflow_v1.to_saliency_map`
+        to convert the capacities to saliency maps.
+        Args:
+            x: input images.
+            batch_size: images per predict batch.
+            shape (tuple): if given, returns the saliency maps of this (height, width)
+                instead. They are computed in the graph, see
+                :func:`IBA.tensorflow_v1.to_saliency_maps`.
+        Returns:
+            capacities of shape ``(n_images, ) + feature_shape`` or saliency maps of
+            shape ``(n_images, ) + shape``.
+        """
+        assert self._saliency_model is not None, "Call fit_generator or load first."
+        if shape is None:
+            return self._saliency_model.predict(x, batch_size=batch_size)
+        shape = tuple(shape)
+        if shape not in self._saliency_map_models:
+            saliency_maps = Lambda(lambda c: to_saliency_maps(c, shape, 'channels_last'))(
+                self._saliency_model.output)
+            self._saliency_map_models[shape] = keras.models.Model(self._model.inputs, saliency_maps)
+        return self._saliency_map_models[shape].predict(x, batch_size=batch_size)
+
+    def _build_train_ops(self, learning_rate):
+        iba = self._iba
+        n_images = iba._analyze_batch
+
+        self._targets = tf.placeholder(tf.float32, [None] + self._output.shape.as_list()[1:])
+        # padded images have a weight of zero
+        self._sample_weights = tf.placeholder(tf.float32, [None])
+        model_losses = K.categorical_crossentropy(self._targets, self._output,
+                                                  from_logits=self._from_logits)
+        weight_sum = tf.reduce_sum(self._sample_weights)
+        loss = (tf.reduce_sum(self._sample_weights * model_losses) / weight_sum +
+                self._beta * tf.reduce_sum(self._sample_weights * iba._capacity_means) / weight_sum)
+
+        # chain rule through the alpha variable of the bottleneck into the readout network
+        alpha_grad = tf.gradients(loss, iba._alpha)[0]
+        self._alpha_grad_in = tf.placeholder(tf.float32, self._head.outputs[0].shape)
+        weights = self._head.trainable_weights
+        grads = tf.gradients(self._head.outputs[0], weights, grad_ys=self._alpha_grad_in)
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+        apply_grads = optimizer.apply_gradients(zip(grads, weights))
+
+        self._alpha_in = tf.placeholder(tf.float32, [n_images] + iba._alpha.shape.as_list()[1:])
+        restrict = [
+            tf.assign(iba._alpha, self._alpha_in),
+            tf.assign(iba._mean_r, self._feature_estimator.mean()[None].astype(np.float32)),
+            tf.assign(iba._std_r, self._feature_estimator.std()[None].astype(np.float32)),
+            tf.assign(iba._active_neurons,
+                      self._feature_estimator.active_neurons()[None].astype(np.float32)),
+            tf.assign(iba._pass_mask, tf.zeros_like(iba._pass_mask)),
+            tf.assign(iba._min_std_r, self._min_std),
+            tf.assign(iba._restrict_flow, True),
+            tf.assign(iba._use_layer_input, True),
+        ]
+        unrestrict = [
+            tf.assign(iba._restrict_flow, False),
+            tf.assign(iba._use_layer_input, True),
+        ]
+        self._train_ops = {
+            'loss': loss,
+            'alpha_grad': alpha_grad,
+            'apply_grads': apply_grads,
+            'restrict': restrict,
+            'unrestrict': unrestrict,
+        }
+        self._get_session().run(tf.variables_initializer(optimizer.variables()))
+
+    def _train_step(self, x, y):
+        session = self._get_session()
+        ops = self._train_ops
+        n_images = self._iba._analyze_batch
+        n_real = len(x[0] if isinstance(x, list) else x)
+
+        # nested pass without restriction
+        session.run(ops['unrestrict'])
+        values = session.run([self._feature] + self._readouts, feed_dict=self._feed_dict(x))
+        head_feed_dict = self._head_feed_dict(values[1:], values[0])
+        alpha = session.run(self._head.outputs[0], feed_dict=head_feed_dict)
+
+        # restricted pass with the predicted alphas
+        session.run(ops['restrict'], feed_dict={self._alpha_in: _pad_rows(alpha, n_images)})
+        if isinstance(x, list):
+            x = [_pad_rows(xi, n_images) for xi in x]
+        else:
+            x = _pad_rows(x, n_images)
+        feed_dict = self._feed_dict(x)
+        feed_dict[self._targets] = _pad_rows(y, n_images)
+        feed_dict[self._sample_weights] = (np.arange(n_images) < n_real).astype(np.float32)
+        loss, alpha_grad = session.run([ops['loss'], ops['alpha_grad']], feed_dict=feed_dict)
+
+        head_feed_dict[self._alpha_grad_in] = alpha_grad[:n_real]
+        session.run(ops['apply_grads'], feed_dict=head_feed_dict)
+        return loss
+
+    def train_readout(self, generator, steps_per_epoch, epochs=1, learning_rate=1e-5, progbar=True):
+        """
+        Trains the readout network, the model is not changed. Every step optimizes
+        ``model_loss + beta * capacity_mean`` for up to ``analyze_batch`` images of the bottleneck.
+        Call :meth:`fit_generator` first.
+        Args:
+            generator: yields ``(x, y)`` batches with one-hot or integer targets ``y``.
+            steps_per_epoch (int): batches per epoch.
+            epochs (int): number of epochs.
+            learning_rate (float): Learning rate of the Adam optimizer.
+            progbar (bool): Flag to display progressbar.
+        Returns:
+            The losses of all steps.
+        """
+        assert self._head is not None, "Call fit_generator or load first."
+        if self._train_ops is None:
+            self._build_train_ops(learning_rate)
+        n_images = self._iba._analyze_batch
+        n_classes = self._targets.shape.as_list()[-1]
+
+        losses = []
+        try:
+            for epoch in range(epochs):
+                steps = range(steps_per_epoch)
+                try:
+                    steps = get_tqdm()(steps, disable=not progbar, desc="[Train Readout {}]".format(epoch))
+                except ImportError:
+                    if progbar:
+                        warnings.warn("Cannot load tqdm! Sorry, no progress bar")
+                for _ in steps:
+                    x, y = next(generator)
+                    y = np.asarray(y)
+                    if y.ndim == 1:
+                        y = np.eye(n_classes, dtype=np.float32)[y]
+                    for start in range(0, len(y), n_images):
+                        x_chunk = ([xi[start:start + n_images] for xi in x] if isinstance(x, list)
+                                   else x[start:start + n_images])
+                        losses.append(self._train_step(x_chunk, y[start:start + n_images]))
+        finally:
+            self._get_session().run(self._train_ops['unrestrict'])
+        return losses
+
+    def save(self, path):
+        """ Saves the estimates and the readout network weights as ``.npz``. """
+        state = {'head_{}'.format(i): w for i, w in enumerate(self._head.get_weights())}
+        for name, estimator in self._named_estimators():
+            for key, value in estimator.state_dict().items():
+                state[name + '/' + key] = value
+        np.savez(path, **state)
+
+    def load(self, path):
+        """ Loads the estimates and the readout network saved with :meth:`save`. """
+        with np.load(path) as f:
+            state = {k: f[k] for k in f.files}
+        for name, estimator in self._named_estimators():
+            estimator.load_state_dict({key[len(name) + 1:]: value for key, value in state.items()
+                                       if key.startswith(name + '/')})
+        self._build_head()
+        self._head.set_weights([state['head_{}'.format(i)] for i in range(len(self._head.weights))])
+
+    def _named_estimators(self):
+        return [('feature', self._feature_estimator)] + [
+            ('readout_{}'.format(i), estimator) for i, estimator in enumerate(self._readout_estimators)]
@@ -12,7 +12,8 @@ import tensorflow_probability as tfp
 
 import numpy as np
 import keras
-from IBA.utils import WelfordEstimator, _to_saliency_map, get_tqdm
+from IBA.utils import WelfordEstimator, _to_saliency_map, _to_saliency_maps, _bilinear_indices, \
+    get_tqdm, _relative_change, estimator_cache_key, load_estimator_cache, save_estimator_cache
 import keras.backend as K
 from IBA._keras_graph import contains_activation
 
@@ -100,11 +101,12 @@ class TFWelfordEstimator(WelfordEstimator):
         """
         state = super().state_dict()
         state['feature_name'] = self._feature_name
+        return state
 
     def load_state_dict(self, state: dict):
         """Loads estimator internal state."""
         super().load_state_dict(state)
-        self._feature_mean = state['feature_mean']
+        self._feature_name = state.get('feature_name', self._feature_name)
 
 
 def to_saliency_map(capacity, shape=None, data_format=None):
@@ -121,6 +123,41 @@ def to_saliency_map(capacity, shape=None, data_format=None):
     return _to_saliency_map(capacity, shape, data_format)
 
 
+def to_saliency_maps(capacities, shape=None, data_format=None):
+    """
+    Converts a batch of capacities (in nats) to saliency maps (in bits) of the given shape.
+    For a tensor, returns the tensor of the saliency maps: the channel sum and the upsampling
+    run in the graph and only the final maps have to be fetched. For a NumPy array, the
+    maps are computed with NumPy. Both give the same output as :func:`to_saliency_map` for
+    every image.
+
+    Args:
+        capacities (tf.Tensor or np.ndarray): Capacities in nats, shape ``(n, ...)``. The
+            spatial shape of a tensor must be known.
+        shape (tuple): (height, width) of the images.
+        data_format (str): ``"channels_first"`` or ``"channels_last"``. If None,
+            the ``K.image_data_format()`` of keras is used.
+    """
+    data_format = data_format or K.image_data_format()
+    if not isinstance(capacities, tf.Tensor):
+        return _to_saliency_maps(capacities, shape, data_format)
+    channel_axis = 1 if data_format == 'channels_first' else -1
+    saliency_maps = tf.reduce_sum(
+        tf.where(tf.is_nan(capacities), tf.zeros_like(capacities), capacities),
+        axis=channel_axis) / float(np.log(2))
+    if shape is not None:
+        ho, wo = saliency_maps.shape.as_list()[1:]
+        h, w = shape
+        saliency_maps = saliency_maps * ((ho*wo) / (h*w))
+        # the indices of the NumPy fallback, bilinear interpolation of the rows then the columns
+        for axis, (n_in, n_out) in ((1, (ho, h)), (2, (wo, w))):
+            lo, hi, weight = _bilinear_indices(n_in, n_out)
+            weight = weight.reshape((1, -1, 1) if axis == 1 else (1, 1, -1))
+            saliency_maps = (tf.gather(saliency_maps, lo, axis=axis) * (1 - weight) +
+                             tf.gather(saliency_maps, hi, axis=axis) * weight)
+    return saliency_maps
+
+
 def _kl_div(r, lambda_, mean_r, std_r):
     r_norm = (r - mean_r) / std_r
 
@@ -135,38 +172,116 @@ def _kl_div(r, lambda_, mean_r, std_r):
     return capacity
 
 
+def _repeat_rows(x, n):
+    """Repeats every row of ``x`` ``n`` times, e.g. ``[a, b] -> [a, a, b, b]`` for ``n = 2``."""
+    x_shape = tf.shape(x)
+    multiples = tf.concat([tf.stack([1, n]), tf.ones_like(x_shape[1:])], axis=0)
+    x_repeated = tf.reshape(tf.tile(tf.expand_dims(x, 1), multiples),
+                            tf.concat([[-1], x_shape[1:]], axis=0))
+    x_repeated.set_shape([None] + x.get_shape().as_list()[1:])
+    return x_repeated
+
+
+def _trunk_tensors(output, layer_input, feed_tensors):
+    """
+    Returns the float tensors which the ops after ``output`` use besides ``output`` and which
+    are computed from ``feed_tensors`` without passing ``layer_input``, e.g. the skip
+    connections around a layer or the targets of a loss. Feeding them runs the ops after
+    ``output`` without the model before the layer.
+    """
+    def forward(tensors):
+        ops, stack = set(), [op for t in tensors for op in t.consumers()]
+        while stack:
+            op = stack.pop()
+            if op not in ops:
+                ops.add(op)
+                stack.extend(consumer for t in op.outputs for consumer in t.consumers())
+        return ops
+
+    after_output = forward([output])
+    after_input = forward([layer_input])
+    feed_ops = set(t.op for t in feed_tensors)
+    # whether an op depends on the feed, iterative as the models can be deep
+    fed = {}
+
+    def depends_on_feed(op):
+        stack, visiting = [op], set()
+        while stack:
+            top = stack[-1]
+            if top in fed:
+                stack.pop()
+                continue
+            if top in feed_ops:
+                fed[top] = True
+            else:
+                pending = [t.op for t in top.inputs if t.op not in fed and t.op not in visiting]
+                if pending:
+                    # loops (tf.while_loop) are cut at the ops already visited
+                    visiting.add(top)
+                    stack.extend(pending)
+                    continue
+                fed[top] = any(fed.get(t.op, False) for t in top.inputs)
+            visiting.discard(top)
+            stack.pop()
+        return fed[op]
+
+    tensors = []
+    for op in after_output:
+        for t in op.inputs:
+            if (t.op not in after_output and t.op not in after_input and t is not output and
+                    t.dtype.is_floating and t.graph.is_feedable(t) and t not in tensors and
+                    depends_on_feed(t.op)):
+                tensors.append(t)
+    return tensors
+
+
+def _pad_rows(x, n):
+    """Pads ``x`` to ``n`` rows by repeating its last row."""
+    if len(x) == n:
+        return x
+    return np.concatenate([x, np.repeat(x[-1:], n - len(x), axis=0)])
+
+
 def _gaussian_kernel(size, std):
-    """Makes 2D gaussian Kernel for convolution."""
+    """Makes 1D gaussian Kernel for separable convolutions."""
     d = tfp.distributions.Normal(0., std)
     vals = d.prob(tf.cast(tf.range(start=-size, limit=size + 1), tf.float32))
-    gauss_kernel = tf.einsum('i,j->ij', vals, vals)
-    return gauss_kernel / tf.reduce_sum(gauss_kernel)
+    return vals / tf.reduce_sum(vals)
 
 
 def _gaussian_blur(x, std=1.):
-
+    """
+    Smoothens the spatial dimensions of ``x`` (``[b, h, w, c]`` or ``[b, l, c]``) with a
+    gaussian kernel. The 2D gaussian is separable, it runs as one 1D convolution per dimension.
+    """
     # Cover 2.5 stds in both directions
     kernel_size = tf.cast((tf.round(4 * std)) * 2 + 1, tf.int32)
 
     kernel = _gaussian_kernel(kernel_size // 2, std)
-    kernel = kernel[:, :, None, None]
+    kernel = kernel[:, None, None, None]
     kernel = tf.tile(kernel, (1, 1, x.shape[-1], 1))
 
     kh = kernel_size//2
 
     if len(x.shape) == 4:
-        x = tf.pad(x, [[0, 0], [kh, kh], [kh, kh], [0, 0]], "REFLECT")
+        x_blur = tf.pad(x, [[0, 0], [kh, kh], [0, 0], [0, 0]], "REFLECT")
         x_blur = tf.nn.depthwise_conv2d(
-            x,
+            x_blur,
             kernel,
             strides=[1, 1, 1, 1],
             padding='VALID',
-            name='blurring',
+            name='blurring_rows',
+        )
+        x_blur = tf.pad(x_blur, [[0, 0], [0, 0], [kh, kh], [0, 0]], "REFLECT")
+        x_blur = tf.nn.depthwise_conv2d(
+            x_blur,
+            tf.transpose(kernel, [1, 0, 2, 3]),
+            strides=[1, 1, 1, 1],
+            padding='VALID',
+            name='blurring_columns',
         )
     elif len(x.shape) == 3:
-        x = tf.pad(x, [[0, 0], [kh, kh], [0, 0]], "REFLECT")
-        kernel = kernel[:, kh+1:kh+2]
-        x_extra_dim = x[:, :, None]
+        x_extra_dim = tf.pad(x, [[0, 0], [kh, kh], [0, 0]], "REFLECT")[:, :, None]
         x_blur = tf.nn.depthwise_conv2d(
             x_extra_dim,
             kernel,
@@ -180,6 +295,18 @@ def _gaussian_blur(x, std=1.):
     return tf.cond(tf.math.equal(std, 0.), lambda: x, lambda: x_blur)
 
 
+def model_cache_key(model, layer_name, manifest=None, folds=None, layer_input=False):
+    """
+    Returns the estimator cache key of ``layer_name`` in the keras ``model``, see
+    :func:`IBA.utils.estimator_cache_key`. Load the weights before computing the key.
+    With ``layer_input`` the key is the one of the layer input, e.g. for an
+    :class:`IBALayer`, which estimates its input.
+    """
+    if layer_input:
+        layer_name = layer_name + ':input'
+    return estimator_cache_key(model.get_weights(), layer_name, manifest, folds)
+
+
 def model_wo_softmax(model: keras.Model):
     """Creates a new model w/o the final softmax activation.
        ``model`` must be a keras model.
@@ -253,6 +380,16 @@ class IBALayer(keras.layers.Layer):
         smooth_std (float): Default smoothing of the lambda parameter. Set to ``0`` to disable.
         normalize_beta (bool): Default flag to devide beta by the nubmer of feature
             neurons (default: ``True``).
+        tol (float): Default tolerance to stop the optimization early, see :meth:`analyze`.
+            ``None`` always runs all ``steps``.
+        analyze_batch (int): Number of images optimized together by :meth:`analyze_batch`.
+            Every image has its own alpha, the results are the same as analyzing them one by one.
+            With ``analyze_batch > 1`` and the layer input restricted, the input batch has to be
+            the ``analyze_batch`` analyzed images, other batch sizes raise an error.
+        cache_key (str): key of the estimator cache (see :func:`model_cache_key`). A cached
+            estimate is loaded when the layer is built and :meth:`fit_generator` saves its estimate.
+            Can also be set later with :meth:`set_cache_key`.
+        cache_dir (str): directory of the estimator cache. Default: ``$IBA_CACHE_DIR`` or ``~/.cache/iba``.
         **kwargs: keras layer kwargs, see ``keras.layers.Layer``
     """
     def __init__(self, estimator=None,
@@ -267,9 +404,19 @@ class IBALayer(keras.layers.Layer):
                  min_std=0.01,
                  smooth_std=1.,
                  normalize_beta=True,
+                 tol=None,
+                 analyze_batch=1,
+                 cache_key=None,
+                 cache_dir=None,
                  **kwargs):
         self._estimator = estimator
+        self._cache_key = cache_key
+        self._cache_dir = cache_dir
+        self._estimate_cached = False
         self._model_loss_set = False
+        self._analyze_batch = analyze_batch
+        self._n_heads = None
+        self._heads_trunk = {}
 
         self._feature_mean = feature_mean
         self._feature_std = feature_std
@@ -285,6 +432,7 @@ class IBALayer(keras.layers.Layer):
             "min_std": min_std,
             "smooth_std": smooth_std,
             "normalize_beta": normalize_beta,
+            "tol": tol,
         }
 
         self._collect_names = []
@@ -292,14 +440,24 @@ class IBALayer(keras.layers.Layer):
         self._report_tensors = OrderedDict()
         self._report_tensors_first = OrderedDict()
 
+        # the capacity is computed in float32, also under a mixed precision policy of keras
+        kwargs.setdefault('dtype', 'float32')
         super().__init__(**kwargs)
 
+    def _assign(self, session, ops=(), **values):
+        """
+        Assigns the ``values`` to the layer variables of the same name (see ``build``)
+        using the prebuilt assign ops. ``ops`` are run in the same call.
+        """
+        session.run(list(ops) + [self._assign_ops[name] for name in values],
+                    feed_dict={self._assign_values[name]: value for name, value in values.items()})
+
     def _get_session(self, session=None):
         """ Returns session if not None or the keras or tensoflow default session.  """
         return session or keras.backend.get_session() or tf.get_default_session()
 
     def set_default(self, batch_size=None, steps=None, beta=None, learning_rate=None,
-                    min_std=None, smooth_std=None, normalize_beta=None):
+                    min_std=None, smooth_std=None, normalize_beta=None, tol=None):
         """Updates the default hyperparamter values. """
         if batch_size is not None:
             self._default_hyperparams['batch_size'] = batch_size
@@ -315,6 +473,8 @@ class IBALayer(keras.layers.Layer):
             self._default_hyperparams['smooth_std'] = smooth_std
         if normalize_beta is not None:
             self._default_hyperparams['normalize_beta'] = normalize_beta
+        if tol is not None:
+            self._default_hyperparams['tol'] = tol
 
     def get_default(self):
         """Returns the default hyperparamter values."""
@@ -373,6 +533,8 @@ class IBALayer(keras.layers.Layer):
     def build(self, input_shape):
         """ Builds the keras layer given the input shape.  """
         shape = self._feature_shape = [1, ] + [int(d) for d in input_shape[1:]]
+        # one alpha and feature map per analyzed image
+        batch_shape = [self._analyze_batch] + shape[1:]
 
         # optimization placeholders
         self.learning_rate = tf.get_variable('learning_rate',  initializer=1.0)
@@ -383,10 +545,12 @@ class IBALayer(keras.layers.Layer):
 
         # trained parameters
         alpha_init = 5
-        self._alpha = tf.get_variable(name='alpha', initializer=alpha_init*tf.ones(shape))
+        self._alpha = tf.get_variable(name='alpha', initializer=alpha_init*tf.ones(batch_shape))
 
         # feature map
-        self._feature = tf.get_variable('feature', shape, trainable=False)
+        self._feature = tf.get_variable('feature', batch_shape, trainable=False)
+        # number of image slots which are run, the first n_slots alphas and feature maps
+        self._n_slots = tf.get_variable('n_slots', dtype=tf.int32, initializer=self._analyze_batch)
 
         # mean of feature map r
         self._mean_r = tf.get_variable(
@@ -411,6 +575,28 @@ class IBALayer(keras.layers.Layer):
         self._min_std_r = tf.get_variable('min_std_r', dtype=tf.float32, initializer=0.1)
         # kernel size for gaussian blur
         self._smooth_std = tf.get_variable('smooth_std', dtype=tf.float32, initializer=1.)
+
+        # assign ops fed with placeholders, built once so that the graph does not grow
+        # with every analyzed image (see _assign)
+        self._assign_values = OrderedDict()
+        self._assign_ops = OrderedDict()
+        for name, var in [('mean_r', self._mean_r),
+                          ('std_r', self._std_r),
+                          ('active_neurons', self._active_neurons),
+                          ('feature', self._feature),
+                          ('n_slots', self._n_slots),
+                          ('pass_mask', self._pass_mask),
+                          ('beta', self._beta),
+                          ('batch_size', self._batch_size),
+                          ('smooth_std', self._smooth_std),
+                          ('min_std_r', self._min_std_r),
+                          ('learning_rate', self.learning_rate),
+                          ('restrict_flow', self._restrict_flow),
+                          ('use_layer_input', self._use_layer_input)]:
+            self._assign_values[name] = tf.placeholder(var.dtype.base_dtype, var.shape,
+                                                       name='assign_{}_value'.format(name))
+            self._assign_ops[name] = tf.assign(var, self._assign_values[name],
+                                               name='assign_{}'.format(name))
         super().build(input_shape)
 
     def compute_output_shape(self, input_shape):
@@ -422,16 +608,17 @@ class IBALayer(keras.layers.Layer):
         the information flow with: :meth:`.restrict_flow`. """
         if self._estimator is None and not self._feature_mean_std_given:
             self._estimator = TFWelfordEstimator(inputs.name)
+            self._load_estimator_cache()
 
-        feature = tf.cond(self._use_layer_input, lambda: inputs, lambda: self._feature)
+        feature = tf.cond(self._use_layer_input, lambda: inputs, lambda: self._feature[:self._n_slots])
 
         tile_batch_size = tf.cond(self._use_layer_input,
                                   lambda: 1,
                                   lambda: self._batch_size)
-        tile_shape = [tile_batch_size, ] + [1] * (len(self._feature_shape) - 1)
-        # tf.tile对张量(Tensor)进行扩展的
-        R = tf.tile(feature, tile_shape)
-        pass_mask = tf.tile(self._pass_mask, tile_shape)
+        self._tile_batch_size = tile_batch_size
+        # every image is repeated tile_batch_size times: [r_1, r_1, ..., r_2, r_2, ...]
+        R = _repeat_rows(feature, tile_batch_size)
+        pass_mask = self._pass_mask * tf.ones_like(R)
         restrict_mask = 1 - pass_mask
 
         std_r_min = tf.maximum(self._std_r, self._min_std_r)
@@ -443,14 +630,26 @@ class IBALayer(keras.layers.Layer):
         # λ = _gaussian_blur(lambda_pre_blur, std=self._smooth_std)
         λ = lambda_pre_blur
 
+        def layer_input_lambda():
+            if self._analyze_batch == 1:
+                # the single alpha is broadcast to every input
+                return λ
+            # one alpha per analyzed image, so the inputs have to be the analyze_batch images
+            batch_matches = tf.debugging.assert_equal(
+                tf.shape(inputs)[0], self._analyze_batch,
+                message="with analyze_batch > 1 the layer input batch has to be analyze_batch")
+            with tf.control_dependencies([batch_matches]):
+                return tf.identity(λ)
+        λ_R = tf.cond(self._use_layer_input, layer_input_lambda,
+                      lambda: _repeat_rows(λ[:self._n_slots], tile_batch_size))
+
         # std normal noise N(0, 1)
-        noise_shape = [tile_batch_size] + R.get_shape().as_list()[1:]
-        std_normal = tf.random.normal(noise_shape)
+        std_normal = tf.random.normal(tf.shape(R))
 
         # ε ~ N(μ_r, σ_r)
         ε = std_r_min * std_normal + self._mean_r
 
-        Z = λ * R + (1 - λ) * ε
+        Z = λ_R * R + (1 - λ_R) * ε
 
         # let all information through for neurons in pass_mask
         Z_with_passing = restrict_mask * Z + pass_mask * R
@@ -459,13 +658,22 @@ class IBALayer(keras.layers.Layer):
         output = tf.cond(self._restrict_flow, lambda: Z_with_passing, lambda: inputs)
         # save capacityies
 
-        self._capacity = (_kl_div(R, λ, self._mean_r, std_r_min) *
+        self._capacity = (_kl_div(R, λ_R, self._mean_r, std_r_min) *
                           restrict_mask * self._active_neurons)
         # 如果是
         self._capacity_no_nans = tf.where(tf.is_nan(self._capacity),
                                           tf.zeros_like(self._capacity),
                                           self._capacity)
-        self._capacity_mean = tf.reduce_sum(self._capacity_no_nans) / tf.reduce_sum(restrict_mask)
+        # capacity mean per image, the rows of an image are consecutive
+        n_images = tf.shape(R)[0] // tile_batch_size
+        self._capacity_means = (
+            tf.reduce_sum(tf.reshape(self._capacity_no_nans, [n_images, -1]), axis=1) /
+            tf.reduce_sum(tf.reshape(restrict_mask, [n_images, -1]), axis=1))
+        # summed over the images, so the gradient of every alpha only depends on its image
+        self._capacity_mean = tf.reduce_sum(self._capacity_means)
+        # capacity map of every image, it does not depend on the noise
+        self._capacity_maps = tf.reshape(
+            self._capacity_no_nans, tf.concat([[n_images, -1], tf.shape(R)[1:]], axis=0))[:, 0]
 
         # save tensors for report
         self._report('lambda_pre_blur', lambda_pre_blur)
@@ -475,6 +683,7 @@ class IBALayer(keras.layers.Layer):
         self._report('capacity', self._capacity)
         self._report('capacity_no_nans', self._capacity_no_nans)
         self._report('capacity_mean', self._capacity_mean)
+        self._report('capacity_means', self._capacity_means)
 
         self._report('perturbed_feature', Z)
         self._report('perturbed_feature_passing', Z_with_passing)
@@ -504,9 +713,9 @@ class IBALayer(keras.layers.Layer):
         """
         session = self._get_session(session)
         old_value = session.run(self._restrict_flow)
-        session.run(tf.assign(self._restrict_flow, True))
+        self._assign(session, restrict_flow=True)
         yield
-        session.run(tf.assign(self._restrict_flow, old_value))
+        self._assign(session, restrict_flow=old_value)
 
     # Set model loss
 
@@ -522,23 +731,30 @@ class IBALayer(keras.layers.Layer):
         You have to ensure that the final layer of ``model`` does not applies a softmax.
         For keras models, you can remove a softmax activation using :func:`model_wo_softmax`.
         """
-        self.target = tf.get_variable('iba_target', dtype=tf.int32, initializer=[1])
+        self.target = tf.get_variable('iba_target', dtype=tf.int32, initializer=[1] * self._analyze_batch)
 
-        target_one_hot = tf.one_hot(self.target, depth=logits.shape[-1])
+        n_images = tf.shape(self.target)[0]
+        target_one_hot = tf.one_hot(_repeat_rows(self.target, tf.shape(logits)[0] // n_images),
+                                    depth=logits.shape[-1])
         loss_ce = tf.nn.softmax_cross_entropy_with_logits_v2(
             labels=target_one_hot,
             logits=logits,
             name='cross_entropy'
         )
-        loss_ce_mean = tf.reduce_mean(loss_ce)
+        # mean over the noise samples of every image, summed over the images
+        loss_ce_means = tf.reduce_mean(tf.reshape(loss_ce, [n_images, -1]), axis=1)
+        loss_ce_mean = tf.reduce_sum(loss_ce_means)
         self._report('logits', logits)
         self._report('cross_entropy', loss_ce)
-        self.set_model_loss(loss_ce_mean, optimizer_cls)
+        self.set_model_loss(loss_ce_mean, optimizer_cls, model_losses=loss_ce_means)
         return self.target
 
-    def set_model_loss(self, model_loss, optimizer_cls=tf.train.AdamOptimizer):
+    def set_model_loss(self, model_loss, optimizer_cls=tf.train.AdamOptimizer, model_losses=None):
         """
         Sets the model loss for the final objective ``model_loss + beta * capacity_mean``.
+        For ``analyze_batch > 1``, ``model_loss`` must be the sum of the per image losses.
+        ``model_losses`` are the per image losses, used to detect the convergence of every
+        image (see ``tol``). If ``None``, all images use the total loss.
         When build the ``model_loss``, ensure you are using the copied graph.
 
         Example: ::
@@ -551,6 +767,12 @@ class IBALayer(keras.layers.Layer):
         information_loss = self._capacity_mean
         loss = model_loss + self._beta * information_loss
         self._optimizer_step = self._optimizer.minimize(loss, var_list=[self._alpha])
+        self._optimizer_initializer = tf.variables_initializer(self._optimizer.variables())
+
+        if model_losses is None:
+            self._image_losses = loss * tf.ones_like(self._capacity_means)
+        else:
+            self._image_losses = model_losses + self._beta * self._capacity_means
 
         self._report('loss', loss)
         self._report('model_loss', model_loss)
@@ -558,8 +780,95 @@ class IBALayer(keras.layers.Layer):
         self._report('grad_loss_wrt_alpha', tf.gradients(loss, self._alpha)[0])
         self._model_loss_set = True
 
+    def set_multi_head_loss(self, head_losses, optimizer_cls=tf.train.AdamOptimizer):
+        """
+        Explains several heads of a multi-task model in the same optimization: head ``k`` of
+        image ``i`` is explained by the alpha of slot ``i * n_heads + k``, so ``analyze_batch``
+        (see the constructor) must be at least the number of heads. All heads are computed
+        in one graph run per step, see :meth:`analyze_heads_batch`.
+        Args:
+            head_losses (list): one tensor per head with the loss of every row of the model
+                output, i.e. of shape ``[n_images * n_heads * batch_size]``:
+                :meth:`analyze_heads_batch` runs only the slots of the heads.
+            optimizer_cls: optimizer of the alphas.
+        """
+        n_heads = len(head_losses)
+        if n_heads > self._analyze_batch:
+            raise ValueError("Got {} heads, but the layer has only analyze_batch={} alphas."
+                             .format(n_heads, self._analyze_batch))
+        # slot (i, k) only sees the loss of head k in its rows, the other rows of head k do
+        # not change its alpha
+        slot_losses = [tf.reduce_mean(tf.reshape(loss, [-1, n_heads, self._batch_size])[:, k], axis=1)
+                       for k, loss in enumerate(head_losses)]
+        model_losses = tf.reshape(tf.stack(slot_losses, axis=1), [-1])
+        for k, loss in enumerate(slot_losses):
+            self._report('head_loss_{}'.format(k), tf.reduce_sum(loss))
+        self._n_heads = n_heads
+        self.set_model_loss(tf.reduce_sum(model_losses), optimizer_cls, model_losses=model_losses)
+
+    def set_classification_segmentation_loss(self, classification_output, segmentation_output,
+                                             optimizer_cls=tf.train.AdamOptimizer):
+        """
+        Sets a :meth:`set_multi_head_loss` for the sigmoid outputs of the multi-task models
+        (``classification_output`` and ``segmentation_output``, see ``models/MTL_IBA.py``):
+        the binary cross-entropy of the class and the mean binary cross-entropy of the mask.
+        Returns the placeholders of the class target (one-hot, ``[n_images, n_classes]``) and of
+        the mask target (``[n_images, height, width, channels]``). Example: ::
+            cls_target, seg_target = iba.set_classification_segmentation_loss(
+                model.get_layer('classification_output').output,
+                model.get_layer('segmentation_output').output)
+            cls_capacity, seg_capacity = iba.analyze_heads(
+                {model.input: x, cls_target: y_cls, seg_target: y_seg})
+        """
+        cls_target = tf.placeholder(tf.float32, [None] + classification_output.shape.as_list()[1:],
+                                    name='iba_classification_target')
+        seg_target = tf.placeholder(tf.float32, [None] + segmentation_output.shape.as_list()[1:],
+                                    name='iba_segmentation_target')
+        # a single target is broadcasted to all rows, analyze_heads_batch repeats the targets
+        # of every image to its rows
+        cls_loss = K.mean(K.binary_crossentropy(cls_target * tf.ones_like(classification_output),
+                                                classification_output), axis=-1)
+        seg_loss = K.mean(K.batch_flatten(K.binary_crossentropy(
+            seg_target * tf.ones_like(segmentation_output), segmentation_output)), axis=-1)
+        self._report('classification_loss', cls_loss)
+        self._report('segmentation_loss', seg_loss)
+        self.set_multi_head_loss([cls_loss, seg_loss], optimizer_cls)
+        return cls_target, seg_target
+
     # Fit std and mean estimator
 
+    def set_cache_key(self, cache_key, cache_dir=None):
+        """
+        Sets the key of the estimator cache, e.g. after loading the model weights, and
+        loads the cached estimate if the estimator was not fitted yet. Example: ::
+
+            model.load_weights('weights.h5')
+            iba.set_cache_key(model_cache_key(model, iba.name, 'dataset/split.csv', layer_input=True))
+            iba.fit_generator(feed_dicts)   # returns immediately if the estimate is cached
+
+        Returns:
+            ``True`` if a cached estimate was loaded.
+        """
+        self._cache_key = cache_key
+        self._cache_dir = cache_dir or self._cache_dir
+        return self._load_estimator_cache()
+
+    def _load_estimator_cache(self):
+        if self._cache_key is None or self._estimator is None or self._estimator.n_samples() > 0:
+            return False
+        state = load_estimator_cache(self._cache_key, self._cache_dir)
+        if state is None:
+            return False
+        self._estimator.load_state_dict(state)
+        self._estimate_cached = True
+        return True
+
+    def save_estimator_cache(self):
+        """ Saves the estimate under the ``cache_key``. Returns the path of the cache file. """
+        assert self._cache_key is not None, "no cache_key set"
+        return save_estimator_cache(self._cache_key, self._estimator.state_dict(), self._cache_dir)
+
+
     def fit(self, feed_dict, session=None, run_kwargs={}):
         """
         Estimate the feature mean and std from the given feed_dict.
@@ -605,6 +914,15 @@ class IBALayer(keras.layers.Layer):
             run_kwargs (dict): additional kwargs to ``session.run``.
         """
 
+        if self._estimator.n_samples() >= n_samples:
+            # e.g. loaded from the estimator cache
+            return
+        if self._estimate_cached:
+            # a cached estimate of fewer samples is a miss, refit from scratch instead of
+            # fitting the cached images again on top of it
+            self._estimator.reset()
+        self._estimate_cached = False
+
         try:
             tqdm = get_tqdm()
             gen = tqdm(generator, disable=not progbar, desc="[Fit Estimator]")
@@ -617,6 +935,8 @@ class IBALayer(keras.layers.Layer):
             self._estimator.fit(feed_dict, session=session, run_kwargs=run_kwargs)
             if self._estimator.n_samples() >= n_samples:
                 break
+        if self._cache_key is not None:
+            self.save_estimator_cache()
 
     def analyze(self, feed_dict,
                 batch_size=None,
@@ -628,7 +948,8 @@ class IBALayer(keras.layers.Layer):
                 normalize_beta=None,
                 session=None,
                 pass_mask=None,
-                progbar=False) -> np.ndarray:
+                progbar=False,
+                tol=None) -> np.ndarray:
         """
         Returns the transmitted information per feature. See :func:`to_saliency_map` to convert the
         intermediate capacites to a visual saliency map.
@@ -649,6 +970,9 @@ class IBALayer(keras.layers.Layer):
                 No noise is added if ``pass_mask == 0``.  For example, it might
                 be usefull if a variable lenght sequence is zero-padded.
             progbar (bool): Flag to display progressbar.
+            tol (float): stop the optimization of an image once the relative change of its
+                loss and of its capacity map between two steps are both below ``tol``. The
+                steps used by every image are stored in ``self.steps_used``.
         """
         session = self._get_session(session)
         feature = session.run(self.input, feed_dict=feed_dict)
@@ -665,7 +989,112 @@ class IBALayer(keras.layers.Layer):
             smooth_std=smooth_std,
             normalize_beta=normalize_beta,
             session=session,
-            progbar=False)
+            progbar=False,
+            tol=tol)[0]
+
+    def analyze_batch(self, feed_dict, targets=None, session=None, **kwargs):
+        """
+        Returns the transmitted information per feature for every image in ``feed_dict``.
+        The images are optimized in chunks of ``analyze_batch`` images (see the constructor)
+        in the same graph runs, each with its own alpha.
+        Args:
+            feed_dict (dict): TensorFlow feed_dict providing the model inputs of all images.
+            targets (np.array): one target per image if :meth:`set_classification_loss` is used.
+            session (tf.Session): TensorFlow session to run the optimization.
+            **kwargs: hyperparameters, see :meth:`analyze`.
+        Returns:
+            capacities of shape ``(n_images, ) + feature_shape``.
+        """
+        session = self._get_session(session)
+        features = session.run(self.input, feed_dict=feed_dict)
+        return self._analyze_features(features, feed_dict, targets, feed_feature=True,
+                                      session=session, **kwargs)
+
+    def analyze_heads(self, feed_dict, session=None, **kwargs):
+        """
+        Returns one capacity map per head of :meth:`set_multi_head_loss` for the image in
+        ``feed_dict``, see :meth:`analyze_heads_batch`.
+        Args:
+            feed_dict (dict): TensorFlow feed_dict providing the model inputs and the head
+                targets of a single image.
+            session (tf.Session): TensorFlow session to run the optimization.
+            **kwargs: hyperparameters, see :meth:`analyze`.
+        Returns:
+            capacities of shape ``(n_heads, ) + feature_shape``.
+        """
+        return self.analyze_heads_batch(feed_dict, session, **kwargs)[0]
+
+    def analyze_heads_batch(self, feed_dict, session=None, **kwargs):
+        """
+        Returns the capacity maps of every head of :meth:`set_multi_head_loss` for every image
+        in ``feed_dict``. Chunks of ``analyze_batch // n_heads`` images are optimized together,
+        every head of every image with its own alpha. The model before the layer, and the
+        tensors the heads use besides the layer output (e.g. skip connections), are computed
+        once; every step only runs the slots of the chunk through the model after the layer.
+        Args:
+            feed_dict (dict): TensorFlow feed_dict providing the model inputs and the head
+                targets of all images.
+            session (tf.Session): TensorFlow session to run the optimization.
+            **kwargs: hyperparameters, see :meth:`analyze`.
+        Returns:
+            capacities of shape ``(n_images, n_heads) + feature_shape``.
+        """
+        if self._n_heads is None:
+            raise ValueError("Call set_multi_head_loss before analyze_heads.")
+        session = self._get_session(session)
+        graph = self.input.graph
+        feed_tensors = [graph.as_graph_element(key) for key in feed_dict]
+        trunk_key = tuple(sorted(t.name for t in feed_tensors))
+        if trunk_key not in self._heads_trunk:
+            self._heads_trunk[trunk_key] = _trunk_tensors(self.output, self.input, feed_tensors)
+        trunk = self._heads_trunk[trunk_key]
+        outs = session.run([self.input] + trunk, feed_dict=feed_dict)
+        features = outs[0]
+        n_images = len(features)
+        # every slot has batch_size rows of the layer output
+        rows_per_image = self._n_heads * (kwargs.get('batch_size') or
+                                          self._default_hyperparams['batch_size'])
+        images_per_run = self._analyze_batch // self._n_heads
+
+        def is_batch(value):
+            return np.ndim(value) > 0 and len(value) == n_images
+
+        capacities = []
+        steps_used = []
+        for start in range(0, n_images, images_per_run):
+            chunk = slice(start, start + images_per_run)
+            heads_feed_dict = {key: np.repeat(value[chunk], rows_per_image, axis=0)
+                               if is_batch(value) else value
+                               for key, value in feed_dict.items()}
+            # the model is not evaluated up to the layer input and the trunk tensors in every step
+            heads_feed_dict[self.input] = np.repeat(features[chunk], rows_per_image, axis=0)
+            for tensor, value in zip(trunk, outs[1:]):
+                if is_batch(value):
+                    heads_feed_dict[tensor] = np.repeat(value[chunk], rows_per_image, axis=0)
+            slot_features = np.repeat(features[chunk], self._n_heads, axis=0)
+            capacity = self._analyze_feature(slot_features, heads_feed_dict, session=session,
+                                             n_slots=len(slot_features), **kwargs)
+            capacities.append(capacity.reshape((-1, self._n_heads) + capacity.shape[1:]))
+            steps_used.append(self.steps_used)
+        self.steps_used = np.concatenate(steps_used)
+        return np.concatenate(capacities)
+
+    def _analyze_features(self, features, feed_dict, targets=None, feed_feature=False, **kwargs):
+        capacities = []
+        steps_used = []
+        for start in range(0, len(features), self._analyze_batch):
+            chunk = features[start:start + self._analyze_batch]
+            chunk_feed_dict = dict(feed_dict)
+            if feed_feature:
+                # the model is not evaluated up to the layer input in every step
+                chunk_feed_dict[self.input] = chunk
+            if targets is not None:
+                chunk_feed_dict[self.target] = _pad_rows(
+                    np.asarray(targets[start:start + self._analyze_batch]), self._analyze_batch)
+            capacities.append(self._analyze_feature(chunk, chunk_feed_dict, **kwargs))
+            steps_used.append(self.steps_used)
+        self.steps_used = np.concatenate(steps_used)
+        return np.concatenate(capacities)
 
     def _analyze_feature(self,
                          feature,
@@ -679,7 +1108,9 @@ class IBALayer(keras.layers.Layer):
                          normalize_beta=True,
                          pass_mask=None,
                          session=None,
-                         progbar=False):
+                         progbar=False,
+                         tol=None,
+                         n_slots=None):
         if session is None:
             session = keras.backend.get_session()
 
@@ -690,6 +1121,7 @@ class IBALayer(keras.layers.Layer):
         min_std = min_std or self._default_hyperparams['min_std']
         smooth_std = smooth_std or self._default_hyperparams['smooth_std']
         normalize_beta = normalize_beta or self._default_hyperparams['normalize_beta']
+        tol = tol or self._default_hyperparams.get('tol')
 
         if not hasattr(self, '_optimizer'):
             raise ValueError("Optimizer not build yet! You have to specify your model loss "
@@ -699,7 +1131,7 @@ class IBALayer(keras.layers.Layer):
         if not normalize_beta:
             # we use the mean of the capacity, which is equivalent to dividing by k =h *w*c.
             # therefore, we have to denormalize beta: β = β*h*w*c.
-            beta = beta * np.prod(feature.shape)
+            beta = beta * np.prod(feature.shape[1:])
 
         if self._feature_mean_std_given:
             feature_mean = self._feature_mean
@@ -717,29 +1149,32 @@ class IBALayer(keras.layers.Layer):
             else:
                 return x
 
+        n_images = len(feature)
+        feature = _pad_rows(feature, self._analyze_batch)
+
         feature_mean = maybe_unsqueeze(feature_mean)
         feature_std = maybe_unsqueeze(feature_std)
         feature_active = maybe_unsqueeze(feature_active)
 
-        # set hyperparameters
-        assigns = [
-            self._alpha.initializer,
-            tf.variables_initializer(self._optimizer.variables()),
-            tf.assign(self._mean_r, feature_mean, name='assign_feature_mean'),
-            tf.assign(self._std_r, feature_std, name='assign_feature_std'),
-            tf.assign(self._active_neurons, feature_active, name='assign_feature_std'),
-            tf.assign(self._feature, feature, name='assign_feature'),
-            tf.assign(self._beta, beta, name='assign_beta'),
-            tf.assign(self._smooth_std, smooth_std, name='assign_smooth_std'),
-            tf.assign(self._min_std_r, min_std, name='assign_min_std'),
-            tf.assign(self.learning_rate, learning_rate, name='assign_lr'),
-            tf.assign(self._restrict_flow, True, name='assign_restrict_flow'),
-            tf.assign(self._use_layer_input, False, name='assign_use_layer_input'),
-        ]
         if pass_mask is None:
-            pass_mask = tf.zeros_like(self._pass_mask)
-        assigns.append(tf.assign(self._pass_mask, pass_mask))
-        session.run(assigns)
+            pass_mask = np.zeros(self._pass_mask.shape.as_list(), dtype=np.float32)
+        pass_mask = maybe_unsqueeze(pass_mask)
+
+        # set hyperparameters
+        self._assign(session, [self._alpha.initializer, self._optimizer_initializer],
+                     mean_r=feature_mean,
+                     std_r=feature_std,
+                     active_neurons=feature_active,
+                     feature=feature,
+                     n_slots=n_slots or self._analyze_batch,
+                     pass_mask=pass_mask,
+                     beta=beta,
+                     batch_size=batch_size,
+                     smooth_std=smooth_std,
+                     min_std_r=min_std,
+                     learning_rate=learning_rate,
+                     restrict_flow=True,
+                     use_layer_input=False)
 
         report_tensors = self._get_report_tensors()
         report_tensors_first = self._get_report_tensors_first()
@@ -760,11 +1195,35 @@ class IBALayer(keras.layers.Layer):
                 warnings.warn("Cannot load tqdm! Sorry, no progress bar")
             steps_progbar = range(steps)
 
+        self.steps_used = np.full(n_images, steps)
+        # capacity maps of the images which converged before the last step
+        converged_capacity = {}
+        last = None
         for step in steps_progbar:
+            if tol is None:
+                outs = session.run(
+                    [self._optimizer_step] + list(report_tensors.values()),
+                    feed_dict=feed_dict)
+                self._log[step] = OrderedDict(zip(report_tensors_first.keys(), outs[1:]))
+                continue
+
+            # the losses and capacities are computed before the step is applied
             outs = session.run(
-                [self._optimizer_step] + list(report_tensors.values()),
+                [self._optimizer_step, self._image_losses, self._capacity_maps] +
+                list(report_tensors.values()),
                 feed_dict=feed_dict)
-            self._log[step] = OrderedDict(zip(report_tensors_first.keys(), outs[1:]))
+            self._log[step] = OrderedDict(zip(report_tensors_first.keys(), outs[3:]))
+            image_losses, capacity_maps = outs[1][:n_images], outs[2][:n_images]
+            if last is not None:
+                converged = ((_relative_change(image_losses, last[0]) < tol) &
+                             (_relative_change(capacity_maps, last[1]) < tol))
+                for i in np.flatnonzero(converged):
+                    if i not in converged_capacity:
+                        converged_capacity[i] = capacity_maps[i]
+                        self.steps_used[i] = step
+                if len(converged_capacity) == n_images:
+                    break
+            last = image_losses, capacity_maps
 
         final_report_tensors = list(report_tensors.values())
         final_report_tensor_names = list(report_tensors.keys())
@@ -778,11 +1237,14 @@ class IBALayer(keras.layers.Layer):
         self._log['final'] = OrderedDict(zip(final_report_tensor_names, vals))
 
         # reset flags up
-        session.run([
-            tf.assign(self._restrict_flow, False, name='assign_restrict_flow'),
-            tf.assign(self._use_layer_input, True, name='assign_use_layer_input'),
-        ])
-        return self._log['final']['capacity'][0]
+        self._assign(session, restrict_flow=False, use_layer_input=True)
+        # the first noise sample of every image, the capacity is the same for all of them
+        capacity = self._log['final']['capacity']
+        capacity = capacity.reshape((-1, batch_size) + capacity.shape[1:])[:n_images, 0]
+        for i, converged in converged_capacity.items():
+            capacity[i] = converged
+        self._log['steps_used'] = self.steps_used
+        return capacity
 
     def state_dict(self):
         """
@@ -56,12 +56,19 @@ class WelfordEstimator:
             self.m = np.zeros(shape)
             self.s = np.zeros(shape)
             self._neuron_nonzero = np.zeros(shape, dtype='long')
-        for xi in x:
-            self._neuron_nonzero += (xi != 0.)
-            old_m = self.m.copy()
-            self.m = self.m + (xi-self.m) / (self._n_samples + 1)
-            self.s = self.s + (xi-self.m) * (xi-old_m)
-            self._n_samples += 1
+        if len(x) == 0:
+            return x
+        # merge the batch statistics with the running ones (Chan et al.), equivalent
+        # to the per-sample welford update
+        n_a, n_b = self._n_samples, len(x)
+        n = n_a + n_b
+        batch_mean = x.mean(axis=0, dtype=np.float64)
+        batch_s = ((x - batch_mean) ** 2).sum(axis=0)
+        delta = batch_mean - self.m
+        self.m += delta * (n_b / n)
+        self.s += batch_s + delta ** 2 * (n_a * n_b / n)
+        self._neuron_nonzero += (x != 0.).sum(axis=0)
+        self._n_samples = n
         return x
 
     def n_samples(self):
@@ -96,9 +103,156 @@ class WelfordEstimator:
         """ Loads the internal state of the estimator. """
         self.m = state['m']
         self.s = state['s']
-        self._n_samples = state['n_samples']
+        self._n_samples = int(state['n_samples'])
         self._neuron_nonzero = state['neuron_nonzero']
 
+    def merge(self, other):
+        """
+        Merges the estimates of ``other`` into this estimator, as if all samples were
+        fitted by this estimator. ``other`` is an estimator or a :meth:`state_dict`
+        fitted on different samples, e.g. on another shard of the dataset.
+        """
+        state = other.state_dict() if hasattr(other, 'state_dict') else other
+        n_b = int(state['n_samples'])
+        if n_b == 0:
+            return self
+        if self._n_samples == 0:
+            self.m = np.array(state['m'], dtype=np.float64)
+            self.s = np.array(state['s'], dtype=np.float64)
+            self._neuron_nonzero = np.array(state['neuron_nonzero'], dtype='long')
+            self._n_samples = n_b
+            return self
+        # parallel variance (Chan et al.)
+        n_a = self._n_samples
+        n = n_a + n_b
+        delta = state['m'] - self.m
+        self.m = self.m + delta * (n_b / n)
+        self.s = self.s + state['s'] + delta ** 2 * (n_a * n_b / n)
+        self._neuron_nonzero = self._neuron_nonzero + state['neuron_nonzero']
+        self._n_samples = n
+        return self
+
+
+def merge_estimator_states(states):
+    """ Merges the ``state_dict`` s of estimators fitted on disjoint samples into one state. """
+    estimator = WelfordEstimator()
+    for state in states:
+        estimator.merge(state)
+    return estimator.state_dict()
+
+
+def split_shards(items, n_shards):
+    """ Splits ``items`` into ``n_shards`` shards of (almost) the same size. """
+    return [items[i::n_shards] for i in range(n_shards)]
+
+
+def estimate_sharded(fit_shard, shards, workers=None):
+    """
+    Fits the feature statistics on every shard in a process pool and merges them.
+
+    Args:
+        fit_shard: function ``fit_shard(shard) -> state_dict`` which fits an estimator on
+            one shard and returns its (numpy) :meth:`WelfordEstimator.state_dict`.
+            It is executed in a new process, so it has to be importable (defined at the
+            top level of a module) and load the model itself.
+        shards: the arguments of ``fit_shard``, e.g. lists of image paths (see :func:`split_shards`).
+        workers: number of processes. Default: one per shard.
+
+    Returns:
+        A :class:`WelfordEstimator` with the estimates of all shards.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # spawn instead of fork: tensorflow sessions and cuda contexts cannot be forked
+    with ProcessPoolExecutor(max_workers=workers or len(shards),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        states = list(executor.map(fit_shard, shards))
+    estimator = WelfordEstimator()
+    for state in states:
+        estimator.merge(state)
+    return estimator
+
+
+def save_estimator_state(state, path):
+    """ Saves a :meth:`WelfordEstimator.state_dict` as ``.npz``. """
+    np.savez(path, **{k: v for k, v in state.items() if k != 'feature_name'})
+
+
+def load_estimator_state(path):
+    """ Loads a state saved with :func:`save_estimator_state`. """
+    with np.load(path) as f:
+        state = {k: f[k] for k in f.files}
+    # np.savez stores python ints as 0-d arrays
+    state['n_samples'] = int(state['n_samples'])
+    return state
+
+
+def estimator_cache_key(weights, layer_name, manifest=None, folds=None):
+    """
+    Returns a key for the estimator cache (see :func:`load_estimator_cache`).
+
+    Args:
+        weights: the model weights as a list of numpy arrays, e.g. ``model.get_weights()``.
+        layer_name: name of the layer or feature tensor of the bottleneck.
+        manifest: the data used for the estimation, a split manifest or an image directory.
+            The manifest content, or the file names and sizes of the directory, are hashed.
+        folds: the folds of the manifest used for the estimation.
+    """
+    import hashlib
+    import os
+
+    h = hashlib.sha1()
+    for w in weights:
+        w = np.ascontiguousarray(w)
+        h.update(('%s%s' % (w.dtype, w.shape)).encode())
+        h.update(w.data)
+    h.update(layer_name.encode())
+    if manifest is not None and os.path.isdir(manifest):
+        for root, dirs, files in sorted(os.walk(manifest)):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                h.update(('%s:%d' % (os.path.relpath(path, manifest), os.path.getsize(path))).encode())
+    elif manifest is not None:
+        with open(manifest, 'rb') as f:
+            h.update(f.read())
+    if folds is not None:
+        h.update(repr(sorted(str(fold) for fold in folds)).encode())
+    return h.hexdigest()
+
+
+def estimator_cache_path(key, cache_dir=None):
+    """ Cache file of ``key``, in ``cache_dir`` or ``$IBA_CACHE_DIR`` (default: ``~/.cache/iba``). """
+    import os
+
+    cache_dir = cache_dir or os.environ.get('IBA_CACHE_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'iba')
+    return os.path.join(cache_dir, key + '.npz')
+
+
+def load_estimator_cache(key, cache_dir=None):
+    """ Returns the cached estimator state of ``key`` or ``None``. """
+    import os
+
+    path = estimator_cache_path(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    return load_estimator_state(path)
+
+
+def save_estimator_cache(key, state, cache_dir=None):
+    """ Saves the estimator state under ``key``. Returns the path of the cache file. """
+    import os
+
+    path = estimator_cache_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first, other processes never read a partial cache
+    tmp = path[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+    save_estimator_state(state, tmp)
+    os.replace(tmp, path)
+    return path
+
 
 def _to_saliency_map(capacity, shape=None, data_format='channels_last'):
     """
@@ -127,6 +281,91 @@ def _to_saliency_map(capacity, shape=None, data_format='channels_last'):
         return saliency_map
 
 
+def _bilinear_indices(n_in, n_out):
+    """
+    Returns the source indices ``lo``, ``hi`` and the weight of ``hi`` of every output pixel
+    of a bilinear resize from ``n_in`` to ``n_out`` pixels. Pixel centers are aligned and the
+    border is mirrored, as ``skimage.transform.resize(order=1)`` does for upsampling.
+    """
+    src = (np.arange(n_out) + 0.5) * (n_in / float(n_out)) - 0.5
+    # mirror at the first and the last pixel center
+    src = np.abs(src)
+    src = np.clip(np.where(src > n_in - 1, 2 * (n_in - 1) - src, src), 0, n_in - 1)
+    lo = np.floor(src).astype(np.int64)
+    hi = np.minimum(lo + 1, n_in - 1)
+    return lo, hi, (src - lo).astype(np.float32)
+
+
+def _to_saliency_maps(capacities, shape=None, data_format='channels_last'):
+    """
+    Batched :func:`_to_saliency_map` for capacities of shape ``(n, ...)``, returns saliency maps
+    of shape ``(n, ) + shape``. It is the NumPy fallback of the device implementations
+    (``IBA.pytorch.to_saliency_maps`` and ``IBA.tensorflow_v1.to_saliency_maps``), which use the
+    same indices and give the same output.
+    """
+    if data_format == 'channels_first':
+        saliency_maps = np.nansum(capacities, 1)
+    elif data_format == 'channels_last':
+        saliency_maps = np.nansum(capacities, -1)
+    else:
+        raise ValueError
+
+    # to bits
+    saliency_maps = saliency_maps / float(np.log(2))
+
+    if shape is None:
+        return saliency_maps
+    ho, wo = saliency_maps.shape[1:]
+    h, w = shape
+    # Scale bits to the pixels
+    saliency_maps = saliency_maps * ((ho*wo) / (h*w))
+    lo_y, hi_y, wy = _bilinear_indices(ho, h)
+    lo_x, hi_x, wx = _bilinear_indices(wo, w)
+    wy = wy[None, :, None]
+    rows = saliency_maps[:, lo_y] * (1 - wy) + saliency_maps[:, hi_y] * wy
+    return rows[:, :, lo_x] * (1 - wx) + rows[:, :, hi_x] * wx
+
+
+def saliency_parity(reference, saliency_map, top_k=0.1):
+    """
+    Compares a saliency map to a ``reference``, e.g. a map of a reduced precision run to the
+    map of the float32 run of the same image.
+
+    Args:
+        reference (np.ndarray): reference saliency map.
+        saliency_map (np.ndarray): saliency map of the same shape.
+        top_k (float): fraction of the pixels for the top-k overlap.
+
+    Returns:
+        dict with the ``max_abs_error``, the ``relative_l1`` error, the pearson
+        ``correlation`` and the ``top_k_overlap`` (fraction of the ``top_k`` most salient
+        pixels of ``reference`` that are also among the most salient pixels of ``saliency_map``).
+    """
+    reference = np.nan_to_num(np.asarray(reference, dtype=np.float64)).ravel()
+    saliency_map = np.nan_to_num(np.asarray(saliency_map, dtype=np.float64)).ravel()
+    if reference.shape != saliency_map.shape:
+        raise ValueError("Shapes differ: {} and {}".format(reference.shape, saliency_map.shape))
+    k = max(1, int(round(top_k * len(reference))))
+    top_reference = np.argsort(reference)[-k:]
+    top_saliency = np.argsort(saliency_map)[-k:]
+    return {
+        'max_abs_error': float(np.abs(reference - saliency_map).max()),
+        'relative_l1': float(np.abs(reference - saliency_map).sum() /
+                             (np.abs(reference).sum() + 1e-12)),
+        'correlation': float(np.corrcoef(reference, saliency_map)[0, 1]),
+        'top_k_overlap': len(np.intersect1d(top_reference, top_saliency)) / float(k),
+    }
+
+
+def _relative_change(new, old, eps=1e-8):
+    """
+    Returns the relative L1 change ``|new - old| / |old|`` of every row. Works for numpy
+    arrays and torch tensors.
+    """
+    n = len(new)
+    return abs(new - old).reshape(n, -1).sum(1) / (abs(old).reshape(n, -1).sum(1) + eps)
+
+
 def get_tqdm():
     """Tries to import ``tqdm`` from ``tqdm.auto`` if fails uses cli ``tqdm``."""
     try:
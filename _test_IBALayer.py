@@ -18,7 +18,7 @@ import keras.backend as K
 import os
 import tensorflow as tf
 from IBA.utils import plot_saliency_map
-from IBA.tensorflow_v1 import IBALayer, model_wo_softmax, to_saliency_map
+from IBA.tensorflow_v1 import IBALayer, model_wo_softmax, to_saliency_map, model_cache_key
 from models.VGG import VGG16Net_IBA
 
 batch_size = 12
@@ -102,9 +102,9 @@ target = iba.set_classification_loss(model_logits.output)
 # ensure model is in eval mode
 K.set_learning_phase(0)
 
-# estimate mean, std on 5000 samples
-for img in train_x[:600]:
-    iba.fit({model.input: img[None]})
+# estimate mean, std on 600 samples, later runs load the estimate from the cache
+iba.set_cache_key(model_cache_key(model, iba.name, train_path, layer_input=True))
+iba.fit_generator(({model.input: img[None]} for img in train_x), n_samples=600)
 
 rows = 6
 cols = 2
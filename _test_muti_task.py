@@ -47,7 +47,7 @@ model.summary()
 model.load_weights('MT-IB_BUSI.h5')
 
 
-test_x, test_c_y, test_s_y = load_clas_seg_data(testX_dir, target)
+test_x, test_c_y, test_s_y = load_clas_seg_data(testX_dir, target, cache=True)
 
 
 lb = LabelBinarizer()
@@ -0,0 +1,87 @@
+"""
+Throughput and latency benchmark of a running ``serve_explanations.py``. Sends the images
+of ``--images`` (files or directories) from ``--concurrency`` threads and prints the
+requests per second and the latency percentiles.
+
+    python benchmark_explanations.py --images dataset/LE/test/images --requests 200 --concurrency 8 --no-iba
+"""
+import os
+import time
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+import numpy as np
+
+
+def list_images(paths):
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                images += [os.path.join(root, f) for f in sorted(files)
+                           if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
+        else:
+            images.append(path)
+    return images
+
+
+def explain(url, data, timeout=300):
+    """
+    Posts one encoded image, returns the decoded JSON response and the latency in seconds.
+    The JSON ``{'error': ...}`` of a failed (400/500) request is returned like a response.
+    """
+    start = time.perf_counter()
+    request = Request(url, data=data, headers={'Content-Type': 'application/octet-stream'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            body = json.loads(response.read().decode('utf-8'))
+    except HTTPError as e:
+        body = json.loads(e.read().decode('utf-8'))
+    return body, time.perf_counter() - start
+
+
+def run_benchmark(url, images, n_requests, concurrency, warmup=2):
+    """ Returns the latencies of ``n_requests`` requests and the wall time of all of them. """
+    payloads = []
+    for path in images:
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    for i in range(warmup):
+        explain(url, payloads[i % len(payloads)])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda i: explain(url, payloads[i % len(payloads)]),
+                                    range(n_requests)))
+    wall = time.perf_counter() - start
+    errors = [body['error'] for body, _ in results if 'error' in body]
+    if errors:
+        print('%d requests failed, e.g.: %s' % (len(errors), errors[0]))
+    return np.array([latency for _, latency in results]), wall
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--images', type=str, nargs='+', required=True, help='image files or directories')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--no-iba', action='store_true', help='skip the IBA optimization')
+    parser.add_argument('--no-gradcam', action='store_true', help='skip the Grad-CAM')
+    opt = parser.parse_args()
+    print(opt)
+
+    images = list_images(opt.images)
+    assert len(images) > 0, 'no images found'
+    url = '%s/explain?iba=%d&gradcam=%d' % (opt.url.rstrip('/'), not opt.no_iba, not opt.no_gradcam)
+    latencies, wall = run_benchmark(url, images, opt.requests, opt.concurrency)
+    with urlopen(opt.url.rstrip('/') + '/health') as response:
+        health = json.loads(response.read().decode('utf-8'))
+
+    print('%d requests in %.2fs: %.2f requests/s' % (len(latencies), wall, len(latencies) / wall))
+    print('latency ms: mean %.1f  p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(
+        1000 * np.array([latencies.mean()] + list(np.percentile(latencies, [50, 90, 99])) +
+                        [latencies.max()])))
+    print('server: %d requests in %d batches' % (health['requests'], health['batches']))
@@ -0,0 +1,104 @@
+"""
+Estimates the feature mean and std of an IBA layer on several processes. Every process
+loads the model and fits a ``TFWelfordEstimator`` on one shard of the images, the
+shard states are merged into one (see ``IBA.utils.estimate_sharded``).
+
+    python estimate_iba_stats.py --model models.VGG:VGG16Net_IBA.build --weights wights/model.h5 \\
+        --layer block4_conv3 --data dataset/split.csv --folds 0 1 2 3 --workers 4 --out iba_stats.npz
+
+The ``.npz`` can be loaded with ``IBA.utils.load_estimator_state`` and passed to
+``TFWelfordEstimator.load_state_dict`` / ``WelfordEstimator.merge``. With ``--cache`` the
+state is also written to the estimator cache, where ``IBALayer(cache_key=...)`` finds it.
+An ``IBALayer`` estimates its input, so estimate it with ``--layer <iba name> --layer-input``.
+"""
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+from functools import partial
+import importlib
+import argparse
+import numpy as np
+
+from IBA.utils import estimate_sharded, split_shards, save_estimator_state, \
+    estimator_cache_key, save_estimator_cache
+
+
+def build_model(model, weights=None, target=(224, 224), n_classes=2):
+    """
+    ``model`` is a saved keras model (``.h5``) or ``module:builder`` of a model definition
+    with the arguments ``(width, height, depth, classes)``, either a function like
+    ``models.MTL_IBA:MTL_IBA`` or a ``build`` staticmethod like ``models.VGG:VGG16Net_IBA.build``.
+
+    Args:
+        target: input (width, height) passed to the builder.
+        n_classes: number of classes passed to the builder.
+    """
+    import keras
+    from IBA.tensorflow_v1 import IBALayer
+    if ':' in model:
+        module_name, builder_name = model.split(':')
+        builder = importlib.import_module(module_name)
+        for name in builder_name.split('.'):
+            builder = getattr(builder, name)
+        net = builder(target[0], target[1], 3, n_classes)
+    else:
+        net = keras.models.load_model(model, custom_objects={'IBALayer': IBALayer}, compile=False)
+    if weights:
+        net.load_weights(weights)
+    return net
+
+
+def fit_shard(paths, model, weights, layer, target, batch_size, use_layer_input=False, n_classes=2):
+    """ Fits a ``TFWelfordEstimator`` on ``paths`` and returns its state, runs in a worker process. """
+    import keras.backend as K
+    from gernerate_data import read_images
+    from IBA.tensorflow_v1 import TFWelfordEstimator
+
+    K.set_learning_phase(0)
+    net = build_model(model, weights, target, n_classes)
+    feature = net.get_layer(layer).input if use_layer_input else net.get_layer(layer).output
+    estimator = TFWelfordEstimator(feature.name)
+    for i in range(0, len(paths), batch_size):
+        batch = read_images(paths[i:i + batch_size], target, workers=1).astype(np.float32) / 255.0
+        estimator.fit({net.input: batch}, session=K.get_session())
+    return estimator.state_dict()
+
+
+def list_images(data, folds=None):
+    """ All images of an ``images/<class_name>/`` directory or a split manifest. """
+    from gernerate_data import list_clas_seg_samples
+    return [path for path, _ in list_clas_seg_samples(data, shuffle=False, seed=0, folds=folds)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='saved keras model or module:function')
+    parser.add_argument('--weights', type=str, default=None, help='weights loaded into the model')
+    parser.add_argument('--layer', type=str, required=True, help='name of the layer where the IBA is inserted')
+    parser.add_argument('--layer-input', action='store_true', help='estimate the input of --layer instead of its output')
+    parser.add_argument('--data', type=str, required=True, help='images/<class_name>/ directory or split manifest')
+    parser.add_argument('--folds', type=str, nargs='*', default=None, help='folds of the split manifest')
+    parser.add_argument('--target', type=int, nargs=2, default=[224, 224], help='width height')
+    parser.add_argument('--n-classes', type=int, default=2, help='classes of a module:builder model')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--n-samples', type=int, default=None, help='use only the first n images')
+    parser.add_argument('--workers', type=int, default=4, help='processes, one shard per process')
+    parser.add_argument('--out', type=str, default='iba_stats.npz')
+    parser.add_argument('--cache', action='store_true', help='also save the state to the estimator cache')
+    parser.add_argument('--cache-dir', type=str, default=None, help='defaults to $IBA_CACHE_DIR or ~/.cache/iba')
+    opt = parser.parse_args()
+    print(opt)
+
+    paths = list_images(opt.data, opt.folds)[:opt.n_samples]
+    shards = split_shards(paths, opt.workers)
+    fit = partial(fit_shard, model=opt.model, weights=opt.weights, layer=opt.layer,
+                  target=tuple(opt.target), batch_size=opt.batch_size, use_layer_input=opt.layer_input,
+                  n_classes=opt.n_classes)
+    estimator = estimate_sharded(fit, shards, opt.workers)
+    save_estimator_state(estimator.state_dict(), opt.out)
+    print('estimated %s on %d samples, saved to %s' % (opt.layer, estimator.n_samples(), opt.out))
+    if opt.cache:
+        # same key as model_cache_key(..., layer_input=opt.layer_input)
+        layer_name = opt.layer + ':input' if opt.layer_input else opt.layer
+        weights = build_model(opt.model, opt.weights, tuple(opt.target), opt.n_classes).get_weights()
+        key = estimator_cache_key(weights, layer_name, opt.data, opt.folds)
+        print('cached as', save_estimator_cache(key, estimator.state_dict(), opt.cache_dir))
@@ -1,26 +1,77 @@
 from keras.preprocessing.image import img_to_array
-from sklearn.model_selection import train_test_split
+from keras.utils import Sequence
+from sklearn.model_selection import train_test_split, StratifiedKFold
 from PIL import Image
+import tensorflow as tf
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import random
 import shutil
+import json
+import zlib
+import csv
 import cv2
 import os
 
-def load_cla_data(train_imagePaths, target):
-
-    data = []
-    labels = []
-    images_names = []
-    for imagePath in train_imagePaths:
-        image = cv2.imread(imagePath)
-        image = cv2.resize(image, target)
-        data.append(image)
-        label = imagePath.split(os.path.sep)[-2]
-        labels.append(label)
-        _, images_name = os.path.split(imagePath)
-        print(images_name)
-        images_names.append(images_name)
+def read_images(paths, target, flags=cv2.IMREAD_COLOR, workers=None, out=None, rows=None):
+    """
+    Decodes and resizes ``paths`` with a thread pool (``cv2.imread`` and ``cv2.resize``
+    release the GIL) and writes them into one preallocated uint8 array. The order of
+    the output follows ``paths``, independent of the number of workers.
+
+    Args:
+        paths: image paths.
+        target: (width, height) passed to ``cv2.resize``.
+        flags: ``cv2.imread`` flags.
+        workers: number of threads. Defaults to the number of cpus, ``1`` decodes serially.
+        out: write into this array instead of allocating a new one.
+        rows: ``paths[i]`` is written to ``out[rows[i]]``, requires ``out``.
+            Defaults to ``range(len(paths))``.
+    """
+    if rows is not None and out is None:
+        raise ValueError('rows can only be given together with out')
+    workers = workers or os.cpu_count() or 1
+    rows = range(len(paths)) if rows is None else rows
+
+    def decode(i):
+        out[rows[i]] = cv2.resize(cv2.imread(paths[i], flags), target)
+
+    if out is None:
+        if len(paths) == 0:
+            return np.empty((0,), dtype=np.uint8)
+        # the first image determines the shape and dtype of the output
+        first = cv2.resize(cv2.imread(paths[0], flags), target)
+        out = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+        out[rows[0]] = first
+        remaining = range(1, len(paths))
+    else:
+        remaining = range(len(paths))
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(decode, remaining))
+    else:
+        for i in remaining:
+            decode(i)
+    return out
+
+def load_cla_data(train_imagePaths, target, workers=None, cache=False):
+    """
+    Args:
+        cache: read the images from the dataset cache (see ``build_dataset_cache``) of the
+            ``images/<class_name>/`` directory holding ``train_imagePaths``.
+    """
+    if cache and len(train_imagePaths) > 0:
+        images_dir = os.path.dirname(os.path.dirname(os.path.normpath(train_imagePaths[0])))
+        images, _, _, index = load_dataset_cache(images_dir, target)
+        rows = {os.path.normpath(e['path']): row for row, e in enumerate(index['samples'])}
+        data = images[np.array([rows[os.path.normpath(imagePath)] for imagePath in train_imagePaths],
+                               dtype=np.int64)]
+    else:
+        data = read_images(train_imagePaths, target, workers=workers)
+    labels = [imagePath.split(os.path.sep)[-2] for imagePath in train_imagePaths]
+    images_names = [os.path.split(imagePath)[1] for imagePath in train_imagePaths]
     data = np.array(data, dtype="float") / 255.0
     labels = np.array(labels)
 
@@ -58,35 +109,22 @@ def split_train_and_test(img_dir, mask_dir, test_dir, split_size=0.25):
 
     print("=====================finish move======================")
 
-def load_SEG_data(testX_dir, target=(64, 64), shuffle=True):
+def load_SEG_data(testX_dir, target=(64, 64), shuffle=True, seed=None, workers=None, folds=None, cache=False):
 
-    class_list = os.listdir(testX_dir)
-    
-    data = []
-    labels = []
-    data_names = []
-    
-    for class_name in class_list:
-        class_path = os.path.join(testX_dir, class_name)
-        img_list = os.listdir(class_path)
-        if shuffle:
-            random.shuffle(img_list)
-        for image_Name in img_list:
-
-            img_path = os.path.join(class_path, image_Name)
-            image = cv2.imread(img_path)
-            image = cv2.resize(image, target)
-            data_names.append(image_Name)
-            print(img_path)
-
-            mask_Path = img_path.replace('images', 'masks')
-            mask = cv2.imread(mask_Path, cv2.COLOR_BGR2GRAY)
-            mask = cv2.resize(mask,target)
-            mask = np.expand_dims(mask, axis=-1)
-            print(mask.shape)
-            print(mask_Path)
-            data.append(image)
-            labels.append(mask)
+    if cache:
+        data, _, masks, samples = _read_clas_seg_cache(testX_dir, target, shuffle, seed, folds)
+        data_names = [os.path.basename(img_path) for img_path, _ in samples]
+        # 缓存中的mask是三通道的, 二值mask的各通道相同, 取第一个通道
+        labels = masks[..., :1]
+    else:
+        samples = list_clas_seg_samples(testX_dir, shuffle, seed, folds, with_masks=True)
+        img_paths = [img_path for img_path, _, _ in samples]
+        mask_paths = [mask_path for _, mask_path, _ in samples]
+        data_names = [os.path.basename(img_path) for img_path in img_paths]
+
+        data = read_images(img_paths, target, workers=workers)
+        labels = read_images(mask_paths, target, flags=cv2.COLOR_BGR2GRAY, workers=workers)
+        labels = np.expand_dims(labels, axis=-1)
 
     data = np.array(data, dtype="float")
     labels = np.array(labels, dtype="float")
@@ -100,188 +138,559 @@ def load_SEG_data(testX_dir, target=(64, 64), shuffle=True):
 
     return data, labels, data_names
     
-def load_SEG_data_for_test(testX_dir, target=(64, 64), shuffle=False):
+def load_SEG_data_for_test(testX_dir, target=(64, 64), shuffle=False, seed=None, workers=None, folds=None,
+                           cache=False):
 
-    class_list = os.listdir(testX_dir)
-    data = []
-    labels = []
-    original_imgs = []
-    data_names = []
-    for class_name in class_list:
-        class_path = os.path.join(testX_dir, class_name)
-        img_list = os.listdir(class_path)
-        if shuffle:
-            random.shuffle(img_list)
-        for image_Name in img_list:
-
-            img_path = os.path.join(class_path, image_Name)
-            image = cv2.imread(img_path)
-            image = cv2.resize(image, target)
-            data_names.append(image_Name)
-            print(img_path)
-
-            mask_Path = img_path.replace('images', 'masks')
-            mask = cv2.imread(mask_Path)
-            mask = cv2.resize(mask, target)
-            print(mask_Path)
-            data.append(image)
-            labels.append(mask)
+    data, _, labels, samples = _read_clas_seg_samples(testX_dir, target, shuffle, seed, workers, cache, folds)
+    data_names = [os.path.basename(img_path) for img_path, _ in samples]
 
     data = np.array(data, dtype="float")
-    labels = np.array(labels, dtype="float")
     original_imgs =data
     data = data / 255.0
-    labels = labels / 255.0
-    if labels.shape == 3:
-        np.expand_dims(labels, axis=-1)
 
-    onehot_mask = mask_to_onehot(labels, 2)
+    onehot_mask = mask_to_onehot(labels, 2, scale=255)
     return data, onehot_mask, data_names, original_imgs
 
-def load_clas_seg_data(testX_dir, target=(64, 64), shuffle = True):
+def _read_clas_seg_samples(testX_dir, target, shuffle, seed=None, workers=None, cache=False, folds=None):
+    """
+    Returns uint8 images, class names, uint8 masks and the ``(image path, class name)``
+    samples of ``testX_dir``, either decoded in parallel or read from the dataset cache.
+    """
+    if cache:
+        return _read_clas_seg_cache(testX_dir, target, shuffle, seed, folds)
+    samples = list_clas_seg_samples(testX_dir, shuffle, seed, folds, with_masks=True)
+    data = read_images([img_path for img_path, _, _ in samples], target, workers=workers)
+    masks = read_images([mask_path for _, mask_path, _ in samples], target, workers=workers)
+    labels = np.array([class_name for _, _, class_name in samples])
+    return data, labels, masks, [(img_path, class_name) for img_path, _, class_name in samples]
 
-    class_list = os.listdir(testX_dir)
-    data = []
-    labels = []
-    masks = []
-    for class_name in class_list:
-        class_path = os.path.join(testX_dir, class_name)
-        img_list = os.listdir(class_path)
-        if shuffle:
-            random.shuffle(img_list)
-        for image_Name in img_list:
-
-            img_path = os.path.join(class_path, image_Name)
-#             print(img_path)
-            image = cv2.imread(img_path)
-            image = cv2.resize(image, target)
-         
-
-            label = img_path.split(os.path.sep)[-2]
-            labels.append(label)
-
-            mask_Path = img_path.replace('images', 'masks')
-#             print(mask_Path)
-            mask = cv2.imread(mask_Path)
-            mask = cv2.resize(mask, target)
-            
-            data.append(image)
-            masks.append(mask)
+def load_clas_seg_data(testX_dir, target=(64, 64), shuffle = True, cache=False, seed=None, workers=None,
+                          sparse=False, folds=None):
 
+    data, labels, masks, _ = _read_clas_seg_samples(testX_dir, target, shuffle, seed, workers, cache, folds)
+    return _clas_seg_arrays(data, labels, masks, sparse)
+
+def _clas_seg_arrays(data, labels, masks, sparse=False):
     data = np.array(data, dtype="float")
     labels = np.array(labels)
-    masks = np.array(masks, dtype="float")
-    data = data / 255.0     
-    masks = masks / 255.0
-    masks = np.array(masks)
-    if masks.shape == 3:
-        np.expand_dims(masks, axis=-1)
-    onehot_mask = mask_to_onehot(masks, 2)
+    data = data / 255.0
+    # masks stay uint8, only the one hot (or sparse) encoding is materialized
+    if sparse:
+        onehot_mask = mask_to_labels(masks, 2, scale=255)[..., None]
+    else:
+        onehot_mask = mask_to_onehot(masks, 2, scale=255)
 
     return data, labels, onehot_mask
 
-def load_clas_seg_data_for_test(testX_dir, target=(64, 64), shuffle = False):
+def load_clas_seg_data_for_test(testX_dir, target=(64, 64), shuffle = False, cache=False, seed=None, workers=None,
+                                sparse=False, folds=None):
 
-    class_list = os.listdir(testX_dir)
-    data = []
-    imgs = []
-    labels = []
-    masks = []
-    for class_name in class_list:
-        class_path = os.path.join(testX_dir, class_name)
-        img_list = os.listdir(class_path)
-        if shuffle:
-            random.shuffle(img_list)
-        for image_Name in img_list:
+    data, labels, masks, samples = _read_clas_seg_samples(testX_dir, target, shuffle, seed, workers, cache, folds)
+    # file names of the last class directory
+    last_class = samples[-1][1]
+    img_list = [os.path.basename(img_path) for img_path, class_name in samples if class_name == last_class]
+    imgs = np.array(data, dtype="float")
+    data, labels, onehot_mask = _clas_seg_arrays(data, labels, masks, sparse)
 
-            img_path = os.path.join(class_path, image_Name)
-            image = cv2.imread(img_path)
-            imgs.append(image)
-            image = cv2.resize(image, target)
-#             print(img_path)
+    return data, labels, onehot_mask, img_list, imgs
 
-            label = img_path.split(os.path.sep)[-2]
-            labels.append(label)
+def load_img(testX_dir, target=(64, 64), shuffle = True, cache=False, seed=None, workers=None,
+                sparse=False, folds=None):
 
-            mask_Path = img_path.replace('images', 'masks')
-            mask = cv2.imread(mask_Path)
-            mask = cv2.resize(mask, target)
-#             print(mask_Path)
-            data.append(image)
-            masks.append(mask)
+    data, labels, masks, _ = _read_clas_seg_samples(testX_dir, target, shuffle, seed, workers, cache, folds)
+    return _clas_seg_arrays(data, labels, masks, sparse)
 
-    data = np.array(data, dtype="float")
-    labels = np.array(labels)
-    masks = np.array(masks, dtype="float")
-    
-    imgs = data
-    data = data / 255.0
-    masks = masks / 255.0
-    masks = np.array(masks)
-    if masks.shape == 3:
-        np.expand_dims(masks, axis=-1)
-    onehot_mask = mask_to_onehot(masks, 2)
+def mask_path_of(img_path):
+    """
+    Returns the mask of ``img_path`` in the sibling ``masks`` directory, with the same file
+    name or else the ``.png`` of the same name (e.g. the masks of ``preprocess/imageaug.py``).
+    """
+    mask_path = img_path.replace('images', 'masks')
+    png_path = os.path.splitext(mask_path)[0] + '.png'
+    if not os.path.exists(mask_path) and os.path.exists(png_path):
+        return png_path
+    return mask_path
 
-    return data, labels, onehot_mask, img_list, imgs
+def list_clas_seg_samples(testX_dir, shuffle=True, seed=None, folds=None, with_masks=False):
+    """
+    Lists the (image path, class name) pairs of an ``images/<class_name>/`` directory in the
+    same order as the ``load_clas_seg_data`` loaders. The images of each class are shuffled
+    if ``shuffle`` is set, reproducibly if a ``seed`` is given.
 
-def load_img(testX_dir, target=(64, 64), shuffle = True):
+    ``testX_dir`` can also be a split manifest (``.csv``, see ``write_split_manifest``),
+    then only the samples of ``folds`` are listed.
 
-    class_list = os.listdir(testX_dir)
-    data = []
-    labels = []
-    masks = []
+    With ``with_masks`` the (image path, mask path, class name) triples are listed, the mask
+    path is the ``mask_path`` column of a manifest or ``mask_path_of`` the image.
+    """
+    rng = random if seed is None else random.Random(seed)
+    if is_split_manifest(testX_dir):
+        class_images = {}
+        for entry in read_split_manifest(testX_dir, folds):
+            class_images.setdefault(entry['label'], []).append((entry['path'], entry['mask_path']))
+        class_list = sorted(class_images)
+    else:
+        class_list = sorted(os.listdir(testX_dir)) if seed is not None else os.listdir(testX_dir)
+    samples = []
     for class_name in class_list:
-        class_path = os.path.join(testX_dir, class_name)
-        img_list = os.listdir(class_path)
+        if is_split_manifest(testX_dir):
+            img_list = class_images[class_name]
+        else:
+            class_path = os.path.join(testX_dir, class_name)
+            img_list = [(img_path, mask_path_of(img_path)) for img_path in
+                        (os.path.join(class_path, image_Name) for image_Name in os.listdir(class_path))]
+        if seed is not None:
+            img_list.sort()
         if shuffle:
-            random.shuffle(img_list)
-        for image_Name in img_list:
+            rng.shuffle(img_list)
+        for img_path, mask_path in img_list:
+            samples.append((img_path, mask_path, class_name) if with_masks else (img_path, class_name))
+    return samples
 
-            img_path = os.path.join(class_path, image_Name)
-            image = cv2.imread(img_path)
-            image = cv2.resize(image, target)
-            print(img_path)
+MANIFEST_FIELDS = ['path', 'mask_path', 'label', 'fold']
 
-            label = img_path.split(os.path.sep)[-2]
-            labels.append(label)
+def is_split_manifest(path):
+    return os.path.splitext(path)[1].lower() == '.csv'
 
-            mask_Path = img_path.replace('images', 'masks')
-            mask = cv2.imread(mask_Path)
-            mask = cv2.resize(mask, target)
-            print(mask_Path)
-            data.append(image)
-            masks.append(mask)
+def write_split_manifest(train_dir, manifest_path, n_folds=5, test_size=0.1, seed=0):
+    """
+    Splits an ``images/<class_name>/`` directory without moving any file. The samples are
+    written to a CSV manifest with the columns ``path, mask_path, label, fold``; ``test_size``
+    of every class goes to the ``test`` fold, the rest is assigned to ``n_folds`` stratified
+    folds ``0 .. n_folds - 1``. Paths are stored relative to the manifest.
+
+    Args:
+        train_dir: the ``images`` directory, masks are read from the sibling ``masks`` directory.
+        manifest_path: the ``.csv`` file to write.
+        n_folds: number of cross validation folds.
+        test_size: fraction of the held out test split, 0 for none.
+        seed: seed of the split.
+    Returns:
+        the manifest path.
+    """
+    samples = sorted(list_clas_seg_samples(train_dir, shuffle=False, with_masks=True))
+    paths = np.array([img_path for img_path, _, _ in samples])
+    mask_paths = np.array([mask_path for _, mask_path, _ in samples])
+    labels = np.array([class_name for _, _, class_name in samples])
+    folds = np.empty(len(samples), dtype=object)
+
+    rest = np.arange(len(samples))
+    if test_size:
+        rest, test = train_test_split(rest, test_size=test_size, stratify=labels, random_state=seed)
+        folds[test] = 'test'
+    skf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    for fold, (_, fold_idx) in enumerate(skf.split(rest, labels[rest])):
+        folds[rest[fold_idx]] = str(fold)
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        for img_path, mask_path, class_name, fold in zip(paths, mask_paths, labels, folds):
+            writer.writerow({'path': os.path.relpath(os.path.abspath(img_path), manifest_dir),
+                             'mask_path': os.path.relpath(os.path.abspath(mask_path), manifest_dir),
+                             'label': class_name,
+                             'fold': fold})
+    return manifest_path
+
+def read_split_manifest(manifest_path, folds=None):
+    """
+    Reads the entries (dicts with ``path, mask_path, label, fold``) of a split manifest.
+    The paths are resolved against the manifest directory.
 
-    data = np.array(data, dtype="float")
-    labels = np.array(labels)
-    masks = np.array(masks, dtype="float")
-    data = data / 255.0
-    masks = masks / 255.0
-    masks = np.array(masks)
-    if masks.shape == 3:
-        np.expand_dims(masks, axis=-1)
-    onehot_mask = mask_to_onehot(masks, 2)
+    Args:
+        folds: a fold or a list of folds to keep, e.g. ``[0, 1, 2, 3]`` or ``'test'``.
+            All entries are returned if None.
+    """
+    if folds is not None:
+        folds = set(str(fold) for fold in (folds if isinstance(folds, (list, tuple, set)) else [folds]))
+    manifest_dir = os.path.dirname(manifest_path)
+    entries = []
+    with open(manifest_path, newline='') as f:
+        for entry in csv.DictReader(f):
+            if folds is not None and entry['fold'] not in folds:
+                continue
+            entry['path'] = os.path.join(manifest_dir, entry['path'])
+            entry['mask_path'] = os.path.join(manifest_dir, entry['mask_path'])
+            entries.append(entry)
+    return entries
+
+class ClasSegSequence(Sequence):
+    """
+    Streams ``(x, [class_onehot, seg_onehot])`` batches of an ``images/<class_name>/``
+    directory for ``model.fit``. Only one batch is decoded at a time, so the memory
+    is bounded by ``batch_size`` and not by the size of the split. Images and masks
+    are scaled to float32 in the same way as ``load_clas_seg_data``.
+
+    Args:
+        testX_dir: the ``images`` directory, masks are read from the sibling ``masks`` directory,
+            or a split manifest with the ``mask_path`` of every image.
+        target: (width, height) passed to ``cv2.resize``.
+        batch_size: number of samples per batch.
+        shuffle: reshuffle the samples after every epoch.
+        classes: class names in one-hot order. Defaults to the sorted class directories,
+            which matches ``LabelBinarizer`` + ``to_categorical``.
+        n_inputs: the image batch is passed this many times for multi-input models.
+        cache: read the batches from the memory-mapped dataset cache (see ``build_dataset_cache``).
+        sparse: yield integer label masks ``(batch, H, W, 1)`` instead of the one hot masks,
+            for the ``sparse_*`` losses in ``utils.losses``.
+        augment: ``augment(images, masks, seeds) -> (images, masks)`` applied to every uint8 batch,
+            e.g. ``preprocess.imageaug.augment_batch``. The seed of every sample is derived from
+            ``seed``, the epoch and the sample index, so runs are reproducible and a sample is
+            augmented the same way whatever the other samples of its batch are.
+        seed: base seed of the augmentation.
+        folds: folds of a split manifest passed as ``testX_dir`` (see ``write_split_manifest``).
+    """
+    def __init__(self, testX_dir, target=(64, 64), batch_size=8, shuffle=True, classes=None, n_inputs=1,
+                 cache=False, sparse=False, augment=None, seed=0, folds=None):
+        self.samples = list_clas_seg_samples(testX_dir, shuffle=False, folds=folds, with_masks=True)
+        if cache:
+            self._images, self._masks, _, index = load_dataset_cache(testX_dir, target)
+            rows = {e['path']: row for row, e in enumerate(index['samples'])}
+            self._rows = np.array([rows[img_path] for img_path, _, _ in self.samples], dtype=np.int64)
+        else:
+            self._images = self._masks = self._rows = None
+        self.target = target
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.classes = sorted(classes or set(label for _, _, label in self.samples))
+        self.n_inputs = n_inputs
+        self.sparse = sparse
+        self.augment = augment
+        self.seed = seed
+        self.epoch = 0
+        self.indexes = np.arange(len(self.samples))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.samples) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch_indexes = self.indexes[idx * self.batch_size:(idx + 1) * self.batch_size]
+        width, height = self.target
+        images = np.empty((len(batch_indexes), height, width, 3), dtype=np.uint8)
+        masks = np.empty((len(batch_indexes), height, width, 3), dtype=np.uint8)
+        labels = np.empty(len(batch_indexes), dtype=np.int64)
+        for i, sample_idx in enumerate(batch_indexes):
+            img_path, mask_path, class_name = self.samples[sample_idx]
+            if self._images is not None:
+                images[i] = self._images[self._rows[sample_idx]]
+                masks[i] = self._masks[self._rows[sample_idx]]
+            else:
+                images[i] = cv2.resize(cv2.imread(img_path), self.target)
+                masks[i] = cv2.resize(cv2.imread(mask_path), self.target)
+            labels[i] = self.classes.index(class_name)
+        if self.augment is not None:
+            seeds = np.array([np.random.SeedSequence([self.seed, self.epoch, int(i)]).generate_state(1)[0]
+                              for i in batch_indexes])
+            images, masks = self.augment(images, masks, seeds)
+        x = images.astype(np.float32)
+        x /= 255.0
+
+        class_onehot = np.eye(len(self.classes), dtype=np.float32)[labels]
+        if self.sparse:
+            seg_y = mask_to_labels(masks, 2, scale=255)[..., None]
+        else:
+            seg_y = mask_to_onehot(masks, 2, scale=255)
+        inputs = x if self.n_inputs == 1 else [x] * self.n_inputs
+        return inputs, [class_onehot, seg_y]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.shuffle:
+            np.random.shuffle(self.indexes)
+
+def build_clas_seg_dataset(testX_dir, target=(64, 64), batch_size=8, shuffle=True, classes=None, model=None,
+                           n_inputs=1, cache=False, tf_cache=None, augment=None, seed=0, folds=None, sparse=False,
+                           shuffle_buffer=1024):
+    """
+    Builds a ``tf.data`` pipeline of ``(x, targets)`` batches for ``model.fit``, equivalent to
+    ``ClasSegSequence``. The sample keys are shuffled, images and masks are decoded by a parallel
+    ``map``, optionally cached, batched, augmented and prefetched (``AUTOTUNE``) so the input
+    pipeline overlaps with training.
+
+    Args:
+        testX_dir: the ``images`` directory or a split manifest.
+        target: (width, height) passed to ``cv2.resize``.
+        batch_size: number of samples per batch.
+        shuffle: reshuffle the samples every epoch. The keys are shuffled before the decoding,
+            with ``tf_cache`` the decoded samples in a buffer of ``shuffle_buffer`` samples.
+        classes: class names in one-hot order, defaults to the sorted class names.
+        model: the keras model to feed. The image is passed to every model input (as the same
+            tensor, it is not copied) and the targets are keyed by ``model.output_names``: the
+            first output gets the class one-hot, all other outputs the segmentation masks.
+            This fits the ``MLT_net`` and ``MTL_IBA`` builders.
+        n_inputs: number of model inputs if ``model`` is not given.
+        cache: read the samples from the memory-mapped dataset cache (see ``build_dataset_cache``).
+        tf_cache: ``Dataset.cache`` of the decoded uint8 samples, ``''`` caches in memory,
+            a file name caches to that file. Not cached if None.
+        augment: ``augment(images, masks, seeds) -> (images, masks)`` applied to every uint8 batch,
+            with one seed per sample derived from ``seed``, the epoch and the sample.
+        seed: seed of the shuffling and augmentation.
+        folds: folds of a split manifest passed as ``testX_dir``.
+        sparse: yield integer label masks ``(batch, H, W, 1)`` instead of the one hot masks.
+        shuffle_buffer: buffer size of the shuffle after ``tf_cache``.
+    """
+    samples = list_clas_seg_samples(testX_dir, shuffle=False, folds=folds, with_masks=True)
+    classes = sorted(classes or set(label for _, _, label in samples))
+    width, height = target
+    if cache:
+        images, masks, _, index = load_dataset_cache(testX_dir, target)
+        rows = {e['path']: row for row, e in enumerate(index['samples'])}
+        keys = np.array([rows[img_path] for img_path, _, _ in samples], dtype=np.int64)
+
+        def decode(row):
+            return images[row], masks[row]
+    else:
+        keys = np.array([img_path for img_path, _, _ in samples])
+        mask_paths = {img_path: mask_path for img_path, mask_path, _ in samples}
+
+        def decode(img_path):
+            img_path = img_path.decode()
+            return (cv2.resize(cv2.imread(img_path), target),
+                    cv2.resize(cv2.imread(mask_paths[img_path]), target))
+    labels = np.array([classes.index(class_name) for _, _, class_name in samples], dtype=np.int64)
+
+    def decode_sample(key, label):
+        image, mask = tf.numpy_function(decode, [key], [tf.uint8, tf.uint8])
+        image.set_shape((height, width, 3))
+        mask.set_shape((height, width, 3))
+        return image, mask, label, key
+
+    def augment_batch(images, masks, labels, keys, epochs):
+        def run(images, masks, keys, epochs):
+            seeds = np.array([np.random.SeedSequence(
+                [seed, int(epoch), zlib.crc32(key) if isinstance(key, bytes) else int(key)]).generate_state(1)[0]
+                for key, epoch in zip(keys, epochs)])
+            return augment(images, masks, seeds)
+        images, masks = tf.numpy_function(run, [images, masks, keys, epochs], [tf.uint8, tf.uint8])
+        images.set_shape((None, height, width, 3))
+        masks.set_shape((None, height, width, 3))
+        return images, masks, labels, keys, epochs
+
+    if model is not None:
+        n_inputs = len(model.inputs)
+        output_names = model.output_names
+    else:
+        output_names = None
+
+    def to_inputs_and_targets(images, masks, labels, keys, epochs):
+        x = tf.cast(images, tf.float32) / 255.0
+        class_onehot = tf.one_hot(labels, len(classes))
+        # same encoding as mask_to_onehot / mask_to_labels with palette 2 and scale 255
+        background = tf.reduce_all(tf.equal(masks, 0), axis=-1)
+        foreground = tf.reduce_all(tf.equal(masks, 255), axis=-1)
+        if sparse:
+            seg_y = tf.where(foreground, tf.ones_like(masks[..., 0], tf.int8),
+                             tf.where(background, tf.zeros_like(masks[..., 0], tf.int8),
+                                      -tf.ones_like(masks[..., 0], tf.int8)))[..., None]
+        else:
+            seg_y = tf.cast(tf.stack([background, foreground], axis=-1), tf.float32)
+        inputs = x if n_inputs == 1 else (x,) * n_inputs
+        if output_names is None:
+            return inputs, (class_onehot, seg_y)
+        return inputs, {name: class_onehot if i == 0 else seg_y for i, name in enumerate(output_names)}
+
+    autotune = tf.data.experimental.AUTOTUNE
+    samples_dataset = tf.data.Dataset.from_tensor_slices((keys, labels))
+    if shuffle and tf_cache is None:
+        # shuffle the keys, not the decoded samples: the buffer holds no images and the
+        # first batch of an epoch is decoded right away
+        samples_dataset = samples_dataset.shuffle(len(keys), seed=seed, reshuffle_each_iteration=True)
+    samples_dataset = samples_dataset.map(decode_sample, num_parallel_calls=autotune)
+    if tf_cache is not None:
+        samples_dataset = samples_dataset.cache(tf_cache)
+
+    # every iteration (epoch) of the dataset starts the generator again and gets the next epoch
+    epoch_counter = itertools.count()
+
+    def next_epoch():
+        yield next(epoch_counter)
+    dataset = tf.data.Dataset.from_generator(next_epoch, tf.int64, ()).flat_map(
+        lambda epoch: samples_dataset.map(lambda *sample: sample + (epoch, )))
+    if shuffle and tf_cache is not None:
+        # the cache replays the samples in one order, shuffle them in a bounded buffer
+        dataset = dataset.shuffle(min(len(keys), shuffle_buffer), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    if augment is not None:
+        dataset = dataset.map(augment_batch, num_parallel_calls=autotune)
+    dataset = dataset.map(to_inputs_and_targets, num_parallel_calls=autotune)
+    return dataset.prefetch(autotune)
+
+def dataset_cache_dir(testX_dir, target):
+    """
+    Returns the cache directory of an ``images`` directory, e.g.
+    ``dataset/BUSI/train/images/`` -> ``dataset/BUSI/train/cache/224x224/``.
+    All folds of a split manifest share the cache next to the manifest.
+    """
+    split_dir = os.path.dirname(os.path.normpath(testX_dir))
+    return os.path.join(split_dir, 'cache', '{}x{}'.format(*target))
 
-    return data, labels, onehot_mask
+def _read_cache_index(cache_dir):
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+def build_dataset_cache(testX_dir, target=(64, 64), cache_dir=None, workers=None):
+    """
+    Builds (or incrementally updates) the preprocessed cache of an ``images/<class_name>/``
+    directory. The resized uint8 images and masks and the integer labels are stored as
+    ``.npy`` files which can be memory-mapped. Every sample is keyed by its path and the
+    mtimes of image and mask, only new or modified files are decoded again (in parallel,
+    see ``read_images``).
+
+    Returns the cache directory.
+    """
+    cache_dir = cache_dir or dataset_cache_dir(testX_dir, target)
+    samples = sorted(list_clas_seg_samples(testX_dir, shuffle=False, with_masks=True))
+    entries = []
+    for img_path, mask_path, class_name in samples:
+        entries.append({'path': img_path,
+                        'mask_path': mask_path,
+                        'label': class_name,
+                        'mtime': os.path.getmtime(img_path),
+                        'mask_mtime': os.path.getmtime(mask_path)})
+
+    old_index = _read_cache_index(cache_dir)
+    if old_index is not None and old_index['target'] != list(target):
+        old_index = None
+    if old_index is not None and old_index['samples'] == entries:
+        return cache_dir
+
+    old_rows = {}
+    if old_index is not None:
+        old_images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+        old_masks = np.load(os.path.join(cache_dir, 'masks.npy'), mmap_mode='r')
+        old_rows = {(e['path'], e['mtime'], e['mask_mtime']): row
+                    for row, e in enumerate(old_index['samples'])}
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    classes = sorted(set(e['label'] for e in entries))
+    width, height = target
+    shape = (len(entries), height, width, 3)
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy.tmp'),
+                                       mode='w+', dtype=np.uint8, shape=shape)
+    masks = np.lib.format.open_memmap(os.path.join(cache_dir, 'masks.npy.tmp'),
+                                      mode='w+', dtype=np.uint8, shape=shape)
+    labels = np.empty(len(entries), dtype=np.int64)
+
+    decode_rows = []
+    for i, e in enumerate(entries):
+        row = old_rows.get((e['path'], e['mtime'], e['mask_mtime']))
+        if row is not None:
+            images[i] = old_images[row]
+            masks[i] = old_masks[row]
+        else:
+            decode_rows.append(i)
+        labels[i] = classes.index(e['label'])
+    read_images([entries[i]['path'] for i in decode_rows], target, workers=workers,
+                out=images, rows=decode_rows)
+    read_images([entries[i]['mask_path'] for i in decode_rows], target, workers=workers,
+                out=masks, rows=decode_rows)
+    print("cache {}: decoded {} of {} samples".format(cache_dir, len(decode_rows), len(entries)))
+
+    images.flush()
+    masks.flush()
+    del images, masks
+    if old_rows:
+        del old_images, old_masks
+    # the old index does not describe the new rows, remove it before replacing any file.
+    # The new index is swapped in last, an interrupted build has no index and is rebuilt
+    index_path = os.path.join(cache_dir, 'index.json')
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    os.replace(os.path.join(cache_dir, 'images.npy.tmp'), os.path.join(cache_dir, 'images.npy'))
+    os.replace(os.path.join(cache_dir, 'masks.npy.tmp'), os.path.join(cache_dir, 'masks.npy'))
+    np.save(os.path.join(cache_dir, 'labels.npy'), labels)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'target': list(target), 'classes': classes, 'samples': entries}, f)
+    os.replace(index_path + '.tmp', index_path)
+    return cache_dir
+
+def load_dataset_cache(testX_dir, target=(64, 64), cache_dir=None, update=True):
+    """
+    Returns ``(images, masks, labels, index)`` of the preprocessed cache. ``images`` and
+    ``masks`` are read-only uint8 memory maps (zero-copy), ``labels`` are indices into
+    ``index['classes']`` and ``index['samples']`` describes every row.
+    If ``update`` is set, the cache is built or updated first.
+    """
+    if update:
+        cache_dir = build_dataset_cache(testX_dir, target, cache_dir)
+    cache_dir = cache_dir or dataset_cache_dir(testX_dir, target)
+    images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+    masks = np.load(os.path.join(cache_dir, 'masks.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+    index = _read_cache_index(cache_dir)
+    if index is None:
+        raise IOError('the dataset cache {} is incomplete, build it again'.format(cache_dir))
+    return images, masks, labels, index
+
+def _read_clas_seg_cache(testX_dir, target, shuffle, seed=None, folds=None):
+    """
+    Reads the samples of ``testX_dir`` from the cache in the order of
+    ``list_clas_seg_samples``. Returns uint8 images, class names, uint8 masks and the samples.
+    """
+    images, masks, _, index = load_dataset_cache(testX_dir, target)
+    rows = {e['path']: row for row, e in enumerate(index['samples'])}
+    samples = list_clas_seg_samples(testX_dir, shuffle, seed, folds)
+    sample_rows = np.array([rows[img_path] for img_path, _ in samples], dtype=np.int64)
+    labels = np.array([class_name for _, class_name in samples])
+    return images[sample_rows], labels, masks[sample_rows], samples
+
+def mask_to_labels(mask, palette, scale=1):
+    """
+    Converts a segmentation mask (..., H, W, C) to integer labels (..., H, W) in one pass.
+    A pixel has label ``k`` if all its channels equal ``k * scale`` and ``-1`` otherwise,
+    i.e. where the one hot encoding of ``mask_to_onehot`` is all zero.
 
-def mask_to_onehot(mask, palette):
+    Args:
+        scale: channel value of label 1, e.g. 255 for the raw 0/255 uint8 masks,
+            which is equivalent to comparing ``mask / 255.0``.
+    """
+    first = mask[..., 0]
+    if mask.dtype == np.uint8:
+        lut = np.full(256, -1, dtype=np.int8)
+        for colour in range(palette):
+            if colour * scale < 256:
+                lut[colour * scale] = colour
+        labels = lut[first]
+    else:
+        value = first / scale
+        is_label = (value == np.rint(value)) & (value >= 0) & (value < palette)
+        labels = np.where(is_label, value, -1).astype(np.int8)
+    for channel in range(1, mask.shape[-1]):
+        labels[mask[..., channel] != first] = -1
+    return labels
+
+def mask_to_onehot(mask, palette, out=None, dtype=np.float32, packed=False, scale=1):
     """
     Converts a segmentation mask (H, W, C) to (H, W, K) where the last dim is a one
     hot encoding vector, C is usually 1 or 3, and K is the number of class.
+    Masks can have any leading batch dimensions.
+
+    Args:
+        out: write the one hot encoding into this array.
+        dtype: dtype of the result if ``out`` is not given.
+        packed: return the encoding bit-packed along the last axis
+            (``np.unpackbits(x, axis=-1, count=K)`` restores the bool array).
+        scale: channel value of label 1, 255 for the raw 0/255 uint8 masks.
     """
-    semantic_map = []
-    for colour in range(palette):
-        equality = np.equal(mask, colour)
-        class_map = np.all(equality, axis=-1)
-        semantic_map.append(class_map)
-    semantic_map = np.stack(semantic_map, axis=-1).astype(np.float32)
-    return semantic_map
-
-def onehot_to_mask(mask, palette):
+    labels = mask_to_labels(mask, palette, scale)
+    if out is None:
+        out = np.empty(labels.shape + (palette,), dtype=bool if packed else dtype)
+    np.equal(labels[..., None], np.arange(palette, dtype=labels.dtype), out=out, casting='unsafe')
+    if packed:
+        return np.packbits(out, axis=-1)
+    return out
+
+def onehot_to_mask(mask, palette, out=None):
     """
     Converts a mask (H, W, K) to (H, W, C)
     """
     x = np.argmax(mask, axis=-1)
     colour_codes = np.array(palette)
-    x = np.uint8(colour_codes[x.astype(np.uint8)])
-    return x
+    return np.take(colour_codes.astype(np.uint8), x, axis=0, out=out)
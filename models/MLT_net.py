@@ -29,7 +29,7 @@ def MTL_classic(input_width, input_height, depth, nClasses):
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
     c = Activation('relu', name='cls_act_4')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
 
     # segmentation branch
     o = backbone.get_layer(name="block5_conv3").output
@@ -62,7 +62,7 @@ def MTL_classic(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     o = Conv2D(nClasses, (1, 1), padding="same")(o)
     o = Activation("relu")(o)
-    s = Activation("softmax", name='segmentation_output')(o)
+    s = Activation("softmax", name='segmentation_output', dtype='float32')(o)
 
     return Model(inputs=backbone.inputs, outputs=[c, s])
 
@@ -111,7 +111,7 @@ def MTL_classic2(input_width, input_height, depth, nClasses):
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
 #     c = Activation('relu', name='cls_act_4')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
 
     
 
@@ -154,7 +154,7 @@ def MTL_classic2(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
+    s = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
 
     return Model(inputs=[clas_input,seg_input], outputs=[c, s], name='Multi_task_VGG16')
 
@@ -221,7 +221,7 @@ def MTL_3(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     o = x
@@ -273,8 +273,8 @@ def MTL_3(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -342,7 +342,7 @@ def MTL_3_2(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     o = x
@@ -394,8 +394,8 @@ def MTL_3_2(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -462,7 +462,7 @@ def MTL_3_2_IBA(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     o = x
@@ -514,8 +514,8 @@ def MTL_3_2_IBA(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -652,7 +652,7 @@ def MTL3_interaction(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     
     # segmentation branch
@@ -726,16 +726,18 @@ def MTL3_interaction(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
 
 
-def create_pair_model(input_width, input_height, depth, nClasses):
+def create_pair_model(input_width, input_height, depth, nClasses, single_input=False):
+    # single_input: only cls_input, the shared layers run once and feed both heads
     cls_input = Input(shape=(input_width, input_height, 3), name='cls_input')
-    seg_input = Input(shape=(input_width, input_height, 3), name='seg_input')
+    if not single_input:
+        seg_input = Input(shape=(input_width, input_height, 3), name='seg_input')
     # assume cls_input is the same as seg_input
     # shared layers
     # block 1
@@ -809,15 +811,15 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x_1 = shared3(x_1)
     x_1 = shared4(x_1)
     x_1 = shared5(x_1)
-    x_1 = shared6(x_1)
-    x_1 = shared7(x_1)
+    cls_block_1_out = shared6(x_1)
+    x_1 = shared7(cls_block_1_out)
     x_1 = shared8(x_1)
     x_1 = shared9(x_1)
     x_1 = shared10(x_1)
     x_1 = shared11(x_1)
     x_1 = shared12(x_1)
-    x_1 = shared13(x_1)
-    x_1 = shared14(x_1)
+    cls_block_2_out = shared13(x_1)
+    x_1 = shared14(cls_block_2_out)
     x_1 = shared15(x_1)
     x_1 = shared16(x_1)
     x_1 = shared17(x_1)
@@ -826,8 +828,8 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x_1 = shared20(x_1)
     x_1 = shared21(x_1)
     x_1 = shared22(x_1)
-    x_1 = shared23(x_1)
-    x_1 = shared24(x_1)
+    cls_block_3_out = shared23(x_1)
+    x_1 = shared24(cls_block_3_out)
     x_1 = shared25(x_1)
     x_1 = shared26(x_1)
     x_1 = shared27(x_1)
@@ -836,8 +838,8 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x_1 = shared30(x_1)
     x_1 = shared31(x_1)
     x_1 = shared32(x_1)
-    x_1 = shared33(x_1)
-    x_1 = shared34(x_1)
+    cls_block_4_out = shared33(x_1)
+    x_1 = shared34(cls_block_4_out)
     x_1 = shared35(x_1)
     x_1 = shared36(x_1)
     x_1 = shared37(x_1)
@@ -855,53 +857,59 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x = Activation('relu', name='cls_act_0')(x)
     x = Dropout(0.5, name='dropout')(x)
     x = Dense(2, name='dense_1')(x)
-    out_cls = Activation('sigmoid', name='classification_output')(x)
+    out_cls = Activation('sigmoid', name='classification_output', dtype='float32')(x)
 
     # seg net
-    x_2 = shared1(seg_input)
-    x_2 = shared2(x_2)
-    x_2 = shared3(x_2)
-    x_2 = shared4(x_2)
-    x_2 = shared5(x_2)
-    block_1_out = shared6(x_2)
-    x_2 = shared7(block_1_out)
-    x_2 = shared8(x_2)
-    x_2 = shared9(x_2)
-    x_2 = shared10(x_2)
-    x_2 = shared11(x_2)
-    x_2 = shared12(x_2)
-    block_2_out = shared13(x_2)
-    x_2 = shared14(block_2_out)
-    x_2 = shared15(x_2)
-    x_2 = shared16(x_2)
-    x_2 = shared17(x_2)
-    x_2 = shared18(x_2)
-    x_2 = shared19(x_2)
-    x_2 = shared20(x_2)
-    x_2 = shared21(x_2)
-    x_2 = shared22(x_2)
-    block_3_out = shared23(x_2)
-    x_2 = shared24(block_3_out)
-    x_2 = shared25(x_2)
-    x_2 = shared26(x_2)
-    x_2 = shared27(x_2)
-    x_2 = shared28(x_2)
-    x_2 = shared29(x_2)
-    x_2 = shared30(x_2)
-    x_2 = shared31(x_2)
-    x_2 = shared32(x_2)
-    block_4_out = shared33(x_2)
-    x_2 = shared34(block_4_out)
-    x_2 = shared35(x_2)
-    x_2 = shared36(x_2)
-    x_2 = shared37(x_2)
-    x_2 = shared38(x_2)
-    x_2 = shared39(x_2)
-    x_2 = shared40(x_2)
-    x_2 = shared41(x_2)
-    x_2 = shared42(x_2)
-    x_2 = shared43(x_2)
-    conv1_seg = x_2
+    if single_input:
+        # the shared trunk already ran on the same image, the decoder reuses its block outputs
+        block_1_out, block_2_out, block_3_out, block_4_out = \
+            cls_block_1_out, cls_block_2_out, cls_block_3_out, cls_block_4_out
+        conv1_seg = conv1_cls
+    else:
+        x_2 = shared1(seg_input)
+        x_2 = shared2(x_2)
+        x_2 = shared3(x_2)
+        x_2 = shared4(x_2)
+        x_2 = shared5(x_2)
+        block_1_out = shared6(x_2)
+        x_2 = shared7(block_1_out)
+        x_2 = shared8(x_2)
+        x_2 = shared9(x_2)
+        x_2 = shared10(x_2)
+        x_2 = shared11(x_2)
+        x_2 = shared12(x_2)
+        block_2_out = shared13(x_2)
+        x_2 = shared14(block_2_out)
+        x_2 = shared15(x_2)
+        x_2 = shared16(x_2)
+        x_2 = shared17(x_2)
+        x_2 = shared18(x_2)
+        x_2 = shared19(x_2)
+        x_2 = shared20(x_2)
+        x_2 = shared21(x_2)
+        x_2 = shared22(x_2)
+        block_3_out = shared23(x_2)
+        x_2 = shared24(block_3_out)
+        x_2 = shared25(x_2)
+        x_2 = shared26(x_2)
+        x_2 = shared27(x_2)
+        x_2 = shared28(x_2)
+        x_2 = shared29(x_2)
+        x_2 = shared30(x_2)
+        x_2 = shared31(x_2)
+        x_2 = shared32(x_2)
+        block_4_out = shared33(x_2)
+        x_2 = shared34(block_4_out)
+        x_2 = shared35(x_2)
+        x_2 = shared36(x_2)
+        x_2 = shared37(x_2)
+        x_2 = shared38(x_2)
+        x_2 = shared39(x_2)
+        x_2 = shared40(x_2)
+        x_2 = shared41(x_2)
+        x_2 = shared42(x_2)
+        x_2 = shared43(x_2)
+        conv1_seg = x_2
 
 
     # UP 1
@@ -961,10 +969,10 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x = Activation('relu')(x)
 
     # last conv
-    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output')(x)
+    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output', dtype='float32')(x)
     # out_seg = Activation(activation='softmax', name='seg-out')(conv10)
 
-    model = Model(inputs=[cls_input, seg_input], outputs=[out_cls, out_seg])
+    model = Model(inputs=cls_input if single_input else [cls_input, seg_input], outputs=[out_cls, out_seg])
 
 
     return model
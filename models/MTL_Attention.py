@@ -242,7 +242,7 @@ def MTL_Attention_model(input_width, input_height, depth, nClasses, ):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     # segmentation block 4
@@ -311,8 +311,8 @@ def MTL_Attention_model(input_width, input_height, depth, nClasses, ):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -72,7 +72,7 @@ def MTL_IBA(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     o = x
@@ -124,8 +124,8 @@ def MTL_IBA(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -183,7 +183,7 @@ def MTL_IBA_h3(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     # segmentation block 4
@@ -235,8 +235,8 @@ def MTL_IBA_h3(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -294,7 +294,7 @@ def MTL_IBA_cross(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     # segmentation block 4
@@ -359,8 +359,8 @@ def MTL_IBA_cross(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -418,7 +418,7 @@ def MTL_IBA_cross2(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     # segmentation branch
     # segmentation block 4
@@ -488,8 +488,8 @@ def MTL_IBA_cross2(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='Multi_task_VGG16')
@@ -546,7 +546,7 @@ def MTL_IBA_cross3(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     clas_branch = Model(inputs=clas_input, outputs=c, name='clas_branch')
 #     clas_branch.load_weights("MTL_IBA_cross3_pretrain.h5", by_name=True)
@@ -621,8 +621,8 @@ def MTL_IBA_cross3(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(2, (3, 3), activation='sigmoid', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(2, (3, 3), activation='sigmoid', padding='same',name='seg-out')(o)
+    s1 = Conv2D(2, (3, 3), activation='sigmoid', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(2, (3, 3), activation='sigmoid', padding='same',name='seg-out', dtype='float32')(o)
 
         # shared feature extraction module: backbone
 #     seg_branch = Model(inputs=clas_input, outputs=x)
@@ -680,7 +680,7 @@ def MTL_IBA_cross3_pretrain(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
 #     clas_branch = Model(inputs=clas_input, outputs=block5_c_pool, name='clas_branch')
 # #     clas_branch.load_weights("MTL_IBA_cross3_pretrain.h5", by_name=True)
@@ -756,8 +756,8 @@ def MTL_IBA_cross3_pretrain(input_width, input_height, depth, nClasses):
     o = Activation('relu')(o)
     
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='sigmoid', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='sigmoid', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
     
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='MTL_IBA_cross3_pretrain')
@@ -876,13 +876,13 @@ def MTL_IBA_s2c(input_width, input_height, depth, nClasses):
     c = Activation('relu', name='cls_act_3')(c)
     c = Dropout(0.5, name='cls_dropout')(c)
     c = Dense(2, name='cls_dense_out')(c)
-    c = Activation('sigmoid', name='classification_output')(c)
+    c = Activation('sigmoid', name='classification_output', dtype='float32')(c)
     
     
     # segmentation branch
     # last conv
-    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output')(o)
-    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out')(o)
+    s1 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='segmentation_output', dtype='float32')(o)
+    s2 = Conv2D(nClasses, (3, 3), activation='softmax', padding='same',name='seg-out', dtype='float32')(o)
 
 
     return Model(inputs=clas_input, outputs=[c, s1, s2], name='MTL_IBA_s2c')
\ No newline at end of file
@@ -10,11 +10,13 @@ def binary_crossentropy(y_true, y_pred):
                   axis=-1)
 
 
-def create_pair_model(input_width, input_height, depth, nClasses):
+def create_pair_model(input_width, input_height, depth, nClasses, single_input=False):
+    # single_input: only cls_input, the shared layers run once and feed both heads
     
 #     img_input = Input(shape=(input_height, input_width, 3), name='input')
     cls_input = Input(shape=(input_height, input_width, 3), name='cls_input')
-    seg_input = Input(shape=(input_height, input_width, 3), name='seg_input')
+    if not single_input:
+        seg_input = Input(shape=(input_height, input_width, 3), name='seg_input')
     # assume cls_input is the same as seg_input
     # shared layers
     # block 1
@@ -141,53 +143,57 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x = Activation('relu', name='cls_act_3')(x)
     x = Dropout(0.5, name='cls_dropout')(x)
     x = Dense(2, name='cls_dense_out')(x)
-    out_cls = Activation('sigmoid', name='classification_output')(x)
+    out_cls = Activation('sigmoid', name='classification_output', dtype='float32')(x)
 
     # seg net
-    x_2 = shared1(seg_input)
-    x_2 = shared2(x_2)
-    x_2 = shared3(x_2)
-    x_2 = shared4(x_2)
-    x_2 = shared5(x_2)
-    block_1_out = shared6(x_2)
-    x_2 = shared7(block_1_out)
-    x_2 = shared8(x_2)
-    x_2 = shared9(x_2)
-    x_2 = shared10(x_2)
-    x_2 = shared11(x_2)
-    x_2 = shared12(x_2)
-    block_2_out = shared13(x_2)
-    x_2 = shared14(block_2_out)
-    x_2 = shared15(x_2)
-    x_2 = shared16(x_2)
-    x_2 = shared17(x_2)
-    x_2 = shared18(x_2)
-    x_2 = shared19(x_2)
-    x_2 = shared20(x_2)
-    x_2 = shared21(x_2)
-    x_2 = shared22(x_2)
-    block_3_out = shared23(x_2)
-    x_2 = shared24(block_3_out)
-    x_2 = shared25(x_2)
-    x_2 = shared26(x_2)
-    x_2 = shared27(x_2)
-    x_2 = shared28(x_2)
-    x_2 = shared29(x_2)
-    x_2 = shared30(x_2)
-    x_2 = shared31(x_2)
-    x_2 = shared32(x_2)
-    block_4_out = shared33(x_2)
-    x_2 = shared34(block_4_out)
-    x_2 = shared35(x_2)
-    x_2 = shared36(x_2)
-    x_2 = shared37(x_2)
-    x_2 = shared38(x_2)
-    x_2 = shared39(x_2)
-    x_2 = shared40(x_2)
-    x_2 = shared41(x_2)
-    x_2 = shared42(x_2)
-    x_2 = shared43(x_2)
-    conv1_seg = x_2
+    if single_input:
+        # the shared trunk already ran on the same image, the decoder reuses its block outputs
+        conv1_seg = block_5_out
+    else:
+        x_2 = shared1(seg_input)
+        x_2 = shared2(x_2)
+        x_2 = shared3(x_2)
+        x_2 = shared4(x_2)
+        x_2 = shared5(x_2)
+        block_1_out = shared6(x_2)
+        x_2 = shared7(block_1_out)
+        x_2 = shared8(x_2)
+        x_2 = shared9(x_2)
+        x_2 = shared10(x_2)
+        x_2 = shared11(x_2)
+        x_2 = shared12(x_2)
+        block_2_out = shared13(x_2)
+        x_2 = shared14(block_2_out)
+        x_2 = shared15(x_2)
+        x_2 = shared16(x_2)
+        x_2 = shared17(x_2)
+        x_2 = shared18(x_2)
+        x_2 = shared19(x_2)
+        x_2 = shared20(x_2)
+        x_2 = shared21(x_2)
+        x_2 = shared22(x_2)
+        block_3_out = shared23(x_2)
+        x_2 = shared24(block_3_out)
+        x_2 = shared25(x_2)
+        x_2 = shared26(x_2)
+        x_2 = shared27(x_2)
+        x_2 = shared28(x_2)
+        x_2 = shared29(x_2)
+        x_2 = shared30(x_2)
+        x_2 = shared31(x_2)
+        x_2 = shared32(x_2)
+        block_4_out = shared33(x_2)
+        x_2 = shared34(block_4_out)
+        x_2 = shared35(x_2)
+        x_2 = shared36(x_2)
+        x_2 = shared37(x_2)
+        x_2 = shared38(x_2)
+        x_2 = shared39(x_2)
+        x_2 = shared40(x_2)
+        x_2 = shared41(x_2)
+        x_2 = shared42(x_2)
+        x_2 = shared43(x_2)
+        conv1_seg = x_2
     
  # UP 1
     x = Conv2DTranspose(512, (2, 2), strides=(2, 2), padding='same')(conv1_seg)
@@ -246,11 +252,11 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x = Activation('relu')(x)
 
     # last conv
-    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output')(x)
-    out_seg2 = Conv2D(2, (3, 3), activation='softmax', padding='same', name='seg-out')(x)
+    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output', dtype='float32')(x)
+    out_seg2 = Conv2D(2, (3, 3), activation='softmax', padding='same', name='seg-out', dtype='float32')(x)
     # out_seg = Activation(activation='softmax', name='seg-out')(conv10)
 
-    model = Model(inputs=[cls_input,seg_input], outputs=[out_cls, out_seg, out_seg2])
+    model = Model(inputs=cls_input if single_input else [cls_input,seg_input], outputs=[out_cls, out_seg, out_seg2])
     
 
 
@@ -177,7 +177,7 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     x = Activation('relu')(x)
 
     # last conv
-    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output')(x)
+    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output', dtype='float32')(x)
     # out_seg = Activation(activation='softmax', name='seg-out')(conv10)
     
     # cls net
@@ -235,7 +235,7 @@ def create_pair_model(input_width, input_height, depth, nClasses):
     cls = Activation('relu', name='cls_act_3')(cls)
     cls = Dropout(0.5, name='cls_dropout')(cls)
     cls = Dense(2, name='cls_dense_out')(cls)
-    out_cls = Activation('sigmoid', name='classification_output')(cls)
+    out_cls = Activation('sigmoid', name='classification_output', dtype='float32')(cls)
     
 
 
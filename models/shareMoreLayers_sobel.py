@@ -21,16 +21,19 @@ def modified_sobel(image):
     output = tf.sqrt(tf.add(tf.square(filtered_x), tf.square(filtered_y)))
     return output
 
-def create_pair_model(img_height, img_width, depth, nClasses=2):
+def create_pair_model(img_height, img_width, depth, nClasses=2, single_input=False):
+    # single_input: only cls_input, the shared layers run once and feed both heads
     
     seg_loss_weight=0.5
     cls_loss_weight=0.5
     cls_input = Input(shape=(img_height, img_width, 3), name='cls_input')
-    seg_input = Input(shape=(img_height, img_width, 3), name='seg_input')
+    if not single_input:
+        seg_input = Input(shape=(img_height, img_width, 3), name='seg_input')
     cls_input_sobel = Lambda(lambda x: modified_sobel(x))(cls_input)
     cls_input_new = multiply([cls_input, cls_input_sobel])
-    seg_input_sobel = Lambda(lambda x: modified_sobel(x))(seg_input)
-    seg_input_new = multiply([seg_input, seg_input_sobel])
+    if not single_input:
+        seg_input_sobel = Lambda(lambda x: modified_sobel(x))(seg_input)
+        seg_input_new = multiply([seg_input, seg_input_sobel])
     # assume cls_input is the same as seg_input
     # shared layers
     # block 1
@@ -105,15 +108,15 @@ def create_pair_model(img_height, img_width, depth, nClasses=2):
     x_1 = shared3(x_1)
     x_1 = shared4(x_1)
     x_1 = shared5(x_1)
-    x_1 = shared6(x_1)
-    x_1 = shared7(x_1)
+    cls_block_1_out = shared6(x_1)
+    x_1 = shared7(cls_block_1_out)
     x_1 = shared8(x_1)
     x_1 = shared9(x_1)
     x_1 = shared10(x_1)
     x_1 = shared11(x_1)
     x_1 = shared12(x_1)
-    x_1 = shared13(x_1)
-    x_1 = shared14(x_1)
+    cls_block_2_out = shared13(x_1)
+    x_1 = shared14(cls_block_2_out)
     x_1 = shared15(x_1)
     x_1 = shared16(x_1)
     x_1 = shared17(x_1)
@@ -122,8 +125,8 @@ def create_pair_model(img_height, img_width, depth, nClasses=2):
     x_1 = shared20(x_1)
     x_1 = shared21(x_1)
     x_1 = shared22(x_1)
-    x_1 = shared23(x_1)
-    x_1 = shared24(x_1)
+    cls_block_3_out = shared23(x_1)
+    x_1 = shared24(cls_block_3_out)
     x_1 = shared25(x_1)
     x_1 = shared26(x_1)
     x_1 = shared27(x_1)
@@ -132,8 +135,8 @@ def create_pair_model(img_height, img_width, depth, nClasses=2):
     x_1 = shared30(x_1)
     x_1 = shared31(x_1)
     x_1 = shared32(x_1)
-    x_1 = shared33(x_1)
-    x_1 = shared34(x_1)
+    cls_block_4_out = shared33(x_1)
+    x_1 = shared34(cls_block_4_out)
     x_1 = shared35(x_1)
     x_1 = shared36(x_1)
     x_1 = shared37(x_1)
@@ -142,8 +145,8 @@ def create_pair_model(img_height, img_width, depth, nClasses=2):
     x_1 = shared40(x_1)
     x_1 = shared41(x_1)
     x_1 = shared42(x_1)
-    x_1 = shared43(x_1)
-    x_1 = shared44(x_1)
+    cls_block_5_out = shared43(x_1)
+    x_1 = shared44(cls_block_5_out)
     conv1_cls = x_1
     
     x = Flatten(name='cls_flatten')(conv1_cls)
@@ -151,54 +154,60 @@ def create_pair_model(img_height, img_width, depth, nClasses=2):
     x = Activation('relu', name='cls_act_3')(x)
     x = Dropout(0.5, name='cls_dropout')(x)
     x = Dense(2, name='cls_dense_out')(x)
-    out_cls = Activation('sigmoid', name='classification_output')(x)
+    out_cls = Activation('sigmoid', name='classification_output', dtype='float32')(x)
 
     # seg net
-    x_2 = shared1(seg_input_new)
-    x_2 = shared2(x_2)
-    x_2 = shared3(x_2)
-    x_2 = shared4(x_2)
-    x_2 = shared5(x_2)
-    block_1_out = shared6(x_2)
-    x_2 = shared7(block_1_out)
-    x_2 = shared8(x_2)
-    x_2 = shared9(x_2)
-    x_2 = shared10(x_2)
-    x_2 = shared11(x_2)
-    x_2 = shared12(x_2)
-    block_2_out = shared13(x_2)
-    x_2 = shared14(block_2_out)
-    x_2 = shared15(x_2)
-    x_2 = shared16(x_2)
-    x_2 = shared17(x_2)
-    x_2 = shared18(x_2)
-    x_2 = shared19(x_2)
-    x_2 = shared20(x_2)
-    x_2 = shared21(x_2)
-    x_2 = shared22(x_2)
-    block_3_out = shared23(x_2)
-    x_2 = shared24(block_3_out)
-    x_2 = shared25(x_2)
-    x_2 = shared26(x_2)
-    x_2 = shared27(x_2)
-    x_2 = shared28(x_2)
-    x_2 = shared29(x_2)
-    x_2 = shared30(x_2)
-    x_2 = shared31(x_2)
-    x_2 = shared32(x_2)
-    block_4_out = shared33(x_2)
-    x_2 = shared34(block_4_out)
-    x_2 = shared35(x_2)
-    x_2 = shared36(x_2)
-    x_2 = shared37(x_2)
-    x_2 = shared38(x_2)
-    x_2 = shared39(x_2)
-    x_2 = shared40(x_2)
-    x_2 = shared41(x_2)
-    x_2 = shared42(x_2)
-    x_2 = shared43(x_2)
-    # x_2 = shared44(x_2)
-    conv1_seg = x_2
+    if single_input:
+        # the shared trunk already ran on the same image, the decoder reuses its block outputs
+        block_1_out, block_2_out, block_3_out, block_4_out = \
+            cls_block_1_out, cls_block_2_out, cls_block_3_out, cls_block_4_out
+        conv1_seg = cls_block_5_out
+    else:
+        x_2 = shared1(seg_input_new)
+        x_2 = shared2(x_2)
+        x_2 = shared3(x_2)
+        x_2 = shared4(x_2)
+        x_2 = shared5(x_2)
+        block_1_out = shared6(x_2)
+        x_2 = shared7(block_1_out)
+        x_2 = shared8(x_2)
+        x_2 = shared9(x_2)
+        x_2 = shared10(x_2)
+        x_2 = shared11(x_2)
+        x_2 = shared12(x_2)
+        block_2_out = shared13(x_2)
+        x_2 = shared14(block_2_out)
+        x_2 = shared15(x_2)
+        x_2 = shared16(x_2)
+        x_2 = shared17(x_2)
+        x_2 = shared18(x_2)
+        x_2 = shared19(x_2)
+        x_2 = shared20(x_2)
+        x_2 = shared21(x_2)
+        x_2 = shared22(x_2)
+        block_3_out = shared23(x_2)
+        x_2 = shared24(block_3_out)
+        x_2 = shared25(x_2)
+        x_2 = shared26(x_2)
+        x_2 = shared27(x_2)
+        x_2 = shared28(x_2)
+        x_2 = shared29(x_2)
+        x_2 = shared30(x_2)
+        x_2 = shared31(x_2)
+        x_2 = shared32(x_2)
+        block_4_out = shared33(x_2)
+        x_2 = shared34(block_4_out)
+        x_2 = shared35(x_2)
+        x_2 = shared36(x_2)
+        x_2 = shared37(x_2)
+        x_2 = shared38(x_2)
+        x_2 = shared39(x_2)
+        x_2 = shared40(x_2)
+        x_2 = shared41(x_2)
+        x_2 = shared42(x_2)
+        x_2 = shared43(x_2)
+        # x_2 = shared44(x_2)
+        conv1_seg = x_2
 
 
     # UP 1
@@ -258,10 +267,10 @@ def create_pair_model(img_height, img_width, depth, nClasses=2):
     x = Activation('relu')(x)
 
     # last conv
-    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output')(x)
+    out_seg = Conv2D(2, (3, 3), activation='softmax', padding='same', name='segmentation_output', dtype='float32')(x)
     # out_seg = Activation(activation='softmax', name='seg-out')(conv10)
 
-    model = Model(inputs=[cls_input, seg_input], outputs=[out_cls, out_seg])
+    model = Model(inputs=cls_input if single_input else [cls_input, seg_input], outputs=[out_cls, out_seg])
 
     # layer = Layer
     # idx = 0
@@ -1,39 +1,82 @@
 import os
 import pydicom       #用于读取DICOM(DCOM)文件
+from pydicom.pixel_data_handlers.util import apply_voi_lut
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import argparse
-import scipy.misc
-# import scipy.misc    #用imageio替代
-import imageio
+import cv2
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--origin', type=str, default='F:\\1_数据集\\公开乳腺癌数据集\\INbreast\\AllDICOMs', help='train photos')
-    parser.add_argument('--JPG', type=str, default='F:\\1_数据集\\公开乳腺癌数据集\\INbreast\\JPG', help='test photos')
-    opt=parser.parse_args()
-    print(opt)
+def dicom_to_uint8(path, max_size=None):
+    """
+    Reads a DICOM file and returns its pixels windowed with the VOI LUT (or the
+    window center/width) of the file, scaled to uint8. MONOCHROME1 images are inverted.
 
-    #imgway_1为源文件夹
-    #imgway_2为jpg文件夹
-    imgway_1=opt.origin
-    imgway_2 = opt.JPG
+    Args:
+        path: the DICOM file.
+        max_size: downscale the image so its longer side is at most ``max_size``.
+    """
+    ds = pydicom.dcmread(path)
+    img = apply_voi_lut(ds.pixel_array, ds).astype(np.float32)
+    if ds.get('PhotometricInterpretation') == 'MONOCHROME1':
+        img = img.max() - img
+    img -= img.min()
+    if img.max() > 0:
+        img *= 255.0 / img.max()
+    img = img.astype(np.uint8)
 
-    i=0
+    if max_size and max(img.shape[:2]) > max_size:
+        scale = max_size / float(max(img.shape[:2]))
+        size = (int(round(img.shape[1] * scale)), int(round(img.shape[0] * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return img
 
-    for filename in os.listdir(r"%s" % imgway_1):
+def convert_file(src, dst, max_size=None, force=False):
+    """
+    Converts ``src`` to ``dst``, the format is given by the extension of ``dst``.
+    Returns False if ``dst`` is newer than ``src`` and was not converted again.
+    """
+    if not force and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return False
+    img = dicom_to_uint8(src, max_size)
+    # 先写临时文件, 中断的转换不会被当作已完成
+    tmp = dst + '.tmp' + os.path.splitext(dst)[1]
+    if not cv2.imwrite(tmp, img):
+        raise IOError('could not write %s' % dst)
+    os.replace(tmp, dst)
+    return True
 
-        # name = str(i)
-        name=filename[:-4]
-        ds = pydicom.read_file("%s/%s" % (imgway_1, filename))          #读取文件
-        img = ds.pixel_array
+def convert_dir(origin, output, ext='.png', max_size=None, workers=None, force=False):
+    """
+    Converts all DICOM files of ``origin`` to ``output`` with a process pool.
+    The output is named after the part of the file name before the first ``_``
+    (the INbreast file id). Returns the number of converted and skipped files.
+    """
+    if not os.path.exists(output):
+        os.makedirs(output)
+    srcs, dsts = [], []
+    for filename in sorted(os.listdir(origin)):
+        if not filename.lower().endswith('.dcm'):
+            continue
+        srcs.append(os.path.join(origin, filename))
+        dsts.append(os.path.join(output, filename[:-4].split("_")[0] + ext))
 
-        # path1 = os.path.join(imgway_1, filename)
-        short_name = name.split("_")[0]+'.jpg'
-        path2 = os.path.join(imgway_2, short_name)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        converted = list(executor.map(convert_file, srcs, dsts, [max_size] * len(srcs), [force] * len(srcs),
+                                      chunksize=4))
+    return sum(converted), len(converted) - sum(converted)
 
-        imageio.imwrite(path2, img)
 
-        # os.rename(path1, path2)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--origin', type=str, default='F:\\1_数据集\\公开乳腺癌数据集\\INbreast\\AllDICOMs', help='DICOM directory')
+    parser.add_argument('--JPG', type=str, default='F:\\1_数据集\\公开乳腺癌数据集\\INbreast\\JPG', help='output directory')
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'jpg'], help='png is lossless')
+    parser.add_argument('--max-size', type=int, default=None, help='downscale the longer side to this size')
+    parser.add_argument('--workers', type=int, default=None, help='processes, defaults to the number of CPUs')
+    parser.add_argument('--force', action='store_true', help='convert files with an up to date output again')
+    opt=parser.parse_args()
+    print(opt)
 
-        # if i==410:      #转换410张
-        #     break
+    converted, skipped = convert_dir(opt.origin, opt.JPG, '.' + opt.format, opt.max_size, opt.workers, opt.force)
+    print('converted %d files, %d were up to date' % (converted, skipped))
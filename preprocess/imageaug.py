@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 import cv2
 from imgaug import augmenters as iaa
+from imgaug.augmentables.segmaps import SegmentationMapsOnImage
+import numpy as np
+import argparse
 import os
  
 # Sometimes(0.5, ...) applies the given augmenter in 50% of all cases,
@@ -84,25 +87,78 @@ seq = iaa.Sequential([
     )
 ],random_order=True) #apply augmenters in random order
 
-path = 'E:\\Multi-task IBA\\dataset\INbreast\\train\\images\\benign_images\\'
-savedpath = 'E:\\Multi-task IBA\\dataset\\INbreast\\train\\images\\benign_images\\'
-if not os.path.exists(savedpath):
-    os.mkdir(savedpath)
+# mask pixels are 0 (background), 255 (lesion) or anything else after resizing,
+# they are augmented as the classes 0, 1 and 2 so the latter stay "no class"
+_MASK_VALUES = np.array([0, 255, 128], dtype=np.uint8)
 
-imglist=[]
-filelist = os.listdir(path)
+def _mask_to_segmap(mask):
+    segmap = np.full(mask.shape[:2], 2, dtype=np.int32)
+    segmap[np.all(mask == 0, axis=-1)] = 0
+    segmap[np.all(mask == 255, axis=-1)] = 1
+    return SegmentationMapsOnImage(segmap, shape=mask.shape)
 
-for i in range(len(filelist)):
-    img = cv2.imread(path + filelist[i])
-    imglist.append(img)
+def augment_batch(images, masks, seeds):
+    """
+    Augments a batch of uint8 images (B, H, W, 3) and their 0/255 masks with ``seq``.
+    Geometric ops (flips, rotation) are applied to the masks as well, pixel ops only
+    change the images. The same seed gives the same augmentation.
 
-print('all the picture have been appent to imglist')
+    Args:
+        images: uint8 images (B, H, W, C).
+        masks: uint8 masks (B, H, W, C) as read by ``cv2.imread``.
+        seeds: one seed per sample, e.g. derived from the epoch and the sample index, so the
+            augmentation of a sample does not depend on the other samples of the batch.
+            imgaug draws one seed per call, so every sample is augmented by its own call of
+            the reseeded deterministic ``seq``. A single int seeds the whole batch in one call.
+    Returns:
+        the augmented images and masks, with the same shapes and dtypes.
+    """
+    segmaps = [_mask_to_segmap(mask) for mask in masks]
+    if np.ndim(seeds) == 0:
+        seeds, images, segmaps = [seeds], [images], [segmaps]
+    else:
+        images, segmaps = [image[None] for image in images], [[segmap] for segmap in segmaps]
+    images_aug, segmaps_aug = [], []
+    # augment() takes no random_state, seed a deterministic copy of seq instead.
+    # One copy per batch, seed_ resets all its random states
+    det = seq.to_deterministic()
+    for seed, image_batch, segmap_batch in zip(seeds, images, segmaps):
+        det.seed_(int(seed))
+        image_aug, segmap_aug = det(images=image_batch, segmentation_maps=segmap_batch)
+        images_aug.extend(image_aug)
+        segmaps_aug.extend(segmap_aug)
+    masks_aug = np.empty_like(masks)
+    for i, segmap in enumerate(segmaps_aug):
+        masks_aug[i] = _MASK_VALUES[segmap.get_arr()][..., None]
+    return np.asarray(images_aug, dtype=np.uint8), masks_aug
 
-for count in range(20):
-    images_aug = seq.augment_images(imglist)
-    for j in range(len(filelist)):
-        (imagename, extension) = os.path.splitext(filelist[j])
-        filename = imagename + str(count) + '_' + str(j) + '_' + '.jpg'
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes augmented copies of the images of a directory and '
+                                                 'of their masks in the sibling masks directory.')
+    parser.add_argument('--images', required=True, help='directory with the images')
+    parser.add_argument('--output', required=True, help='output directory of the augmented images')
+    parser.add_argument('--copies', type=int, default=20, help='number of augmented copies per image')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
 
-        cv2.imwrite(savedpath + filename, images_aug[j])
-        print('image of count%s index%s has been writen' %(count, j))
\ No newline at end of file
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    mask_output = args.output.replace('images', 'masks')
+    if not os.path.exists(mask_output):
+        os.makedirs(mask_output)
+
+    filelist = sorted(os.listdir(args.images))
+    imglist = [cv2.imread(os.path.join(args.images, name)) for name in filelist]
+    masklist = [cv2.imread(os.path.join(args.images.replace('images', 'masks'), name)) for name in filelist]
+    print('all the picture have been appent to imglist')
+
+    for count in range(args.copies):
+        for j in range(len(filelist)):
+            images_aug, masks_aug = augment_batch(imglist[j][None], masklist[j][None], args.seed + count * len(filelist) + j)
+            (imagename, extension) = os.path.splitext(filelist[j])
+            filename = imagename + str(count) + '_' + str(j) + '_'
+
+            cv2.imwrite(os.path.join(args.output, filename + '.jpg'), images_aug[0])
+            # lossless, jpg would blur the 0/255 mask values into "no class" pixels
+            cv2.imwrite(os.path.join(mask_output, filename + '.png'), masks_aug[0])
+        print('copy %s has been writen' % count)
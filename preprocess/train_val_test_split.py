@@ -1,4 +1,5 @@
-from gernerate_data import split_train_and_test
+from gernerate_data import split_train_and_test, write_split_manifest
+import argparse
 import shutil
 import random
 import os
@@ -99,9 +100,9 @@ def split_train_and_test2(train_dir, test_split_size=0.1, val_split_size=0.1):
 
     train_img_dir = os.path.join(train_dir, 'images')
 
-    class_path_list = glob.glob(train_img_dir+'*\\*')
+    class_path_list = glob.glob(os.path.join(train_img_dir, '*'))
     for class_path in class_path_list:
-        all_images_list = glob.glob(class_path + '*\\*')
+        all_images_list = glob.glob(os.path.join(class_path, '*'))
         all_masks_list = str(all_images_list).replace('images', 'masks').replace('.jpg', '_mask.png')
 
         all_number = len(all_images_list)
@@ -139,22 +140,28 @@ def split_train_and_test2(train_dir, test_split_size=0.1, val_split_size=0.1):
 
 
 
-
-
-
-
-
-
-
-
-
-
-# 从原始数据集中找出带有mask的图像，并复制到test_dir中
-# copy_segmentation(img_dir, mask_dir, contour_dir, test_dir)
-
-# 分出测试集到test文件夹中
-# split_train_and_test(img_dir, mask_dir, contour_dir, test_dir, split_size=0.25)
-
-# 从训练集每个类别中分出验证集和测试集图像和对应的mask
-train_dir = '..\\dataset\\ICIS\\train\\'
-split_train_and_test2(train_dir, test_split_size=0.1, val_split_size=0.1)
+if __name__ == '__main__':
+    # 默认只写划分清单 (path, mask_path, label, fold), 不移动任何文件, 加 --move 使用旧的移动方式
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train', type=str, default='../dataset/ICIS/train/images/', help='images/<class>/ directory')
+    parser.add_argument('--manifest', type=str, default='../dataset/ICIS/split.csv', help='manifest to write')
+    parser.add_argument('--folds', type=int, default=5, help='number of stratified folds')
+    parser.add_argument('--test-size', type=float, default=0.1, help='held out test fraction')
+    parser.add_argument('--val-size', type=float, default=0.1, help='val fraction of --move')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--move', action='store_true', help='move val/test files like split_train_and_test2')
+    opt = parser.parse_args()
+
+    # 从原始数据集中找出带有mask的图像，并复制到test_dir中
+    # copy_segmentation(img_dir, mask_dir, contour_dir, test_dir)
+
+    # 分出测试集到test文件夹中
+    # split_train_and_test(img_dir, mask_dir, contour_dir, test_dir, split_size=0.25)
+
+    if opt.move:
+        # 从训练集每个类别中分出验证集和测试集图像和对应的mask
+        train_dir = os.path.dirname(os.path.normpath(opt.train))
+        split_train_and_test2(train_dir, test_split_size=opt.test_size, val_split_size=opt.val_size)
+    else:
+        write_split_manifest(opt.train, opt.manifest, n_folds=opt.folds, test_size=opt.test_size, seed=opt.seed)
+        print('manifest written to', opt.manifest)
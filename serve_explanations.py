@@ -0,0 +1,360 @@
+"""
+Serves explanations of a multi-task model (``classification_output`` and ``segmentation_output``,
+see ``models/MTL_IBA.py``) on localhost. The model, its weights and the estimate of the IBA
+layer are loaded once. Concurrent requests are collected for a few milliseconds and the
+prediction and the Grad-CAM of a batch run in one session call, the IBA optimizations of a
+batch run together (``IBALayer.analyze_heads_batch``).
+
+    python serve_explanations.py --model models.MTL_IBA:MTL_IBA_cross3 --weights wights/MTL_IBA_cross3.h5 \\
+        --iba iba --stats iba_stats.npz --gradcam-layer block4_c_conv3 --iba-batch 16 --port 8000
+
+    curl --data-binary @image.png 'http://127.0.0.1:8000/explain?iba=1&gradcam=1'
+
+``POST /explain`` takes the encoded image (png, jpg) as body and returns JSON with the class
+``probabilities``, the predicted ``class``, the segmentation ``mask`` and the requested saliency
+maps. Maps are base64 png images of the model input size, scaled to ``[0, 255]``; their
+``scale`` restores the values. ``GET /health`` returns the request and batch counters.
+``benchmark_explanations.py`` measures throughput and latency of a running server.
+"""
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import time
+import json
+import queue
+import base64
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import cv2
+
+from estimate_iba_stats import build_model
+from IBA.utils import load_estimator_state
+
+
+class RequestBatcher:
+    """
+    Collects the requests of the handler threads and runs them in batches of at most
+    ``max_batch`` on one worker thread. A batch is started ``max_wait`` seconds after its
+    first request or once it is full. ``process_batch(items)`` returns one result per item.
+    """
+    def __init__(self, process_batch, max_batch=8, max_wait=0.005):
+        self._process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.n_requests = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """ Returns a ``Future`` of the result of ``item``. """
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            items = [item for item, _ in batch]
+            try:
+                results = self._process_batch(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            self.n_requests += len(batch)
+            self.n_batches += 1
+
+
+class Explainer:
+    """
+    Prediction, Grad-CAM and IBA saliency of a keras multi-task model with an ``IBALayer``.
+    All graph ops are built in the constructor, :meth:`explain` only runs them. If the layer
+    has ``analyze_batch >= 2``, the IBA explains the classification and the segmentation
+    head in one optimization (see ``IBALayer.analyze_heads_batch``), otherwise only the class.
+    ``analyze_batch // n_heads`` images of a batch are optimized together, build the layer
+    with ``analyze_batch = n_heads * max_batch`` (``--iba-batch``) to run the IBA of a whole
+    batch at once.
+
+    Args:
+        model: keras model, build it in inference mode (``K.set_learning_phase(0)``).
+        iba_layer: name of the ``IBALayer``, it must have an estimate.
+        gradcam_layer: name of the convolution layer of the Grad-CAM.
+        classification_output, segmentation_output: names of the output layers.
+        iba_kwargs: hyperparameters of the IBA, see ``IBALayer.analyze``.
+    """
+    def __init__(self, model, iba_layer='iba', gradcam_layer=None,
+                 classification_output='classification_output',
+                 segmentation_output='segmentation_output', session=None, **iba_kwargs):
+        import keras.backend as K
+        try:
+            import tensorflow.compat.v1 as tf
+        except ModuleNotFoundError:
+            import tensorflow as tf
+
+        self._session = session or K.get_session()
+        self._model = model
+        self._iba = model.get_layer(iba_layer) if iba_layer else None
+        self._iba_kwargs = iba_kwargs
+        self._classification = model.get_layer(classification_output).output
+        self._segmentation = model.get_layer(segmentation_output).output
+        self.input_shape = tuple(model.input.shape.as_list()[1:3])
+
+        with self._session.graph.as_default():
+            self._gradcam = None
+            if gradcam_layer:
+                # one-hot class of every image, the images of a batch do not influence each other
+                self._gradcam_class = tf.placeholder(tf.float32, self._classification.shape)
+                conv = model.get_layer(gradcam_layer).output
+                score = tf.reduce_sum(self._classification * self._gradcam_class)
+                weights = tf.reduce_mean(tf.gradients(score, conv)[0], axis=(1, 2), keepdims=True)
+                self._gradcam = tf.nn.relu(tf.reduce_sum(weights * conv, axis=-1))
+
+            if self._iba is not None:
+                if self._iba._analyze_batch >= 2:
+                    self._iba_heads = ('classification', 'segmentation')
+                    self._iba_targets = self._iba.set_classification_segmentation_loss(
+                        self._classification, self._segmentation)
+                else:
+                    self._iba_heads = ('classification', )
+                    cls_target = tf.placeholder(tf.float32, self._classification.shape)
+                    cls_loss = K.mean(K.binary_crossentropy(
+                        cls_target * tf.ones_like(self._classification), self._classification), axis=-1)
+                    self._iba.set_multi_head_loss([cls_loss])
+                    self._iba_targets = (cls_target, )
+
+    def predict(self, x):
+        """ Returns the class probabilities and the segmentation outputs of the images ``x``. """
+        return self._session.run([self._classification, self._segmentation], {self._model.input: x})
+
+    def explain(self, x, iba=None, gradcam=None):
+        """
+        Explains the images ``x`` of the model input size.
+        Args:
+            x: images, float32 in ``[0, 1]``.
+            iba: one flag per image, compute the IBA saliency. Default: all images.
+            gradcam: one flag per image, compute the Grad-CAM. Default: all images.
+        Returns:
+            one dict per image with the ``probabilities``, the ``class``, the ``mask`` and
+            the ``gradcam`` and ``iba`` saliency maps if requested.
+        """
+        from IBA.tensorflow_v1 import to_saliency_maps
+        n = len(x)
+        iba = [self._iba is not None] * n if iba is None else iba
+        gradcam = [self._gradcam is not None] * n if gradcam is None else gradcam
+
+        probabilities, segmentation = self.predict(x)
+        classes = probabilities.argmax(-1)
+        one_hot = np.eye(probabilities.shape[-1], dtype=np.float32)[classes]
+        masks = segmentation.argmax(-1)
+        results = [{'probabilities': p, 'class': int(c), 'mask': m}
+                   for p, c, m in zip(probabilities, classes, masks)]
+
+        if self._gradcam is not None and any(gradcam):
+            cams = self._session.run(self._gradcam, {self._model.input: x, self._gradcam_class: one_hot})
+            h, w = self.input_shape
+            for result, cam, requested in zip(results, cams, gradcam):
+                if requested:
+                    result['gradcam'] = cv2.resize(cam, (w, h))
+
+        explained = np.flatnonzero(iba)
+        if self._iba is not None and len(explained) > 0:
+            # the predicted class and mask are explained, all images in the same optimization
+            seg_targets = np.eye(segmentation.shape[-1], dtype=np.float32)[masks]
+            targets = (one_hot[explained], seg_targets[explained])
+            feed_dict = dict(zip(self._iba_targets, targets))
+            feed_dict[self._model.input] = x[explained]
+            capacities = self._iba.analyze_heads_batch(feed_dict, session=self._session, **self._iba_kwargs)
+            for i, image_capacities in zip(explained, capacities):
+                saliency_maps = to_saliency_maps(image_capacities, shape=self.input_shape)
+                results[i]['iba'] = dict(zip(self._iba_heads, saliency_maps))
+        return results
+
+
+def with_analyze_batch(model, iba_layer, analyze_batch):
+    """
+    Returns a copy of ``model`` with the same weights whose ``IBALayer`` ``iba_layer`` has
+    ``analyze_batch`` slots. The builders of ``models/`` create the layer with one slot.
+    """
+    import keras
+    from IBA.tensorflow_v1 import IBALayer
+
+    def clone_layer(layer):
+        if layer.name == iba_layer:
+            return IBALayer(analyze_batch=analyze_batch, name=layer.name)
+        return layer.__class__.from_config(layer.get_config())
+    clone = keras.models.clone_model(model, clone_function=clone_layer)
+    clone.set_weights(model.get_weights())
+    return clone
+
+
+def decode_image(data, target):
+    """ Decodes an encoded image and resizes it to ``target`` (width, height), scaled to [0, 1]. """
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('could not decode the image')
+    return cv2.resize(img, target).astype(np.float32) / 255.0
+
+
+def encode_map(saliency_map):
+    """ Returns the base64 png of ``saliency_map`` scaled to uint8 and the ``scale`` to restore it. """
+    saliency_map = np.nan_to_num(np.asarray(saliency_map, dtype=np.float32))
+    scale = float(saliency_map.max()) if saliency_map.size else 0.
+    img = np.uint8(np.clip(saliency_map / scale, 0, 1) * 255) if scale > 0 else \
+        np.zeros(saliency_map.shape, np.uint8)
+    ok, png = cv2.imencode('.png', img)
+    return {'png': base64.b64encode(png.tobytes()).decode('ascii'), 'scale': scale}
+
+
+def to_json(result):
+    """ JSON of a result of :meth:`Explainer.explain`. """
+    out = {'probabilities': [float(p) for p in result['probabilities']],
+           'class': result['class'],
+           'mask': encode_map(result['mask'])}
+    if 'gradcam' in result:
+        out['gradcam'] = encode_map(result['gradcam'])
+    if 'iba' in result:
+        out['iba'] = {head: encode_map(m) for head, m in result['iba'].items()}
+    return out
+
+
+def batch_processor(explainer):
+    """ ``process_batch`` of the :class:`RequestBatcher`, items are ``(image, iba, gradcam)``. """
+    def process_batch(items):
+        x = np.stack([img for img, _, _ in items])
+        results = explainer.explain(x, iba=[flag for _, flag, _ in items],
+                                    gradcam=[flag for _, _, flag in items])
+        return [to_json(result) for result in results]
+    return process_batch
+
+
+def make_handler(explainer, batcher, timeout=300):
+    """ Returns the request handler class of the server. """
+    class ExplanationHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/health':
+                return self._send_json(404, {'error': 'not found'})
+            self._send_json(200, {'status': 'ok', 'requests': batcher.n_requests,
+                                  'batches': batcher.n_batches})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/explain':
+                return self._send_json(404, {'error': 'not found'})
+            query = parse_qs(url.query)
+
+            def flag(name, default):
+                return query.get(name, [str(int(default))])[0].lower() in ('1', 'true', 'yes')
+
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            h, w = explainer.input_shape
+            try:
+                img = decode_image(data, (w, h))
+            except ValueError as e:
+                return self._send_json(400, {'error': str(e)})
+            future = batcher.submit((img, flag('iba', True), flag('gradcam', True)))
+            try:
+                self._send_json(200, future.result(timeout))
+            except Exception as e:
+                self._send_json(500, {'error': repr(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ExplanationHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='saved keras model or module:builder, see estimate_iba_stats.build_model')
+    parser.add_argument('--weights', type=str, default=None, help='weights loaded into the model')
+    parser.add_argument('--target', type=int, nargs=2, default=[224, 224], help='width height of module:builder models')
+    parser.add_argument('--n-classes', type=int, default=2, help='classes of module:builder models')
+    parser.add_argument('--iba', type=str, default='iba', help='name of the IBALayer, empty to disable')
+    parser.add_argument('--stats', type=str, default=None, help='estimate of estimate_iba_stats.py --out')
+    parser.add_argument('--data', type=str, default=None, help='manifest of the cached estimate (--cache)')
+    parser.add_argument('--folds', type=str, nargs='*', default=None, help='folds of the cached estimate')
+    parser.add_argument('--gradcam-layer', type=str, default=None, help='layer of the Grad-CAM')
+    parser.add_argument('--steps', type=int, default=None, help='IBA optimization steps')
+    parser.add_argument('--beta', type=float, default=None)
+    parser.add_argument('--tol', type=float, default=None, help='IBA early stopping tolerance')
+    parser.add_argument('--iba-batch', type=int, default=None,
+                        help='analyze_batch of the IBA layer, e.g. 2 * --max-batch to optimize the '
+                             'two heads of all images of a batch together')
+    parser.add_argument('--max-batch', type=int, default=8, help='maximum requests per batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5., help='time to collect a batch')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    opt = parser.parse_args()
+    print(opt)
+
+    import keras.backend as K
+    from IBA.tensorflow_v1 import model_cache_key
+
+    K.set_learning_phase(0)
+    model = build_model(opt.model, opt.weights, tuple(opt.target), opt.n_classes)
+    if opt.iba and opt.iba_batch:
+        model = with_analyze_batch(model, opt.iba, opt.iba_batch)
+    if opt.iba:
+        iba = model.get_layer(opt.iba)
+        if opt.stats:
+            iba.load_state_dict({'estimator': load_estimator_state(opt.stats), 'feature_mean': None,
+                                 'feature_std': None, 'default_hyperparams': iba.get_default()})
+        else:
+            iba.set_cache_key(model_cache_key(model, opt.iba, opt.data, opt.folds, layer_input=True))
+        iba.set_default(steps=opt.steps, beta=opt.beta, tol=opt.tol)
+
+    explainer = Explainer(model, opt.iba or None, opt.gradcam_layer)
+    batcher = RequestBatcher(batch_processor(explainer), opt.max_batch, opt.max_wait_ms / 1000.)
+    server = ThreadingHTTPServer((opt.host, opt.port), make_handler(explainer, batcher))
+    print('serving explanations on http://%s:%d' % (opt.host, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
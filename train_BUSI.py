@@ -56,9 +56,9 @@ random.shuffle(train_imagePaths)
 random.shuffle(val_imagePaths)
 random.shuffle(test_imagePaths)
 
-train_x,  train_y, _ = load_cla_data(train_imagePaths, target)
-val_x, val_y, _ = load_cla_data(val_imagePaths, target)
-test_x, test_y, _ = load_cla_data(test_imagePaths, target)
+train_x,  train_y, _ = load_cla_data(train_imagePaths, target, cache=True)
+val_x, val_y, _ = load_cla_data(val_imagePaths, target, cache=True)
+test_x, test_y, _ = load_cla_data(test_imagePaths, target, cache=True)
 
 lb = LabelBinarizer()
 train_y = lb.fit_transform(train_y)
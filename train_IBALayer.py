@@ -74,6 +74,9 @@ target = (width, height)
 data_augmentation = True
 
 Name = "VGG16_64X64_5"
+# keras mixed precision policy: 'mixed_bfloat16' (CPU with oneDNN) or 'mixed_float16' (GPU), None for float32.
+# The softmax output and the IBALayer stay float32.
+MIXED_PRECISION = None
 
 train_path = './dataset/ICIS2/train/images/'
 test_path = train_path.replace('train', 'test')
@@ -115,6 +118,9 @@ print('test_x shape', test_x.shape)
 # Convert class vectors to binary class matrices.
 
 K.clear_session()
+if MIXED_PRECISION:
+    from keras import mixed_precision
+    mixed_precision.set_global_policy(MIXED_PRECISION)
 model = Sequential()
 
 model.add(Conv2D(64, (3, 3), activation='relu', padding='same', name='block1_conv1', use_bias=True,
@@ -146,7 +152,7 @@ model.add(Activation('relu', name='relu5'))
 
 model.add(Dropout(0.5, name='dropout2'))
 model.add(Dense(num_classes, name='fc2'))
-model.add(Activation('softmax', name='softmax'))
+model.add(Activation('softmax', name='softmax', dtype='float32'))
 
 if not run_training:
     print("loading weights")
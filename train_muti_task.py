@@ -1,9 +1,10 @@
-from gernerate_data import load_clas_seg_data
+from gernerate_data import load_clas_seg_data, ClasSegSequence, build_clas_seg_dataset
+from preprocess.imageaug import augment_batch
 import tensorflow as tf
 from sklearn.metrics import classification_report, auc, roc_curve
 from keras.utils.np_utils import *
 from keras.callbacks import LearningRateScheduler
-from models.MLT_net import MIB_Net, Multi_IB, Multi_task_VGG16_5, Multi_task_VGG16_4, \
+from models.MLT_net import create_pair_model, MIB_Net, Multi_IB, Multi_task_VGG16_5, Multi_task_VGG16_4, \
     Multi_task_Unet_finetune, Multi_task_Unet_pool3_finetune, Multi_task_Unet_pool4_finetune
 from sklearn.preprocessing import LabelBinarizer, label_binarize
 from utils.losses import dice_coef_loss, dice_coef, dice_p_bce, dice_p_focal, tversky_loss, focal_loss, focal_tversky, \
@@ -26,12 +27,27 @@ depth = 3
 img_size = 224
 Name = "MIB_LE_0.3"
 GPU = True
+CACHE = True  # decode the images once into dataset/<split>/cache/ and memory-map them afterwards
+AUGMENT = True  # augment the train batches on the fly with preprocess/imageaug.py
+WORKERS = 4  # processes preparing the train batches
+MANIFEST = None  # split manifest of preprocess/train_val_test_split.py, e.g. 'dataset/LE/split.csv'
+N_FOLDS = 5
+FOLD = 0  # validation fold if MANIFEST is set, the other folds are used for training
+TF_DATA = False  # feed model.fit with a prefetching tf.data pipeline instead of the Sequences
+# keras mixed precision policy: 'mixed_bfloat16' (CPU with oneDNN) or 'mixed_float16' (GPU), None for float32.
+# The model outputs and the IBA layers stay float32, so the losses and the capacity are computed in float32.
+# 'mixed_float16' scales the loss, so it trains with keras.optimizers.Adam in a LossScaleOptimizer.
+MIXED_PRECISION = None
 target = (img_size, img_size)
 
 if GPU:
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
+if MIXED_PRECISION:
+    from keras import mixed_precision
+    mixed_precision.set_global_policy(MIXED_PRECISION)
+
 
 print("------------------------------------------------ Reading data ------------------------------------------------")
 trainX_dir = 'dataset/LE/test/images/'
@@ -45,22 +61,36 @@ weight_path = 'wights/UNet_BUSI.h5'
 # model = Multi_task_VGG16_5(input_width=img_size, input_height=img_size, depth=depth, nClasses=2)
 # model = Multi_task(input_width=img_size, input_height=img_size, depth=depth, nClasses=2)
 # model = Multi_IB(input_width=img_size, input_height=img_size, depth=depth, nClasses=2)
+# model = create_pair_model(img_size, img_size, depth, nClasses=2, single_input=True)
 model = MIB_Net(input_width=img_size, input_height=img_size, depth=depth, nClasses=2)
 model.summary()
 # model.load_weights('Multi_IB_BUSI_0.4-040-0.9199.h5')
 
 
-train_x,  train_c_y, train_s_y = load_clas_seg_data(trainX_dir, target)
-val_x, val_c_y, val_s_y = load_clas_seg_data(valX_dir, target)
-test_x, test_c_y, test_s_y = load_clas_seg_data(testX_dir, target)
+train_folds = val_folds = test_folds = None
+if MANIFEST:
+    trainX_dir = valX_dir = testX_dir = MANIFEST
+    train_folds = [fold for fold in range(N_FOLDS) if fold != FOLD]
+    val_folds, test_folds = FOLD, 'test'
+
+# train and val are streamed batch by batch, only the test split is kept in memory
+train_gen = ClasSegSequence(trainX_dir, target, batch_size=batch_size, shuffle=True, n_inputs=len(model.inputs),
+                            cache=CACHE, augment=augment_batch if AUGMENT else None, folds=train_folds)
+val_gen = ClasSegSequence(valX_dir, target, batch_size=batch_size, shuffle=False,
+                          classes=train_gen.classes, n_inputs=len(model.inputs), cache=CACHE, folds=val_folds)
+test_x, test_c_y, test_s_y = load_clas_seg_data(testX_dir, target, cache=CACHE, folds=test_folds)
+classes = train_gen.classes
+if TF_DATA:
+    train_gen = build_clas_seg_dataset(trainX_dir, target, batch_size=batch_size, shuffle=True,
+                                       classes=classes, model=model, cache=CACHE,
+                                       augment=augment_batch if AUGMENT else None, folds=train_folds)
+    val_gen = build_clas_seg_dataset(valX_dir, target, batch_size=batch_size, shuffle=False,
+                                     classes=classes, model=model, cache=CACHE, tf_cache='', folds=val_folds)
 
 
 lb = LabelBinarizer()
-train_c_y = lb.fit_transform(train_c_y)
-val_c_y = lb.fit_transform(val_c_y)
-test_c_y = lb.fit_transform(test_c_y)
-train_c_y = to_categorical(train_c_y, 2)
-val_c_y = to_categorical(val_c_y, 2)
+lb.fit(classes)
+test_c_y = lb.transform(test_c_y)
 test_c_y = to_categorical(test_c_y, 2)
 
 
@@ -80,7 +110,13 @@ checkpoint_period2 = ModelCheckpoint(Name + '-{epoch:03d}-{val_segmentation_outp
 # define loss and compile the model
 
 print("------------------------------------------------ begin training ------------------------------------------------")
-opt = Adam(lr=INIT_LR, beta_1=0.9, beta_2=0.99, epsilon=1e-08, decay=0.01)
+if MIXED_PRECISION == 'mixed_float16':
+    # optimizer_v1.Adam cannot scale the loss, the float16 gradients would underflow
+    import keras
+    opt = mixed_precision.LossScaleOptimizer(
+        keras.optimizers.Adam(learning_rate=INIT_LR, beta_1=0.9, beta_2=0.99, epsilon=1e-08, decay=0.01))
+else:
+    opt = Adam(lr=INIT_LR, beta_1=0.9, beta_2=0.99, epsilon=1e-08, decay=0.01)
 
 # model.compile(loss={'segmentation_output': focal_tversky, "classification_output": binary_crossentropy},
 model.compile(loss={'segmentation_output': generalized_dice_loss, "classification_output": binary_crossentropy},
@@ -89,14 +125,13 @@ model.compile(loss={'segmentation_output': generalized_dice_loss, "classificatio
               metrics={'segmentation_output': ['accuracy', generalized_dice_coeff], "classification_output": ['accuracy']})
 
 
-hist = model.fit([train_x, train_x],
-                 [train_c_y, train_s_y],
-                 batch_size=batch_size,
+hist = model.fit(train_gen,
                  epochs=EPOCHS,
-                 validation_data=(val_x, [val_c_y, val_s_y]),
+                 validation_data=val_gen,
                  verbose=1,
-                 callbacks=[checkpoint_period2, checkpoint_period1, reduce_lr, csv_logger, reduce_lr],
-                 shuffle=True)
+                 workers=WORKERS,
+                 use_multiprocessing=True,
+                 callbacks=[checkpoint_period2, checkpoint_period1, reduce_lr, csv_logger, reduce_lr])
 
 print("------------------------------------------------ Saving model ------------------------------------------------")
 model_filename = Name + ".h5"
@@ -54,10 +54,10 @@ valY_dir = valX_dir.replace('images', 'masks')
 testX_dir = trainX_dir.replace('train', 'test')
 testY_dir = testX_dir.replace('images', 'masks')
 
-train_X, train_Y, _ = load_SEG_data(trainX_dir, target=target, shuffle=True)
+train_X, train_Y, _ = load_SEG_data(trainX_dir, target=target, shuffle=True, cache=True)
 #(train_X, val_X, train_Y, val_Y) = train_test_split(train_X, train_Y, test_size=0.2)
-val_X, val_Y, _ = load_SEG_data(valX_dir, target=target, shuffle=True)
-test_X, test_Y, test_img_Names, test_orignal_images = load_SEG_data_for_test(testX_dir, target=target, shuffle=False)
+val_X, val_Y, _ = load_SEG_data(valX_dir, target=target, shuffle=True, cache=True)
+test_X, test_Y, test_img_Names, test_orignal_images = load_SEG_data_for_test(testX_dir, target=target, shuffle=False, cache=True)
 
 print("train_X shape:", train_X.shape)
 print("train_X shape:", train_Y.shape)
@@ -154,6 +154,43 @@ def generalized_dice_coeff(y_true, y_pred):
 def generalized_dice_loss(y_true, y_pred):
     return 1 - generalized_dice_coeff(y_true, y_pred)
 
+# Sparse variants: y_true holds integer labels (batch, H, W[, 1]), -1 for pixels without class
+# (see gernerate_data.mask_to_labels). They give the same values as the one hot versions
+# without materializing the one hot ground truth.
+def _sparse_seg_sums(y_true, y_pred):
+    """
+    Returns the per class intersection and per class ground truth count and the
+    sum of all predictions.
+    """
+    n_classes = int(y_pred.shape[-1])
+    labels = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+    probs = tf.reshape(y_pred, [-1, n_classes])
+    valid = tf.cast(labels >= 0, y_pred.dtype)
+    labels = tf.maximum(labels, 0)
+    picked = tf.gather_nd(probs, tf.stack([tf.range(tf.shape(labels)[0]), labels], axis=1))
+    intersection = tf.math.unsorted_segment_sum(picked * valid, labels, n_classes)
+    count = tf.math.unsorted_segment_sum(valid, labels, n_classes)
+    return intersection, count, K.sum(y_pred)
+
+def sparse_dice_coef(y_true, y_pred):
+    smooth = 0.0005
+    intersection, count, pred_sum = _sparse_seg_sums(y_true, y_pred)
+    return (2. * K.sum(intersection) + smooth) / (K.sum(count) + pred_sum + smooth)
+
+def sparse_dice_coef_loss(y_true, y_pred):
+    return 1 - sparse_dice_coef(y_true, y_pred)
+
+def sparse_generalized_dice_coeff(y_true, y_pred):
+    intersection, count, pred_sum = _sparse_seg_sums(y_true, y_pred)
+    w = 1/(count**2+0.000001)
+    numerator = K.sum(w * K.sum(intersection))
+    denominator = K.sum(w * (K.sum(count) + pred_sum))
+    gen_dice_coef = 2*numerator/denominator
+    return gen_dice_coef
+
+def sparse_generalized_dice_loss(y_true, y_pred):
+    return 1 - sparse_generalized_dice_coeff(y_true, y_pred)
+
 import cv2 as cv
 def mask2_gray(mask, input_type=None):
 